@@ -0,0 +1,467 @@
+# chat_bench.py
+# 伺服器基準測試：啟動 chat_server 子程序，以大量真實連線量測記憶體、吞吐量與 CPU
+import argparse
+import json
+import os
+import secrets
+import selectors
+import socket
+import ssl
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from typing import Dict, List, Optional
+
+ENC = "utf-8"
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def proc_cpu(pid: int) -> float:
+    """子程序累計的 CPU 秒數（user + system）。"""
+    try:
+        with open(f"/proc/{pid}/stat", encoding="ascii") as f:
+            fields = f.read().rpartition(")")[2].split()
+        return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+    except OSError:
+        pass
+    try:
+        import psutil
+    except ImportError:
+        sys.exit("需要 Linux 的 /proc 或安裝 psutil 才能量測伺服器 CPU")
+    t = psutil.Process(pid).cpu_times()
+    return t.user + t.system
+
+
+def proc_status(pid: int) -> Dict[str, int]:
+    """讀 /proc/<pid>/status 的 VmRSS（bytes）與 Threads；非 Linux 時改用 psutil。"""
+    try:
+        out = {}
+        with open(f"/proc/{pid}/status", encoding="ascii") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    out["rss"] = int(line.split()[1]) * 1024
+                elif line.startswith("Threads:"):
+                    out["threads"] = int(line.split()[1])
+        return out
+    except OSError:
+        pass
+    try:
+        import psutil
+    except ImportError:
+        sys.exit("需要 Linux 的 /proc 或安裝 psutil 才能量測伺服器記憶體")
+    p = psutil.Process(pid)
+    return {"rss": p.memory_info().rss, "threads": p.num_threads()}
+
+
+class BenchServer:
+    """以子程序啟動 chat_server.py，關閉准入限制與心跳以免干擾量測。"""
+
+    def __init__(self, cert: str, key: str, port: int, extra: List[str]) -> None:
+        self.port = port
+        self.unix_path = None
+        if "--unix" in extra:
+            self.unix_path = extra[extra.index("--unix") + 1]
+        self.admin_token = secrets.token_hex(8)
+        cmd = [
+            sys.executable, os.path.join(HERE, "chat_server.py"),
+            "--host", "127.0.0.1", "--port", str(port), "--cert", cert, "--key", key,
+            "--max-conns", "0", "--max-conns-per-ip", "0", "--max-handshakes", "0",
+            "--backlog", "1024", "--ping-interval", "0", "--ping-timeout", "0",
+            "--admin-token", self.admin_token,
+        ] + extra
+        self.proc = subprocess.Popen(cmd, stdout=subprocess.DEVNULL)
+        deadline = time.monotonic() + 10
+        while True:
+            try:
+                socket.create_connection(("127.0.0.1", port), timeout=1).close()
+                if self.unix_path and not os.path.exists(self.unix_path):
+                    raise OSError("unix socket not ready")
+                break
+            except OSError:
+                if self.proc.poll() is not None or time.monotonic() > deadline:
+                    sys.exit("伺服器未能啟動")
+                time.sleep(0.1)
+
+    def status(self) -> Dict[str, int]:
+        return proc_status(self.proc.pid)
+
+    def cpu(self) -> float:
+        return proc_cpu(self.proc.pid)
+
+    def stop(self) -> None:
+        self.proc.terminate()
+        try:
+            self.proc.wait(5)
+        except subprocess.TimeoutExpired:
+            self.proc.kill()
+
+
+class ClientPool:
+    """一個執行緒用 selector 持有大量已 join 的連線並持續讀掉伺服器推送的資料。
+
+    transport 為 "tls"（直連伺服器的 TLS 埠）、"plain"（127.0.0.1 明文埠）或 "unix"；
+    proxy=True 時在明文連線開頭送 PROXY v1 標頭，模擬前面有 TLS 終結器。
+    """
+
+    def __init__(self, port: int, transport: str = "tls", unix_path: Optional[str] = None,
+                 proxy: bool = False) -> None:
+        self.port = port
+        self.transport = transport
+        self.unix_path = unix_path
+        self.proxy = proxy
+        self.ctx = ssl.create_default_context()
+        self.ctx.check_hostname = False
+        self.ctx.verify_mode = ssl.CERT_NONE
+        self.sel = selectors.DefaultSelector()
+        self.conns: List[socket.socket] = []
+        self.bytes_in = 0
+        self.last_recv = 0.0
+        self._watch: Optional[socket.socket] = None
+        self._watching = False
+        self._watch_buf = bytearray()
+        self.watched: List[dict] = []     # 等待 admin 回覆期間，第一條連線收到的訊息
+
+    def connect(self, name: str) -> socket.socket:
+        conn = self.open(name)
+        conn.setblocking(False)
+        self.sel.register(conn, selectors.EVENT_READ)
+        self.conns.append(conn)
+        if self._watch is None:
+            self._watch = conn
+        return conn
+
+    def open(self, name: str) -> socket.socket:
+        """建立連線並送出 join，回傳阻塞模式的 socket（不納入 pool 的讀取）。"""
+        if self.transport == "unix":
+            conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            conn.connect(self.unix_path)
+        else:
+            conn = socket.create_connection(("127.0.0.1", self.port))
+        if self.transport == "tls":
+            conn = self.ctx.wrap_socket(conn)
+        elif self.proxy:
+            # 每條連線假裝來自不同的來源位址
+            n = len(self.conns)
+            src = f"10.{n >> 16 & 255}.{n >> 8 & 255}.{n & 255}"
+            conn.sendall(f"PROXY TCP4 {src} 127.0.0.1 {40000 + n % 20000} {self.port}\r\n".encode("ascii"))
+        conn.sendall((json.dumps({"type": "join", "name": name}) + "\n").encode(ENC))
+        return conn
+
+    def drain(self, quiet: float = 0.0) -> int:
+        """讀掉所有可讀資料；quiet > 0 時一直讀到連續 quiet 秒沒有資料為止。"""
+        total = 0
+        last = time.monotonic()
+        while True:
+            events = self.sel.select(timeout=quiet or 0)
+            got = 0
+            for key, _ in events:
+                got += self._read(key.fileobj)
+            total += got
+            if got:
+                last = time.monotonic()
+            elif not quiet or time.monotonic() - last >= quiet:
+                return total
+
+    def send(self, conn: socket.socket, data: bytes) -> None:
+        """非阻塞送出；送不出去時先讀掉資料，避免與伺服器互相等待。"""
+        view = memoryview(data)
+        while view:
+            try:
+                view = view[conn.send(view):]
+            except (ssl.SSLWantWriteError, ssl.SSLWantReadError, BlockingIOError):
+                self.drain(quiet=0)
+                self.sel.select(timeout=0.01)
+
+    def _read(self, conn: socket.socket) -> int:
+        n = 0
+        while True:
+            try:
+                chunk = conn.recv(65536)
+            except (ssl.SSLWantReadError, BlockingIOError):
+                break
+            if not chunk:
+                self.sel.unregister(conn)
+                break
+            n += len(chunk)
+            if self._watching and conn is self._watch:
+                self._watch_buf += chunk
+                while b"\n" in self._watch_buf:
+                    line, _, rest = self._watch_buf.partition(b"\n")
+                    self._watch_buf = bytearray(rest)
+                    try:
+                        self.watched.append(json.loads(line))
+                    except ValueError:
+                        pass
+        if n:
+            self.bytes_in += n
+            self.last_recv = time.monotonic()
+        return n
+
+    def admin(self, token: str, cmd: str, timeout: float = 10.0) -> Optional[str]:
+        """由第一條連線送 admin 指令並等待回覆文字。"""
+        if self._watch is None:
+            return None
+        self.drain()
+        self.watched.clear()
+        self._watch_buf.clear()
+        self._watching = True
+        self._watch.setblocking(True)
+        self._watch.sendall((json.dumps({"type": "admin", "token": token, "cmd": cmd}) + "\n").encode(ENC))
+        self._watch.setblocking(False)
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            self.drain()
+            for msg in self.watched:
+                if msg.get("type") == "system" and str(msg.get("text", "")).startswith(cmd):
+                    self._watching = False
+                    return msg["text"]
+            time.sleep(0.05)
+        self._watching = False
+        return None
+
+    def close(self) -> None:
+        for conn in self.conns:
+            try:
+                conn.close()
+            except OSError:
+                pass
+        self.sel.close()
+
+
+class LatencyProbe:
+    """傳送期間另開一條連線，定期送 ping 與一則聊天，量 pong（control）與自己聊天回聲（chat）的往返時間。
+
+    probe 本身也收全部廣播，兩者都包含它前面已在傳輸中的資料；
+    伺服器啟用 --writer-threads 時 pong 可以插到排隊中的聊天之前。
+    """
+
+    def __init__(self, pool: ClientPool, interval: float) -> None:
+        self.conn = pool.open("probe")
+        self.interval = interval
+        self.rtt: Dict[str, List[float]] = {"control": [], "chat": []}
+        self._pings: List[float] = []
+        self._chats: Dict[str, float] = {}
+        self._sending = True
+        self._deadline = 0.0
+        self._thread = threading.Thread(target=self._loop, daemon=True)
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def stop(self, timeout: float = 10.0) -> None:
+        """停止送出；執行緒再等還沒回來的 pong 與回聲最多 timeout 秒。"""
+        self._deadline = time.monotonic() + timeout
+        self._sending = False
+
+    def close(self) -> None:
+        self._thread.join()
+        self.conn.close()
+
+    def _loop(self) -> None:
+        buf = bytearray()
+        n = 0
+        next_send = time.monotonic()
+        self.conn.settimeout(0.01)
+        while self._sending or ((self._pings or self._chats) and time.monotonic() < self._deadline):
+            now = time.monotonic()
+            if self._sending and now >= next_send:
+                tag = f"probe:{n}"
+                n += 1
+                self._pings.append(now)
+                self._chats[tag] = now
+                self.conn.sendall((json.dumps({"type": "ping"}) + "\n"
+                                   + json.dumps({"type": "chat", "text": tag}) + "\n").encode(ENC))
+                next_send = now + self.interval
+            try:
+                chunk = self.conn.recv(65536)
+            except (TimeoutError, ssl.SSLWantReadError):
+                continue
+            if not chunk:
+                return
+            now = time.monotonic()
+            buf += chunk
+            lines = buf.split(b"\n")
+            buf = bytearray(lines.pop())
+            for line in lines:
+                # 廣播量很大，先用位元組比對篩掉無關的行
+                if b'"pong"' in line and self._pings:
+                    self.rtt["control"].append(now - self._pings.pop(0))
+                elif b'"probe:' in line:
+                    tag = json.loads(line).get("text")
+                    if tag in self._chats:
+                        self.rtt["chat"].append(now - self._chats.pop(tag))
+
+    def summary(self) -> str:
+        parts = []
+        for lane, values in self.rtt.items():
+            values = sorted(values)
+            if not values:
+                parts.append(f"{lane} n=0")
+                continue
+
+            def pct(p: float) -> float:
+                return values[min(len(values) - 1, int(p * len(values)))] * 1000
+
+            parts.append(f"{lane} n={len(values)} p50={pct(0.5):.1f}ms p99={pct(0.99):.1f}ms max={values[-1] * 1000:.1f}ms")
+        return "probe rtt: " + "  ".join(parts)
+
+
+def run_idle(args) -> int:
+    """逐步建立 levels 指定數量的閒置連線，每一級量測伺服器 RSS 增量與每連線成本。
+
+    每次 join 都會廣播給所有已連線者，建立 N 條連線共需 O(N²) 則通知；
+    10k 級在單核機器上要數分鐘，量測前會等到通知全部送完、流量靜止。
+    """
+    levels = sorted(int(x) for x in args.levels.split(","))
+    extra = args.server_arg or []
+    server = BenchServer(args.cert, args.key, args.port, extra)
+    pool = ClientPool(args.port)
+    try:
+        time.sleep(args.settle)
+        base = server.status()
+        print(f"server pid={server.proc.pid} args={' '.join(extra) or '(default)'}")
+        print(f"baseline rss={base['rss'] / 1048576:.1f} MiB threads={base.get('threads', '?')}")
+        print(f"{'conns':>7} {'rss MiB':>9} {'Δrss/conn':>10} {'threads':>8} {'connect s':>10} {'notices MiB':>12}")
+        started = time.monotonic()
+        for level in levels:
+            t0 = time.monotonic()
+            while len(pool.conns) < level:
+                pool.connect(f"idle{len(pool.conns)}")
+                if len(pool.conns) % 50 == 0:
+                    pool.drain()
+            pool.drain(quiet=args.settle)
+            elapsed = time.monotonic() - t0
+            st = server.status()
+            per_conn = (st["rss"] - base["rss"]) / level
+            print(f"{level:7d} {st['rss'] / 1048576:9.1f} {per_conn:10.0f} {st.get('threads', 0):8d}"
+                  f" {elapsed:10.1f} {pool.bytes_in / 1048576:12.1f}", flush=True)
+            if args.report:
+                print(pool.admin(server.admin_token, "memory") or "(memory report timed out)")
+        print(f"total {time.monotonic() - started:.1f}s")
+    finally:
+        pool.close()
+        server.stop()
+    return 0
+
+
+def run_throughput(args) -> int:
+    """比較伺服器自行做 TLS 與 TLS 交給本機終結器（明文／Unix socket 端點）時的吞吐量與 CPU。
+
+    傳送端依序送出聊天訊息，每則訊息扇出給所有連線（含傳送端）；吞吐量以送達則數計，
+    CPU 只計伺服器程序。明文模式下終結器本身的 CPU 不在此數字內，
+    而且本工具與伺服器在同一台機器上搶 CPU，絕對數字只適合互相比較。
+    --coalesce 列出多個窗口時每種組合各跑一次，並附上伺服器統計的批次大小與排隊延遲；
+    --writers 同理，附上伺服器統計的各優先序排隊延遲。--probe-ms 另開一條連線量 control 與 chat 的往返時間。
+    """
+    transports = [t.strip() for t in args.transport.split(",") if t.strip()]
+    windows = [float(w) for w in args.coalesce.split(",") if w.strip()]
+    writers = [int(w) for w in args.writers.split(",") if w.strip()]
+    # 兩種模式互斥，同時指定時不跑該組合
+    runs = [(t, w, n) for t in transports for w in windows for n in writers if not (w and n)]
+    payload_text = "x" * args.size
+    conns = args.senders + args.receivers
+    delivered = args.senders * args.messages * conns
+    print(f"senders={args.senders} receivers={args.receivers} messages/sender={args.messages}"
+          f" size={args.size} deliveries/run={delivered}")
+    print(f"{'transport':<12} {'deliv/s':>10} {'sent/s':>9} {'srv cpu s':>10} {'µs/deliv':>9} {'µs/sent':>8}")
+    for i, (transport, window, nwriters) in enumerate(runs):
+        port = args.port + i
+        extra = ["--coalesce-ms", str(window), "--writer-threads", str(nwriters)]
+        if transport == "plain":
+            extra += ["--plain-port", str(port + 100)]
+        elif transport == "unix":
+            extra += ["--unix", os.path.join(args.unix_dir, f"chat_bench-{os.getpid()}.sock")]
+        if args.proxy and transport != "tls":
+            extra.append("--proxy-protocol")
+        server = BenchServer(args.cert, args.key, port, extra + (args.server_arg or []))
+        pool = ClientPool(port + 100 if transport == "plain" else port, transport, server.unix_path,
+                          proxy=args.proxy)
+        try:
+            senders = [pool.connect(f"tx{n}") for n in range(args.senders)]
+            for n in range(args.receivers):
+                pool.connect(f"rx{n}")
+            probe = LatencyProbe(pool, args.probe_ms / 1000) if args.probe_ms > 0 else None
+            pool.drain(quiet=args.settle)
+            base_bytes = pool.bytes_in
+            cpu0 = server.cpu()
+            if probe is not None:
+                probe.start()
+            t0 = time.monotonic()
+            for m in range(args.messages):
+                for conn in senders:
+                    line = json.dumps({"type": "chat", "text": payload_text, "id": m}) + "\n"
+                    pool.send(conn, line.encode(ENC))
+                pool.drain()
+            if probe is not None:
+                probe.stop()    # 先停，否則它的聊天會讓流量一直不靜止
+            pool.drain(quiet=args.settle)
+            if probe is not None:
+                probe.close()
+            elapsed = max(pool.last_recv - t0, 1e-9)
+            cpu = server.cpu() - cpu0
+            sent = args.senders * args.messages
+            label = transport + (" +proxy" if args.proxy and transport != "tls" else "")
+            if window:
+                label += f" c={window:g}"
+            if nwriters:
+                label += f" w={nwriters}"
+            print(f"{label:<12}"
+                  f" {delivered / elapsed:10.0f} {sent / elapsed:9.0f} {cpu:10.2f}"
+                  f" {cpu * 1e6 / delivered:9.1f} {cpu * 1e6 / sent:8.0f}"
+                  f"  ({(pool.bytes_in - base_bytes) / 1048576:.1f} MiB in {elapsed:.1f}s)", flush=True)
+            if probe is not None:
+                print(f"{'':<12} {probe.summary()}", flush=True)
+            if window:
+                print(f"{'':<12} {pool.admin(server.admin_token, 'coalesce')}", flush=True)
+            if nwriters:
+                report = pool.admin(server.admin_token, "lanes") or "lanes: (timed out)"
+                print("\n".join(f"{'':<12} {line}" for line in report.splitlines()), flush=True)
+        finally:
+            pool.close()
+            server.stop()
+    return 0
+
+
+def main():
+    ap = argparse.ArgumentParser(description="chat_server benchmarks")
+    sub = ap.add_subparsers(dest="mode", required=True)
+    idle = sub.add_parser("idle", help="resident memory per idle joined connection")
+    idle.add_argument("--cert", required=True, help="server TLS certificate (PEM)")
+    idle.add_argument("--key", required=True, help="server TLS private key (PEM)")
+    idle.add_argument("--port", type=int, default=5077, help="port for the benchmark server (default: 5077)")
+    idle.add_argument("--levels", default="1000,5000,10000", help="comma-separated connection counts (default: 1000,5000,10000)")
+    idle.add_argument("--settle", type=float, default=1.0, help="seconds without traffic before sampling (default: 1)")
+    idle.add_argument("--report", action="store_true", help="also print the server's per-component memory report")
+    idle.add_argument("--server-arg", action="append", metavar="ARG",
+                      help="extra argument passed to chat_server.py (repeatable, e.g. --server-arg=--thread-stack-kb=256)")
+    tput = sub.add_parser("throughput", help="fan-out throughput and server CPU, in-process TLS vs. offloaded")
+    tput.add_argument("--cert", required=True, help="server TLS certificate (PEM)")
+    tput.add_argument("--key", required=True, help="server TLS private key (PEM)")
+    tput.add_argument("--port", type=int, default=5077, help="first port for benchmark servers (default: 5077)")
+    tput.add_argument("--transport", default="tls,plain,unix",
+                      help="comma-separated: tls = server terminates TLS, plain/unix = offloaded listener (default: all)")
+    tput.add_argument("--coalesce", default="0", metavar="MS[,MS...]",
+                      help="comma-separated --coalesce-ms windows to compare, 0 = off (default: 0)")
+    tput.add_argument("--writers", default="0", metavar="N[,N...]",
+                      help="comma-separated --writer-threads counts to compare, 0 = off (default: 0)")
+    tput.add_argument("--probe-ms", type=float, default=0.0,
+                      help="measure ping and chat round trips on an extra connection every N ms during the run, 0 = off (default: 0)")
+    tput.add_argument("--proxy", action="store_true", help="send a PROXY v1 header on plaintext connections")
+    tput.add_argument("--senders", type=int, default=4, help="connections sending chat messages (default: 4)")
+    tput.add_argument("--receivers", type=int, default=50, help="connections only receiving (default: 50)")
+    tput.add_argument("--messages", type=int, default=500, help="messages per sender (default: 500)")
+    tput.add_argument("--size", type=int, default=100, help="chat text length in characters (default: 100)")
+    tput.add_argument("--settle", type=float, default=1.0, help="seconds without traffic that end a phase (default: 1)")
+    tput.add_argument("--unix-dir", default=tempfile.gettempdir(), help="directory for the Unix socket (default: temp dir)")
+    tput.add_argument("--server-arg", action="append", metavar="ARG", help="extra argument passed to chat_server.py (repeatable)")
+    args = ap.parse_args()
+    if args.mode == "idle":
+        sys.exit(run_idle(args))
+    if args.mode == "throughput":
+        sys.exit(run_throughput(args))
+
+
+if __name__ == "__main__":
+    main()
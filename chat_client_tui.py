@@ -1,5 +1,11 @@
 # chat_client_tui.py
 # 需求: pip install prompt_toolkit
+from __future__ import annotations
+
+import time
+
+_T0 = time.perf_counter()   # --startup-profile 的起點：本模組開始載入
+
 import socket
 import ssl
 import threading
@@ -8,30 +14,32 @@ import argparse
 import datetime
 import unicodedata
 import platform
-import time
-import ctypes
-import ipaddress
 import os
-from dataclasses import dataclass
-from typing import Callable, List, Optional
-
-from prompt_toolkit import Application
-from prompt_toolkit.layout import HSplit, Window, Layout
-from prompt_toolkit.layout.controls import FormattedTextControl, UIControl, UIContent
-from prompt_toolkit.widgets import TextArea
-from prompt_toolkit.key_binding import KeyBindings
-from prompt_toolkit.styles import Style
-from prompt_toolkit.application.current import get_app
-from prompt_toolkit.mouse_events import MouseEventType
+import mmap
+import re
+import bisect
+import base64
+import hashlib
+import struct
+from array import array
+from collections import deque
+from dataclasses import dataclass, field
+from typing import TYPE_CHECKING, Any, BinaryIO, Callable, Dict, List, Optional, Set, Tuple
+
+from chat_diag import Diagnostics
+from chat_net import tune_keepalive
+
 from wcwidth import wcswidth
 
-if platform.system() == "Windows":
-    from ctypes import wintypes
-else:
-    wintypes = None
+if TYPE_CHECKING:
+    import asyncio
+
+# prompt_toolkit（連帶 asyncio）約占匯入時間的七成，只在 _build_ui()／asyncio 模式才匯入，
+# 讓它與 TCP/TLS 連線及 join 並行；ctypes、ipaddress、random、tempfile、tracemalloc 也在用到時才匯入。
 
 ENC = "utf-8"
 
+
 def east_asian_width(s: str) -> int:
     w = 0
     for ch in s:
@@ -121,8 +129,10 @@ class TaskbarFlasher:
         self._setup()
 
     def _setup(self) -> None:
-        if platform.system() != "Windows" or wintypes is None:
+        if platform.system() != "Windows":
             return
+        import ctypes
+        from ctypes import wintypes
         try:
             self._user32 = ctypes.windll.user32
             self._kernel32 = ctypes.windll.kernel32
@@ -253,6 +263,7 @@ class TaskbarFlasher:
             return False
         if not self._ensure_hwnd():
             return False
+        import ctypes
         info = self._flashwinfo_cls()
         info.cbSize = ctypes.sizeof(info)
         info.hwnd = self.hwnd
@@ -361,10 +372,443 @@ class ChatEntry:
     ts: str
 
 
+FILE_CHUNK = 16 * 1024      # /send 每個分塊的原始大小；base64 後約 22 KiB 一行
+
+
+@dataclass
+class FileTransfer:
+    """上傳或下載中的檔案；上傳只由寫入端讀檔，下載只由接收端寫檔，記憶體中只有一個分塊。"""
+    name: str
+    path: str
+    size: int
+    f: Optional[BinaryIO] = None
+    done: int = 0
+    seq: int = 0
+    sha: Any = field(default_factory=hashlib.sha256)
+
+
+def format_size(n: int) -> str:
+    if n < 1024:
+        return f"{n} B"
+    if n < 1024 * 1024:
+        return f"{n / 1024:.1f} KiB"
+    return f"{n / (1024 * 1024):.1f} MiB"
+
+
+_CJK_CHARS = "\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff\uac00-\ud7af"
+_TOKEN_RE = re.compile(f"[{_CJK_CHARS}]+|[^\\W{_CJK_CHARS}]+")
+_CJK_RE = re.compile(f"[{_CJK_CHARS}]")
+
+
+def _tokenize(text: str) -> Set[str]:
+    """英數以整個單字為 token；CJK 連續字串切成 unigram + bigram（中文沒有空白分詞）。"""
+    tokens: Set[str] = set()
+    for m in _TOKEN_RE.finditer(text.lower()):
+        run = m.group()
+        if _CJK_RE.match(run):
+            tokens.update(run)
+            tokens.update(run[i:i + 2] for i in range(len(run) - 1))
+        else:
+            tokens.add(run)
+    return tokens
+
+
+def _query_tokens(term: str) -> Set[str]:
+    tokens: Set[str] = set()
+    for m in _TOKEN_RE.finditer(term.lower()):
+        run = m.group()
+        if _CJK_RE.match(run) and len(run) > 1:
+            tokens.update(run[i:i + 2] for i in range(len(run) - 1))
+        else:
+            tokens.add(run)
+    return tokens
+
+
+class HistoryIndex:
+    """ChatHistory 的倒排索引：token -> 項目 id，隨 append / 溢出 / 淘汰增量維護。
+
+    常駐項目的 posting 放在 set（可刪除）；溢出到 scrollback 的項目不會再變動，
+    先累積成遞增的 array，滿 _SEGMENT_DOCS 筆寫成 PostingFile 的一段，記憶體只留常駐與這一段。
+    """
+
+    _SEGMENT_DOCS = 4096
+
+    def __init__(self, spill: Optional[PostingFile] = None) -> None:
+        self._postings: Dict[str, Set[int]] = {}
+        self._pending: Dict[str, array] = {}  # 已溢出、尚未寫到 spill 的 posting
+        self._pending_docs = 0
+        self._latin: List[str] = []          # 常駐與 _pending 中排序過的英數 token，供前綴查詢
+        self.spill = spill
+
+    def add(self, doc_id: int, text: str) -> None:
+        for tok in _tokenize(text):
+            bucket = self._postings.get(tok)
+            if bucket is None:
+                if tok not in self._pending:
+                    self._add_vocab(tok)
+                bucket = self._postings[tok] = set()
+            bucket.add(doc_id)
+
+    def remove(self, doc_id: int, text: str) -> None:
+        for tok in _tokenize(text):
+            bucket = self._postings.get(tok)
+            if bucket is None:
+                continue
+            bucket.discard(doc_id)
+            if not bucket:
+                del self._postings[tok]
+                if tok not in self._pending:
+                    self._drop_vocab(tok)
+
+    def freeze(self, doc_id: int, text: str) -> None:
+        """項目溢出到 scrollback：posting 移到 array。呼叫端須依 id 遞增的順序呼叫。"""
+        for tok in _tokenize(text):
+            bucket = self._postings.get(tok)
+            if bucket is not None:
+                bucket.discard(doc_id)
+                if not bucket:
+                    del self._postings[tok]
+            frozen = self._pending.get(tok)
+            if frozen is None:
+                frozen = self._pending[tok] = array("I")
+            frozen.append(doc_id)
+        self._pending_docs += 1
+        if self.spill is not None and self._pending_docs >= self._SEGMENT_DOCS:
+            self.spill.write_segment(self._pending)
+            for tok in self._pending:
+                if tok not in self._postings:
+                    self._drop_vocab(tok)
+            self._pending = {}
+            self._pending_docs = 0
+
+    def clear(self) -> None:
+        self._postings.clear()
+        self._pending.clear()
+        self._pending_docs = 0
+        self._latin = []
+        if self.spill is not None:
+            self.spill.clear()
+
+    def candidates(self, term: str, below: Optional[int] = None) -> List[int]:
+        """回傳包含 term 所有 token 的項目 id（遞增）；英數 token 以前綴比對，長 CJK 片段需呼叫端再驗證。
+
+        從 posting 最短的 token 展開，其餘 token 只對剩下的 id 逐一檢查，不展開成集合。
+        below 以外（>= below）的 id 不回傳。
+        """
+        query = _query_tokens(term)
+        if not query:
+            return []
+        groups = []
+        for tok in query:
+            cjk = bool(_CJK_RE.match(tok))
+            keys = [tok] if cjk else self._prefixed(tok)
+            resident = [self._postings[k] for k in keys if k in self._postings]
+            frozen = [self._pending[k] for k in keys if k in self._pending]
+            disk = self.spill.find(tok, prefix=not cjk) if self.spill is not None else []
+            size = sum(map(len, resident)) + sum(map(len, frozen)) + sum(d[3] for d in disk)
+            if not size:
+                return []
+            groups.append((size, resident, frozen, disk))
+        groups.sort(key=lambda g: g[0])
+        _, resident, frozen, disk = groups[0]
+        ids: Set[int] = set().union(*resident, *frozen)
+        for _, _, offset, count in disk:
+            ids.update(self.spill.read(offset, count))
+        result = sorted(i for i in ids if below is None or i < below)
+        for _, resident, frozen, disk in groups[1:]:
+            if not result:
+                break
+            ordered = list(frozen)
+            for first, last, offset, count in disk:
+                # 只讀 id 範圍內還有候選的段
+                i = bisect.bisect_left(result, first)
+                if i < len(result) and result[i] <= last:
+                    ordered.append(self.spill.read(offset, count))
+            result = [
+                i for i in result
+                if any(i in bucket for bucket in resident) or any(_sorted_has(seq, i) for seq in ordered)
+            ]
+        return result
+
+    def _prefixed(self, prefix: str) -> List[str]:
+        i = bisect.bisect_left(self._latin, prefix)
+        keys = []
+        while i < len(self._latin) and self._latin[i].startswith(prefix):
+            keys.append(self._latin[i])
+            i += 1
+        return keys
+
+    def _add_vocab(self, tok: str) -> None:
+        if not _CJK_RE.match(tok):
+            bisect.insort(self._latin, tok)
+
+    def _drop_vocab(self, tok: str) -> None:
+        if not _CJK_RE.match(tok):
+            i = bisect.bisect_left(self._latin, tok)
+            if i < len(self._latin) and self._latin[i] == tok:
+                del self._latin[i]
+
+
+def _sorted_has(seq, value: int) -> bool:
+    i = bisect.bisect_left(seq, value)
+    return i < len(seq) and seq[i] == value
+
+
+def _matches(term: str, text: str) -> bool:
+    """與 HistoryIndex.candidates 加上 _verify_runs 複驗相同的判斷，用於單筆新項目。"""
+    query = _query_tokens(term)
+    if not query:
+        return False
+    tokens = _tokenize(text)
+    for tok in query:
+        if _CJK_RE.match(tok):
+            if tok not in tokens:
+                return False
+        elif not any(t.startswith(tok) for t in tokens):
+            return False
+    haystack = text.lower()
+    return all(r in haystack for r in _verify_runs(term))
+
+
+def _verify_runs(term: str) -> List[str]:
+    # 三字以上的 CJK 片段需複驗：bigram 交集不保證字元相鄰
+    return [
+        m.group() for m in _TOKEN_RE.finditer(term.lower())
+        if _CJK_RE.match(m.group()) and len(m.group()) > 2
+    ]
+
+
+class ScrollbackFile:
+    """ChatHistory 溢出項目的磁碟備份：append-only 檔案 + 位移索引，以 mmap 延遲讀回。"""
+
+    def __init__(self, path: Optional[str] = None):
+        self.path = path
+        if path:
+            self._fh = self._open_new(path)
+        else:
+            import tempfile
+            self._fh = tempfile.TemporaryFile(prefix="chat-scrollback-")
+        self._offsets = array("Q")  # 第 i 筆的起始位移
+        self._size = 0
+        self._mm: Optional[mmap.mmap] = None
+        self._mm_size = 0
+
+    @staticmethod
+    def _open_new(path: str) -> BinaryIO:
+        # 只用新檔或空檔：既有內容不是這次的歷史，截斷會毀掉使用者的檔案
+        try:
+            return open(path, "x+b")
+        except FileExistsError:
+            pass
+        fh = open(path, "r+b")
+        if os.fstat(fh.fileno()).st_size > 0:
+            fh.close()
+            raise FileExistsError(f"{path} 已存在且不是空檔，請為 --scrollback-file 指定新的路徑")
+        return fh
+
+    def __len__(self) -> int:
+        return len(self._offsets)
+
+    def append_many(self, entries: List[ChatEntry]) -> None:
+        if not entries:
+            return
+        chunks = []
+        pos = self._size
+        for e in entries:
+            data = json.dumps([e.user, e.text, e.ts], ensure_ascii=False).encode(ENC) + b"\n"
+            self._offsets.append(pos)
+            pos += len(data)
+            chunks.append(data)
+        self._fh.seek(self._size)
+        self._fh.write(b"".join(chunks))
+        self._fh.flush()
+        self._size = pos
+
+    def read(self, start: int, end: int) -> List[ChatEntry]:
+        start = max(0, start)
+        end = min(end, len(self._offsets))
+        if start >= end:
+            return []
+        mm = self._map()
+        out = []
+        for i in range(start, end):
+            a = self._offsets[i]
+            b = self._offsets[i + 1] if i + 1 < len(self._offsets) else self._size
+            try:
+                user, text, ts = json.loads(mm[a:b])
+            except (ValueError, TypeError):
+                user, text, ts = "?", "", ""
+            out.append(ChatEntry(user=user, text=text, ts=ts))
+        return out
+
+    def clear(self) -> None:
+        self._unmap()
+        self._fh.seek(0)
+        self._fh.truncate(0)
+        self._offsets = array("Q")
+        self._size = 0
+
+    def close(self) -> None:
+        self._unmap()
+        try:
+            self._fh.close()
+        except Exception:
+            pass
+
+    def _map(self) -> mmap.mmap:
+        # 檔案只會變長；映射範圍不足時才重新映射
+        if self._mm is None or self._mm_size < self._size:
+            self._unmap()
+            self._mm = mmap.mmap(self._fh.fileno(), self._size, access=mmap.ACCESS_READ)
+            self._mm_size = self._size
+        return self._mm
+
+    def _unmap(self) -> None:
+        if self._mm is not None:
+            try:
+                self._mm.close()
+            except Exception:
+                pass
+        self._mm = None
+        self._mm_size = 0
+
+
+class PostingFile:
+    """HistoryIndex 溢出部分的 posting：每段一次寫出、token 依 UTF-8 排序，以 mmap 二分搜尋。
+
+    一段依序是 posting 區（uint32 id）、token 區（補齊到 4 bytes）與目錄；目錄每個 token 4 個
+    uint32：token 位移、token 長度、posting 位移、筆數，皆相對於段首。記憶體只留每段的位置與 id 範圍。
+    """
+
+    _ENTRY = struct.Struct("<4I")
+
+    def __init__(self, path: Optional[str] = None):
+        self.path = path
+        if path:
+            self._fh = ScrollbackFile._open_new(path)
+        else:
+            import tempfile
+            self._fh = tempfile.TemporaryFile(prefix="chat-index-")
+        self._segments: List[Tuple[int, int, int, int, int]] = []   # (段首, 目錄位移, token 數, 最小 id, 最大 id)
+        self._size = 0
+        self._mm: Optional[mmap.mmap] = None
+        self._mm_size = 0
+
+    def write_segment(self, postings: Dict[str, array]) -> None:
+        if not postings:
+            return
+        items = sorted((tok.encode(ENC), ids) for tok, ids in postings.items())
+        posting_bytes = sum(4 * len(ids) for _, ids in items)
+        chunks: List[bytes] = []
+        keys = bytearray()
+        table = bytearray()
+        post = 0
+        for key, ids in items:
+            chunks.append(ids.tobytes())
+            table += self._ENTRY.pack(posting_bytes + len(keys), len(key), post, len(ids))
+            keys += key
+            post += 4 * len(ids)
+        keys += b"\0" * (-len(keys) % 4)
+        chunks.append(bytes(keys))
+        chunks.append(bytes(table))
+        first = min(ids[0] for _, ids in items)
+        last = max(ids[-1] for _, ids in items)
+        self._segments.append((self._size, posting_bytes + len(keys), len(items), first, last))
+        data = b"".join(chunks)
+        self._fh.seek(self._size)
+        self._fh.write(data)
+        self._fh.flush()
+        self._size += len(data)
+
+    def find(self, token: str, prefix: bool = False) -> List[Tuple[int, int, int, int]]:
+        """回傳 [(段的最小 id, 最大 id, posting 絕對位移, 筆數)]；prefix 為真時比對所有以 token 開頭的 key。"""
+        if not self._segments:
+            return []
+        key = token.encode(ENC)
+        mm = self._map()
+        out = []
+        for base, table, count, first, last in self._segments:
+            lo, hi = 0, count
+            while lo < hi:
+                mid = (lo + hi) // 2
+                if self._key(mm, base, table, mid) < key:
+                    lo = mid + 1
+                else:
+                    hi = mid
+            while lo < count:
+                k_off, k_len, p_off, n = self._ENTRY.unpack_from(mm, base + table + 16 * lo)
+                k = mm[base + k_off:base + k_off + k_len]
+                if k != key and not (prefix and k.startswith(key)):
+                    break
+                out.append((first, last, base + p_off, n))
+                if not prefix:
+                    break
+                lo += 1
+        return out
+
+    def read(self, offset: int, count: int) -> array:
+        ids = array("I")
+        ids.frombytes(self._map()[offset:offset + 4 * count])
+        return ids
+
+    def clear(self) -> None:
+        self._unmap()
+        self._fh.seek(0)
+        self._fh.truncate(0)
+        self._segments = []
+        self._size = 0
+
+    def close(self) -> None:
+        self._unmap()
+        try:
+            self._fh.close()
+        except Exception:
+            pass
+
+    def _key(self, mm: mmap.mmap, base: int, table: int, i: int) -> bytes:
+        k_off, k_len, _, _ = self._ENTRY.unpack_from(mm, base + table + 16 * i)
+        return mm[base + k_off:base + k_off + k_len]
+
+    def _map(self) -> mmap.mmap:
+        if self._mm is None or self._mm_size < self._size:
+            self._unmap()
+            self._mm = mmap.mmap(self._fh.fileno(), self._size, access=mmap.ACCESS_READ)
+            self._mm_size = self._size
+        return self._mm
+
+    def _unmap(self) -> None:
+        if self._mm is not None:
+            try:
+                self._mm.close()
+            except Exception:
+                pass
+        self._mm = None
+        self._mm_size = 0
+
+
 class ChatHistory:
-    def __init__(self, max_entries: int = 10000):
+    # 有 scrollback 時一次溢出一批，減少寫檔與 list 前段刪除的次數
+    _SPILL_BATCH = 256
+    # 搜尋複驗時每批持有 self.lock 的筆數，讓 render 可以穿插
+    _VERIFY_BATCH = 256
+
+    def __init__(self, max_entries: int = 10000, scrollback: Optional[ScrollbackFile] = None):
         self.max_entries = max_entries
-        self.entries: List[ChatEntry] = []
+        self.entries: List[ChatEntry] = []   # 常駐記憶體的最新部分
+        self.scrollback = scrollback
+        self._base = 0                       # entries[0] 的邏輯索引（= 已溢出到磁碟的筆數）
+        self._dropped = 0                    # 無 scrollback 時已丟棄的筆數；項目 id = _dropped + 邏輯索引
+        spill = None
+        if scrollback is not None:
+            spill = PostingFile(f"{scrollback.path}.idx" if scrollback.path else None)
+        self.index = HistoryIndex(spill)     # 涵蓋常駐與已溢出到 scrollback 的項目
+        self._index_lock = threading.Lock()  # 搜尋在背景執行緒查索引，不占用 self.lock
+        self.highlight: Optional[int] = None # 搜尋命中的項目 id
+        self.search_term = ""
+        self.search_hits: List[int] = []     # 目前搜尋的命中 id；之後新增的項目符合時由 append 補上
+        self._search_gen = 0
+        self._window_start = 0               # 目前解碼中的磁碟視窗
+        self._window: List[ChatEntry] = []
         self.view_start = 0
         self.follow_bottom = True
         self.last_height = 0
@@ -383,11 +827,27 @@ class ChatHistory:
 
     def append(self, entry: ChatEntry) -> None:
         with self.lock:
+            doc_id = self._dropped + self._total()
+            text = f"{entry.user} {entry.text}"
+            with self._index_lock:
+                self.index.add(doc_id, text)
+            if self.search_term and _matches(self.search_term, text):
+                self.search_hits.append(doc_id)
             self.entries.append(entry)
             overflow = len(self.entries) - self.max_entries
             if overflow > 0:
-                del self.entries[:overflow]
-                self.view_start = max(0, self.view_start - overflow)
+                if self.scrollback is not None:
+                    evict = min(len(self.entries), overflow + min(self._SPILL_BATCH, self.max_entries // 4))
+                    self._freeze(evict)
+                    self.scrollback.append_many(self.entries[:evict])
+                    del self.entries[:evict]
+                    self._base += evict
+                else:
+                    self._unindex(overflow)
+                    del self.entries[:overflow]
+                    self._dropped += overflow
+                    self.view_start = max(0, self.view_start - overflow)
+                    del self.search_hits[:bisect.bisect_left(self.search_hits, self._dropped)]
 
             if self.follow_bottom:
                 target_start = self._max_start(height_hint=self.last_height)
@@ -399,9 +859,21 @@ class ChatHistory:
 
     def clear(self) -> None:
         with self.lock:
-            if not self.entries and self.view_start == 0 and self.follow_bottom:
+            if not self._total() and self.view_start == 0 and self.follow_bottom:
                 return
             self.entries.clear()
+            with self._index_lock:
+                self.index.clear()
+            self.highlight = None
+            self.search_term = ""
+            self.search_hits = []
+            self._search_gen += 1
+            self._base = 0
+            self._dropped = 0
+            self._window = []
+            self._window_start = 0
+            if self.scrollback is not None:
+                self.scrollback.clear()
             self.view_start = 0
             self.follow_bottom = True
             self._last_snapshot = {
@@ -418,7 +890,7 @@ class ChatHistory:
         height = max(1, height)
         with self.lock:
             self.last_height = height
-            total = len(self.entries)
+            total = self._total()
             max_start = self._max_start(height_hint=height)
 
             if self.follow_bottom:
@@ -428,19 +900,26 @@ class ChatHistory:
 
             start = self.view_start
             end = min(total, start + height)
-            visible_entries = self.entries[start:end]
+            visible_entries = self._entries_between(start, end)
             lines = [format_line(e.user, e.text, e.ts, width) for e in visible_entries]
 
             missing = height - len(lines)
             if missing > 0:
                 lines.extend(["" for _ in range(missing)])
 
+            highlight_row = None
+            if self.highlight is not None:
+                pos = self.highlight - self._dropped
+                if start <= pos < end:
+                    highlight_row = pos - start
+
             self._last_snapshot = {
                 "total": total,
                 "view_start": start,
                 "view_end": end,
                 "follow_bottom": self.follow_bottom,
                 "height": height,
+                "highlight_row": highlight_row,
             }
 
         return lines
@@ -487,9 +966,96 @@ class ChatHistory:
         with self.lock:
             return dict(self._last_snapshot)
 
+    def search(self, term: str) -> List[int]:
+        """回傳符合 term 的項目 id（由舊到新），含已溢出到 scrollback 的項目；空字串取消搜尋。
+
+        之後新增的項目符合時由 append 加進 search_hits。只在複驗時分批持有 self.lock，
+        可在背景執行緒呼叫；被更新的搜尋或 clear() 取代時回傳空串列。
+        """
+        with self.lock:
+            self._search_gen += 1
+            gen = self._search_gen
+            self.search_term = term
+            self.search_hits = []
+            below = self._dropped + self._total()   # 從這裡開始由 append 比對
+        if not term:
+            return []
+        with self._index_lock:
+            ids = self.index.candidates(term, below)
+        runs = _verify_runs(term)
+        if runs:
+            verified = []
+            for n in range(0, len(ids), self._VERIFY_BATCH):
+                with self.lock:
+                    if gen != self._search_gen:
+                        return []
+                    for i in ids[n:n + self._VERIFY_BATCH]:
+                        e = self._entry_by_id(i)
+                        if e is not None and all(r in f"{e.user} {e.text}".lower() for r in runs):
+                            verified.append(i)
+            ids = verified
+        with self.lock:
+            if gen != self._search_gen:
+                return []
+            # 搜尋期間被淘汰的項目不回傳
+            self.search_hits[:0] = ids[bisect.bisect_left(ids, self._dropped):]
+            return list(self.search_hits)
+
+    def jump_to(self, entry_id: Optional[int]) -> None:
+        """捲動使指定項目位於視窗中央並標示；None 則取消標示。"""
+        with self.lock:
+            self.highlight = entry_id
+            if entry_id is not None:
+                pos = entry_id - self._dropped
+                height = max(1, self.last_height)
+                self.follow_bottom = False
+                self.view_start = self._clamp_view_start(pos - height // 2)
+                self.follow_bottom = self.view_start >= self._max_start(height)
+        self._notify_change()
+
+    def _total(self) -> int:
+        return self._base + len(self.entries)
+
+    def _unindex(self, count: int) -> None:
+        first = self._dropped + self._base
+        with self._index_lock:
+            for i, e in enumerate(self.entries[:count]):
+                self.index.remove(first + i, f"{e.user} {e.text}")
+
+    def _freeze(self, count: int) -> None:
+        first = self._dropped + self._base
+        with self._index_lock:
+            for i, e in enumerate(self.entries[:count]):
+                self.index.freeze(first + i, f"{e.user} {e.text}")
+
+    def _entry_by_id(self, entry_id: int) -> Optional[ChatEntry]:
+        if entry_id < self._dropped:
+            return None
+        offset = self._dropped + self._base
+        if entry_id < offset:
+            # 有 scrollback 時 _dropped 為 0，id 即 scrollback 中的筆次
+            return self.scrollback.read(entry_id, entry_id + 1)[0]
+        pos = entry_id - offset
+        return self.entries[pos] if pos < len(self.entries) else None
+
+    def _entries_between(self, start: int, end: int) -> List[ChatEntry]:
+        # 以邏輯索引取 [start, end)：磁碟部分只解碼視窗所需的幾筆
+        out: List[ChatEntry] = []
+        if start < self._base and self.scrollback is not None:
+            disk_end = min(end, self._base)
+            win_end = self._window_start + len(self._window)
+            if not (self._window_start <= start and disk_end <= win_end):
+                self._window_start = start
+                self._window = self.scrollback.read(start, disk_end)
+            out.extend(self._window[start - self._window_start:disk_end - self._window_start])
+        mem_start = max(0, start - self._base)
+        mem_end = max(0, end - self._base)
+        out.extend(self.entries[mem_start:mem_end])
+        return out
+
     def _max_start(self, height_hint: int) -> int:
         height = max(1, height_hint)
-        total = len(self.entries)
+        total = self._total()
         return max(0, total - height)
 
     def _clamp_view_start(self, value: int, height_hint: Optional[int] = None) -> int:
@@ -505,40 +1071,34 @@ class ChatHistory:
                 pass
 
 
-class ChatHistoryControl(UIControl):
-    def __init__(self, history: ChatHistory):
-        self.history = history
-        self._last_height = 1
-
-    def is_focusable(self) -> bool:
-        return False
-
-    def create_content(self, width: int, height: Optional[int]) -> UIContent:
-        real_height = height if height and height > 0 else self._last_height
-        real_height = max(1, real_height)
-        self._last_height = real_height
-        lines = self.history.render(width, real_height)
+class StartupProfile:
+    """--startup-profile：記錄啟動各階段的時間點（可跨執行緒），結束時印出。"""
 
-        if not lines:
-            lines = [""]
+    def __init__(self, enabled: bool) -> None:
+        self.enabled = enabled
+        self._marks: List[Tuple[float, str, str]] = []
+        self._lock = threading.Lock()
 
-        def get_line(i: int):
-            return [("", lines[i])]
+    def mark(self, label: str, t: Optional[float] = None) -> None:
+        if not self.enabled:
+            return
+        t = time.perf_counter() if t is None else t
+        with self._lock:
+            self._marks.append((t, threading.current_thread().name, label))
 
-        return UIContent(
-            get_line=get_line,
-            line_count=len(lines),
-            show_cursor=False,
-        )
+    def elapsed_ms(self) -> float:
+        return (time.perf_counter() - _T0) * 1000
 
-    def mouse_handler(self, mouse_event) -> object:
-        if mouse_event.event_type == MouseEventType.SCROLL_UP:
-            self.history.scroll_up(3)
-            return None
-        if mouse_event.event_type == MouseEventType.SCROLL_DOWN:
-            self.history.scroll_down(3)
-            return None
-        return NotImplemented
+    def report(self) -> str:
+        with self._lock:
+            marks = sorted(self._marks)
+        lines = ["[STARTUP] 自本模組開始載入起算（不含直譯器本身啟動），delta 為同一執行緒前一階段"]
+        last: Dict[str, float] = {}
+        for t, thread, label in marks:
+            delta = (t - last.get(thread, _T0)) * 1000
+            last[thread] = t
+            lines.append(f"  {(t - _T0) * 1000:8.1f} ms  (+{delta:6.1f})  {thread:<10} {label}")
+        return "\n".join(lines)
 
 
 class ChatClientTUI:
@@ -551,7 +1111,18 @@ class ChatClientTUI:
         ca_path: Optional[str] = None,
         server_name: Optional[str] = None,
         insecure: bool = False,
+        scrollback_path: Optional[str] = None,
+        use_asyncio: bool = False,
+        record_path: Optional[str] = None,
+        headless: bool = False,
+        busy_retries: int = 3,
+        ping_interval: float = 20.0,
+        ping_timeout: float = 60.0,
+        diag_dir: str = ".",
+        download_dir: str = ".",
+        startup: Optional[StartupProfile] = None,
     ):
+        self.startup = startup or StartupProfile(False)
         self.host = host
         self.addr = (host, port)
         self.name = name
@@ -564,31 +1135,80 @@ class ChatClientTUI:
             self._insecure_mode = True
             self._insecure_reason = "--insecure" if insecure else "未指定 --ca"
 
-        base_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         if self._verification_enabled:
             self.ssl_ctx = ssl.create_default_context(
                 ssl.Purpose.SERVER_AUTH,
                 cafile=ca_path,
             )
             self.ssl_ctx.check_hostname = True
-            self.sock = self.ssl_ctx.wrap_socket(
-                base_sock,
-                server_hostname=self.server_name,
-            )
         else:
             self.ssl_ctx = ssl.create_default_context(ssl.Purpose.SERVER_AUTH)
             self.ssl_ctx.check_hostname = False
             self.ssl_ctx.verify_mode = ssl.CERT_NONE
-            self.sock = self.ssl_ctx.wrap_socket(
-                base_sock,
-                server_hostname=self.server_name,
-            )
+
+        # asyncio 模式：連線在 prompt_toolkit 的事件迴圈上收發，不開額外執行緒
+        self.use_asyncio = use_asyncio
+        self.headless = headless
+        self.ping_interval = ping_interval
+        self.ping_timeout = ping_timeout
+        self._last_recv = time.monotonic()
+        self._last_ping = 0.0
+        self.sock: Optional[ssl.SSLSocket] = None
+        if not use_asyncio and not headless:
+            self.sock = self._new_socket()
+        self.busy_retries = busy_retries
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._wakeup: Optional[asyncio.Event] = None
         self.running = True
 
+        # 線上診斷：SIGUSR1/SIGUSR2 或 /profile、/memsnap，結果顯示為系統訊息
+        self.diag = Diagnostics("chat_client", diag_dir, log=self._append_system)
+
+        # 錄製收到的原始 NDJSON（每行前加上相對到達時間），供 --replay 重播
+        self._record = open(record_path, "wb") if record_path else None
+        self._record_t0 = time.monotonic()
+
+        # 送出管線：UI 只負責排入佇列，由寫入執行緒合併後一次寫出
+        self._outbox: List[bytes] = []
+        self._outbox_cond = threading.Condition()
+        self._inflight = 0
+        self._next_msg_id = 0
+        self._unacked: Dict[int, float] = {}   # 訊息 id -> 送出時間（依 id 遞增排列）；受 _outbox_cond 保護
+        self._written_id = 0                    # 已交給寫入端的最大訊息 id
+        self._ack_expired = 0
+        self._send_failed = False
+        self._paused = False        # 伺服器交接期間暫停寫出，訊息留在佇列，重新連線後送往新程序
+
+        # 伺服器升級：收到 reconnect 後繼續讀舊連線到期限，再帶 resume token 連到新程序
+        self._resume: Optional[Tuple[Optional[str], float]] = None   # (token, 期限)
+        self._writer: Optional[asyncio.StreamWriter] = None
+
+        # 檔案傳送：寫入端每批最多夾帶一個分塊並在各上傳之間輪流，聊天訊息不必排在整個檔案後面
+        self.download_dir = download_dir
+        self._next_xfer = 0
+        self._uploads: Dict[int, FileTransfer] = {}     # xfer -> 等待接受或傳送中
+        self._sending: deque = deque()                  # 已被接受、輪流送分塊的 xfer（受 _outbox_cond 保護）
+        self._downloads: Dict[str, FileTransfer] = {}   # 伺服器檔案 id -> 下載中
+
         # UI：上方訊息窗 + 下方輸入列
         self._flasher = TaskbarFlasher(debug=flash_debug)
-        self.history = ChatHistory()
+        self.history = ChatHistory(scrollback=ScrollbackFile(scrollback_path))
+        self._search_term = ""
+        self._search_pos = -1
+        self._search_gen = 0
+        self._searching = False     # 背景搜尋尚未回來；命中清單在 history.search_hits
         self.history.set_on_change(self._on_history_change)
+        # UI 在 start() 中與連線並行建構；headless（重播）不建構
+
+    def _build_ui(self) -> None:
+        from prompt_toolkit import Application
+        from prompt_toolkit.layout import HSplit, Window, Layout
+        from prompt_toolkit.layout.controls import FormattedTextControl
+        from prompt_toolkit.widgets import TextArea
+        from prompt_toolkit.key_binding import KeyBindings
+        from prompt_toolkit.styles import Style
+        from chat_client_ui import ChatHistoryControl
+        self.startup.mark("ui imports")
 
         self.history_control = ChatHistoryControl(self.history)
         self.output_window = Window(
@@ -632,9 +1252,43 @@ class ChatClientTUI:
                 return
             if txt == "/clear":
                 self.history.clear()
+                self._set_search("")
+                self.input.text = ""
+                return
+            if txt in ("/profile", "/memsnap"):
+                action = self.diag.toggle_profile if txt == "/profile" else self.diag.snapshot_memory
+                threading.Thread(target=action, daemon=True).start()
+                self.input.text = ""
+                return
+            if txt == "/msg" or txt.startswith("/msg "):
+                parts = txt.split(None, 2)
+                if len(parts) < 3:
+                    self._append_system("用法: /msg <名稱> <訊息>")
+                    return
+                self._send_dm(parts[1], parts[2])
+                self.input.text = ""
+                return
+            if txt == "/send" or txt.startswith("/send "):
+                path = txt[len("/send"):].strip().strip('"')
+                if not path:
+                    self._append_system("用法: /send <檔案路徑>")
+                    return
+                self._send_file(os.path.expanduser(path))
                 self.input.text = ""
                 return
-            self._send_json({"type": "chat", "text": txt})
+            if txt == "/get" or txt.startswith("/get "):
+                parts = txt.split()
+                if len(parts) != 2:
+                    self._append_system("用法: /get <檔案代號>")
+                    return
+                self._send_json({"type": "file_get", "id": parts[1]})
+                self.input.text = ""
+                return
+            if txt == "/find" or txt.startswith("/find "):
+                self._set_search(txt[len("/find"):].strip())
+                self.input.text = ""
+                return
+            self._send_chat(txt)
             self.input.text = ""  # 清空輸入列
 
         @kb.add("pageup")
@@ -657,6 +1311,16 @@ class ChatClientTUI:
             self._flasher.notify_user_activity()
             self.history.scroll_to_bottom()
 
+        @kb.add("f3")
+        def _(event):
+            self._flasher.notify_user_activity()
+            self._step_search(-1)
+
+        @kb.add("f4")
+        def _(event):
+            self._flasher.notify_user_activity()
+            self._step_search(1)
+
         root = HSplit([
             self.output_window,
             Window(height=1, char="-"),
@@ -666,6 +1330,7 @@ class ChatClientTUI:
 
         style = Style.from_dict({
             "prompt": "bold",
+            "search-match": "reverse",
         })
         self.app = Application(
             layout=Layout(root, focused_element=self.input),
@@ -674,57 +1339,291 @@ class ChatClientTUI:
             full_screen=True,
             mouse_support=True,
         )
+        if self.startup.enabled:
+            self.app.after_render += self._on_first_renders
 
-    def start(self):
-        try:
-            self.sock.connect(self.addr)
-        except ssl.SSLCertVerificationError as err:
-            self._handle_cert_error(err)
-            self._cleanup_failed_connect()
-            return
-        except ssl.SSLError as err:
-            self._handle_ssl_error(err)
-            self._cleanup_failed_connect()
+    def _on_first_renders(self, app) -> None:
+        if not self.startup.enabled:
             return
-        except Exception as err:
-            print(f"[CLIENT] Connect failed: {err}")
-            self._cleanup_failed_connect()
-            return
-
-        self._send_json({"type": "join", "name": self.name})
+        if not hasattr(self, "_first_render_done"):
+            self._first_render_done = True
+            self.startup.mark("first render")
+        if self.history._total() > 0:
+            self.startup.mark("first message rendered")
+            self.startup.enabled = False        # 之後的重繪不再記錄
+            app.after_render -= self._on_first_renders
+            self._append_system(f"[startup] 啟動到第一則訊息顯示: {self.startup.elapsed_ms():.0f} ms")
+
+    # 送出 join 後等待伺服器第一行回覆的上限
+    _JOIN_TIMEOUT = 15.0
 
-        # 開啟接收執行緒
-        threading.Thread(target=self._recv_loop, daemon=True).start()
+    def start(self):
+        if self.use_asyncio:
+            import asyncio
+            asyncio.run(self.run_async())
+            return
 
-        self._flasher.start()
-        self._flasher._debug_print("client", f"start enabled={self._flasher.enabled} hwnd=0x{int(self._flasher.hwnd):X}")
+        # 連線與 join 在背景執行緒進行，主執行緒同時載入 prompt_toolkit 並建構 UI
+        joined: dict = {}
+        connector = threading.Thread(target=self._connect, args=(joined,), name="connect", daemon=True)
+        connector.start()
+        self._build_ui()
+        self.startup.mark("ui built")
+        connector.join()
+        if "first" not in joined:
+            return
+        rfile, first = joined["rfile"], joined["first"]
 
-        # 起始提示
-        self._append_system(f"Connected to {self.addr[0]}:{self.addr[1]} as {self.name}")
-        if self._insecure_mode:
-            reason = self._insecure_reason or "未指定 --ca"
-            self._append_system(f"警告: 目前為不驗證模式（{reason}）")
+        # 開啟寫入與接收執行緒
+        threading.Thread(target=self._send_loop, daemon=True).start()
+        self._on_connected(first)
+        threading.Thread(target=self._recv_loop, args=(rfile,), daemon=True).start()
+        if self.ping_interval > 0:
+            threading.Thread(target=self._heartbeat_loop, daemon=True).start()
 
         # 進入 TUI 主迴圈
         try:
             self.app.run()
         finally:
-            # 清理
+            # 清理：先讓 leave 等尚未寫出的訊息送完
+            self._flush_outbox(timeout=1.0)
             self.running = False
+            with self._outbox_cond:
+                self._outbox_cond.notify_all()
             try:
                 self.sock.shutdown(socket.SHUT_RDWR)
             except Exception:
                 pass
             self.sock.close()
             self._flasher.shutdown()
+            self._close_local_files()
+
+    def _connect(self, joined: dict) -> None:
+        """連線、送出 join 並讀回第一行（含 busy 重試）；成功時在 joined 放入 rfile 與 first。"""
+        attempt = 0
+        while True:
+            try:
+                self.sock.connect(self.addr)
+                self.startup.mark("tcp+tls connected")
+                self.sock.sendall(self._encode(self._join_msg()))
+                self.sock.settimeout(self._JOIN_TIMEOUT)
+                rfile = self.sock.makefile("r", encoding=ENC, newline="\n")
+                first = rfile.readline()
+                self.sock.settimeout(None)
+                self.startup.mark("join reply")
+            except Exception as err:
+                self._handle_connect_error(err)
+                self._cleanup_failed_connect()
+                return
+            wait = self._busy_wait(first, attempt)
+            if wait is None:
+                break
+            try:
+                self.sock.close()
+            except Exception:
+                pass
+            if wait < 0:
+                self._cleanup_failed_connect()
+                return
+            time.sleep(wait)
+            attempt += 1
+            self.sock = self._new_socket()
+        joined["rfile"] = rfile
+        joined["first"] = first
+
+    async def run_async(self) -> None:
+        """在目前的事件迴圈上連線並執行 TUI；讀取、寫入與重繪都在同一執行緒。"""
+        import asyncio
+        self._loop = asyncio.get_running_loop()
+        self._wakeup = asyncio.Event()
+        # 連線在事件迴圈上進行，prompt_toolkit 的匯入與 UI 建構交給工作執行緒並行
+        connecting = asyncio.ensure_future(self._connect_async())
+        await asyncio.to_thread(self._build_ui)
+        self.startup.mark("ui built")
+        joined = await connecting
+        if joined is None:
+            return
+        await self._run_app_async(*joined)
+
+    async def _connect_async(self):
+        """asyncio 版的連線與 join；成功回傳 (reader, writer, first)，失敗回傳 None。"""
+        import asyncio
+        attempt = 0
+        while True:
+            try:
+                reader, writer = await asyncio.open_connection(
+                    self.addr[0],
+                    self.addr[1],
+                    ssl=self.ssl_ctx,
+                    server_hostname=self.server_name,
+                    limit=1 << 20,
+                )
+                raw_sock = writer.get_extra_info("socket")
+                if raw_sock is not None:
+                    self._tune_keepalive(raw_sock)
+                self.startup.mark("tcp+tls connected")
+                writer.write(self._encode(self._join_msg()))
+                await writer.drain()
+                first = await asyncio.wait_for(reader.readline(), self._JOIN_TIMEOUT)
+                self.startup.mark("join reply")
+            except Exception as err:
+                self._handle_connect_error(err)
+                self._cleanup_failed_connect()
+                return None
+            wait = self._busy_wait(first.decode(ENC, errors="replace"), attempt)
+            if wait is None:
+                return reader, writer, first
+            writer.close()
+            if wait < 0:
+                self._cleanup_failed_connect()
+                return None
+            await asyncio.sleep(wait)
+            attempt += 1
+
+    async def _run_app_async(self, reader, writer, first) -> None:
+        import asyncio
+        self._writer = writer
+        send_task = asyncio.ensure_future(self._send_loop_async())
+        self._on_connected(first)
+        recv_task = asyncio.ensure_future(self._recv_loop_async(reader))
+        ping_task = asyncio.ensure_future(self._heartbeat_async()) if self.ping_interval > 0 else None
+
+        try:
+            await self.app.run_async()
+        finally:
+            deadline = time.monotonic() + 1.0
+            while (self._outbox or self._inflight) and not self._send_failed and time.monotonic() < deadline:
+                await asyncio.sleep(0.01)
+            self.running = False
+            self._wakeup.set()
+            recv_task.cancel()
+            if ping_task is not None:
+                ping_task.cancel()
+            try:
+                self._writer.close()
+                await asyncio.wait_for(self._writer.wait_closed(), 1.0)
+            except Exception:
+                pass
+            send_task.cancel()
+            self._flasher.shutdown()
+            self._close_local_files()
+
+    def _new_socket(self) -> ssl.SSLSocket:
+        raw = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._tune_keepalive(raw)
+        return self.ssl_ctx.wrap_socket(raw, server_hostname=self.server_name)
+
+    def _tune_keepalive(self, sock) -> None:
+        if self.ping_interval > 0:
+            tune_keepalive(sock, int(self.ping_interval), max(1, int(self.ping_interval) // 2), 3)
+
+    def _heartbeat_due(self) -> Optional[str]:
+        """回傳 "dead"（逾時未收到任何資料）、"ping"（該送 ping）或 None。"""
+        now = time.monotonic()
+        idle = now - self._last_recv
+        if self.ping_timeout and idle > self.ping_timeout:
+            return "dead"
+        if idle >= self.ping_interval and now - self._last_ping >= self.ping_interval:
+            self._last_ping = now
+            return "ping"
+        return None
+
+    def _heartbeat_tick(self) -> float:
+        return max(0.5, min(self.ping_interval, self.ping_timeout or self.ping_interval) / 4)
+
+    def _heartbeat_loop(self) -> None:
+        while self.running:
+            time.sleep(self._heartbeat_tick())
+            due = self._heartbeat_due()
+            if due == "ping":
+                self._send_json({"type": "ping"})
+            elif due == "dead":
+                self._append_system(f"超過 {self.ping_timeout:.0f} 秒沒有收到伺服器資料，視為斷線")
+                try:
+                    self.sock.shutdown(socket.SHUT_RDWR)   # 讓接收執行緒醒來
+                except OSError:
+                    pass
+                return
+
+    async def _heartbeat_async(self) -> None:
+        import asyncio
+        while self.running:
+            await asyncio.sleep(self._heartbeat_tick())
+            due = self._heartbeat_due()
+            if due == "ping":
+                self._send_json({"type": "ping"})
+            elif due == "dead":
+                self._append_system(f"超過 {self.ping_timeout:.0f} 秒沒有收到伺服器資料，視為斷線")
+                self._writer.transport.abort()
+                return
+
+    def _busy_wait(self, first_line: str, attempt: int) -> Optional[float]:
+        """檢查 join 後的第一行：None 表示已進入聊天室；>=0 為重試前等待秒數；-1 表示放棄。"""
+        if not first_line:
+            print("[CLIENT] 伺服器在加入前關閉連線")
+            return -1.0
+        try:
+            msg = json.loads(first_line)
+        except json.JSONDecodeError:
+            return None
+        if not isinstance(msg, dict) or msg.get("type") != "busy":
+            return None
+        reason = msg.get("reason", "busy")
+        if attempt >= self.busy_retries:
+            print(f"[CLIENT] 伺服器忙碌（{reason}），已重試 {attempt} 次，放棄連線")
+            return -1.0
+        try:
+            retry_after = max(0.0, float(msg.get("retry_after", 5)))
+        except (TypeError, ValueError):
+            retry_after = 5.0
+        import random
+        # 加一點隨機抖動，避免被拒的客戶端同時重連
+        wait = retry_after + random.uniform(0, min(5.0, retry_after / 2 + 1))
+        print(f"[CLIENT] 伺服器忙碌（{reason}），{wait:.1f} 秒後重試（{attempt + 1}/{self.busy_retries}）")
+        return wait
+
+    def _on_connected(self, first_line) -> None:
+        self.diag.install_signal_handlers()
+        self._flasher.start()
+        self._flasher._debug_print("client", f"start enabled={self._flasher.enabled} hwnd=0x{int(self._flasher.hwnd):X}")
+
+        # 起始提示
+        self._append_system(f"Connected to {self.addr[0]}:{self.addr[1]} as {self.name}")
+        if self._insecure_mode:
+            reason = self._insecure_reason or "未指定 --ca"
+            self._append_system(f"警告: 目前為不驗證模式（{reason}）")
+        # 與 busy 檢查一起讀到的第一行
+        self._process_line(first_line if isinstance(first_line, bytes) else first_line.encode(ENC))
+
+    def _handle_connect_error(self, err: Exception) -> None:
+        if isinstance(err, ssl.SSLCertVerificationError):
+            self._handle_cert_error(err)
+        elif isinstance(err, ssl.SSLError):
+            self._handle_ssl_error(err)
+        else:
+            print(f"[CLIENT] Connect failed: {err}")
 
     def _cleanup_failed_connect(self) -> None:
         self.running = False
-        try:
-            self.sock.close()
-        except Exception:
-            pass
+        if self.sock is not None:
+            try:
+                self.sock.close()
+            except Exception:
+                pass
         self._flasher.shutdown()
+        self._close_local_files()
+
+    def _close_local_files(self) -> None:
+        if self.history.scrollback is not None:
+            self.history.scrollback.close()
+        if self.history.index.spill is not None:
+            self.history.index.spill.close()
+        self._close_record()
+        for t in list(self._uploads.values()):
+            self._close_quietly(t.f)
+        self._uploads.clear()
+        for file_id in list(self._downloads):
+            self._abort_download(file_id)
 
     def _handle_cert_error(self, err: ssl.SSLCertVerificationError) -> None:
         print("[CLIENT] TLS 憑證驗證失敗:")
@@ -752,32 +1651,224 @@ class ChatClientTUI:
 
     @staticmethod
     def _is_ip_address(value: str) -> bool:
+        import ipaddress
         try:
             ipaddress.ip_address(value)
             return True
         except ValueError:
             return False
 
-    def _recv_loop(self):
-        f = self.sock.makefile("r", encoding=ENC, newline="\n")
+    def _recv_loop(self, f):
         while self.running:
-            line = f.readline()
-            if not line:
+            try:
+                line = f.readline()
+            except (OSError, ValueError):
+                line = ""           # 含交接期限到了的讀取逾時
+            if line:
+                self._process_line(line.encode(ENC))
+                if self._resume is None:
+                    continue
+                self._pause_sending()
+                remaining = self._resume[1] - time.monotonic()
+                if remaining > 0:
+                    self.sock.settimeout(remaining)     # 寫出已暫停，逾時只影響讀取
+                    continue
+            if self._resume is None or not self.running:
+                break
+            f = self._reconnect()
+            if f is None:
                 break
+        self._on_disconnected()
+
+    def _process_line(self, raw: bytes) -> None:
+        self._last_recv = time.monotonic()
+        self._record_line(raw)
+        try:
+            msg = json.loads(raw)
+        except (json.JSONDecodeError, UnicodeDecodeError):
+            return
+        if isinstance(msg, dict):
+            self._handle_msg(msg)
+
+    async def _recv_loop_async(self, reader: asyncio.StreamReader) -> None:
+        import asyncio
+        while self.running:
+            remaining = None if self._resume is None else self._resume[1] - time.monotonic()
             try:
-                msg = json.loads(line)
-            except json.JSONDecodeError:
+                if remaining is None:
+                    line = await reader.readline()
+                elif remaining > 0:
+                    line = await asyncio.wait_for(reader.readline(), remaining)
+                else:
+                    line = b""
+            except ValueError:
+                continue        # 超過 limit 的單行，丟棄
+            except (OSError, ssl.SSLError, asyncio.TimeoutError):
+                line = b""
+            if line:
+                self._process_line(line)
+                if self._resume is not None:
+                    await self._pause_sending_async()
                 continue
-            self._handle_msg(msg)
-        self._append_system("Disconnected from server.")
+            if self._resume is None or not self.running:
+                break
+            reader = await self._reconnect_async()
+            if reader is None:
+                break
+        self._on_disconnected()
+
+    def _join_msg(self) -> dict:
+        msg = {"type": "join", "name": self.name}
+        if self._resume is not None and self._resume[0]:
+            msg["resume"] = self._resume[0]     # 新程序據此保留名稱、不重複廣播加入訊息
+        return msg
+
+    # 交接時新程序可能還在啟動：重新連線的嘗試次數與間隔（秒，逐次加倍）
+    _RECONNECT_ATTEMPTS = 5
+    _RECONNECT_BACKOFF = 0.5
+
+    def _pause_sending(self) -> None:
+        with self._outbox_cond:
+            self._paused = True
+            while self._inflight and not self._send_failed:
+                self._outbox_cond.wait(1.0)
+
+    async def _pause_sending_async(self) -> None:
+        import asyncio
+        with self._outbox_cond:
+            self._paused = True
+        while self._inflight and not self._send_failed:
+            await asyncio.sleep(0.01)
+
+    def _resume_sending(self) -> None:
+        with self._outbox_cond:
+            self._paused = False
+            self._outbox_cond.notify_all()
+        if self._wakeup is not None:
+            self._call_in_loop(self._wakeup.set)
 
-        # 關閉應用（若還在）
-        if self.running:
-            self.running = False
+    @staticmethod
+    def _is_busy(first_line) -> bool:
+        try:
+            msg = json.loads(first_line)
+        except (ValueError, TypeError):
+            return False
+        return isinstance(msg, dict) and msg.get("type") == "busy"
+
+    def _on_reconnected(self, first) -> None:
+        self._resume = None
+        with self._outbox_cond:
+            # 已寫到舊連線的訊息不會再收到 ack；暫停期間排隊的訊息改由新程序確認
+            for msg_id in [i for i in self._unacked if i <= self._written_id]:
+                del self._unacked[msg_id]
+        self._abort_transfers("伺服器已更新，請重新傳送")
+        self._resume_sending()
+        self._append_system(f"已重新連線到 {self.addr[0]}:{self.addr[1]}")
+        self._process_line(first if isinstance(first, bytes) else first.encode(ENC))
+
+    def _reconnect(self):
+        """關閉舊連線並帶 resume token 連到接手的程序；成功回傳新的 rfile，失敗回傳 None。"""
+        try:
+            self.sock.close()
+        except Exception:
+            pass
+        for attempt in range(self._RECONNECT_ATTEMPTS):
+            self.sock = self._new_socket()
+            try:
+                self.sock.connect(self.addr)
+                self.sock.sendall(self._encode(self._join_msg()))
+                self.sock.settimeout(self._JOIN_TIMEOUT)
+                rfile = self.sock.makefile("r", encoding=ENC, newline="\n")
+                first = rfile.readline()
+                self.sock.settimeout(None)
+            except Exception as err:
+                first = ""
+                self._append_system(f"重新連線失敗: {err}")
+            if first and not self._is_busy(first):
+                self._on_reconnected(first)
+                return rfile
             try:
-                get_app().exit()
+                self.sock.close()
             except Exception:
                 pass
+            time.sleep(self._RECONNECT_BACKOFF * (2 ** attempt))
+        return None
+
+    async def _reconnect_async(self):
+        import asyncio
+        try:
+            self._writer.close()
+        except Exception:
+            pass
+        for attempt in range(self._RECONNECT_ATTEMPTS):
+            writer = None
+            try:
+                reader, writer = await asyncio.open_connection(
+                    self.addr[0],
+                    self.addr[1],
+                    ssl=self.ssl_ctx,
+                    server_hostname=self.server_name,
+                    limit=1 << 20,
+                )
+                writer.write(self._encode(self._join_msg()))
+                await writer.drain()
+                first = await asyncio.wait_for(reader.readline(), self._JOIN_TIMEOUT)
+            except Exception as err:
+                first = b""
+                self._append_system(f"重新連線失敗: {err}")
+            if first and not self._is_busy(first):
+                raw_sock = writer.get_extra_info("socket")
+                if raw_sock is not None:
+                    self._tune_keepalive(raw_sock)
+                self._writer = writer
+                self._on_reconnected(first)
+                return reader
+            if writer is not None:
+                writer.close()
+            await asyncio.sleep(self._RECONNECT_BACKOFF * (2 ** attempt))
+        return None
+
+    def _record_line(self, raw: bytes) -> None:
+        if self._record is None:
+            return
+        if not raw.endswith(b"\n"):
+            raw += b"\n"
+        try:
+            self._record.write(b"%.6f\t" % (time.monotonic() - self._record_t0) + raw)
+        except (OSError, ValueError):
+            self._record = None
+
+    def _close_record(self) -> None:
+        if self._record is not None:
+            try:
+                self._record.close()
+            except OSError:
+                pass
+            self._record = None
+
+    def _on_disconnected(self) -> None:
+        self._append_system("Disconnected from server.")
+
+        # 關閉應用（若還在）；接收執行緒需交回 UI 的事件迴圈執行
+        if self.running:
+            self.running = False
+            self._call_in_loop(self._exit_app)
+
+    def _exit_app(self) -> None:
+        try:
+            if self.app.is_running:
+                self.app.exit()
+        except Exception:
+            pass
+
+    def _call_in_loop(self, callback: Callable[[], None]) -> None:
+        loop = self._loop or getattr(self.app, "loop", None)
+        if loop is None:
+            return
+        try:
+            loop.call_soon_threadsafe(callback)
+        except RuntimeError:
+            pass    # 迴圈已關閉
 
     def _handle_msg(self, msg: dict):
         mtype = msg.get("type")
@@ -791,12 +1882,61 @@ class ChatClientTUI:
         elif mtype == "system":
             text = msg.get("text", "")
             self._append_system_with_ts(text, ts)
+        elif mtype == "dm":
+            sender = msg.get("from", "?")
+            text = msg.get("text", "")
+            self._append_entry(ChatEntry(user=f"{sender} → {self.name}", text=text, ts=ts))
+            self._maybe_flash_for_new_entry()
+        elif mtype == "rename":
+            new_name = str(msg.get("name") or self.name)
+            if new_name != self.name:
+                self._append_system_with_ts(f"名稱 {self.name} 已被使用，改為 {new_name}", ts)
+                self.name = new_name
+        elif mtype == "reconnect":
+            try:
+                after = max(0.0, float(msg.get("retry_after", 0)))
+            except (TypeError, ValueError):
+                after = 0.0
+            token = msg.get("token")
+            self._resume = (str(token) if token else None, time.monotonic() + after)
+            self._append_system_with_ts(f"伺服器更新中，{after:.1f} 秒後自動重新連線（期間的訊息會在連上後送出）", ts)
+        elif mtype == "ping":
+            self._send_json({"type": "pong"})
+        elif mtype == "ack":
+            with self._outbox_cond:
+                acked = self._unacked.pop(msg.get("id"), None)
+            if acked is not None:
+                self._invalidate()
         elif mtype == "roster":
             users = msg.get("users")
             if not isinstance(users, list):
                 users = []
             roster_text = self._format_roster_line(users)
             self._append_system_with_ts(roster_text, ts)
+        elif mtype == "file":
+            size = msg.get("size") if isinstance(msg.get("size"), int) else 0
+            text = f"分享檔案 {msg.get('name', '?')}（{format_size(size)}），輸入 /get {msg.get('id', '')} 下載"
+            self._append_entry(ChatEntry(user=str(msg.get("from", "?")), text=text, ts=ts))
+            self._maybe_flash_for_new_entry()
+        elif mtype == "file_accept":
+            with self._outbox_cond:
+                if msg.get("xfer") in self._uploads:
+                    self._sending.append(msg.get("xfer"))
+                    self._outbox_cond.notify()
+            if self._wakeup is not None:
+                self._call_in_loop(self._wakeup.set)
+        elif mtype == "file_reject":
+            with self._outbox_cond:
+                t = self._uploads.pop(msg.get("xfer"), None)
+                if msg.get("xfer") in self._sending:
+                    self._sending.remove(msg.get("xfer"))
+            if t is not None:
+                self._close_quietly(t.f)
+            name = t.name if t is not None else f"#{msg.get('xfer')}"
+            self._append_system_with_ts(f"檔案 {name} 傳送失敗: {msg.get('reason', '')}", ts)
+        elif mtype in ("file_start", "file_data", "file_done", "file_error"):
+            if not self.headless:   # 重播錄製檔時不寫檔
+                self._on_download(mtype, msg, ts)
 
     def _append_entry(self, entry: ChatEntry):
         try:
@@ -847,8 +1987,74 @@ class ChatClientTUI:
         position = f"{view_end}/{total}" if total else "0/0"
         state = "最新" if snap.get("follow_bottom", True) else "已回捲"
         tips_scroll = "滑鼠滾輪 或 PgUp/PgDn 捲動，Ctrl+Home 至頂，Ctrl+End 至底"
-        tips_cmd = "/list 顯示名單 /clear 清空畫面 /exit 離開"
-        return f"{tips_scroll} | {tips_cmd} | {position} {state}"
+        tips_cmd = "/list 顯示名單 /msg 私訊 /send 傳檔 /find 搜尋 /clear 清空畫面 /exit 離開"
+        status = f"{tips_scroll} | {tips_cmd} | {position} {state}"
+        with self._outbox_cond:
+            pending = len(self._outbox) + self._inflight
+            transfers = [f"上傳 {self._uploads[x].name} {self._percent(self._uploads[x])}"
+                         for x in self._sending if x in self._uploads]
+            self._expire_unacked_locked(time.monotonic() - self._ACK_TIMEOUT)
+            unacked = len(self._unacked)
+            expired = self._ack_expired
+        transfers += [f"下載 {t.name} {self._percent(t)}" for t in list(self._downloads.values())]
+        if self._send_failed:
+            status += " | 送出失敗"
+        elif pending or unacked:
+            status += f" | 待送 {pending} 未確認 {unacked}"
+        if expired:
+            status += f" | 逾時未確認 {expired}"
+        if transfers:
+            status += " | " + " ".join(transfers)
+        if self._search_term:
+            hits = self.history.search_hits
+            if self._searching:
+                found = "搜尋中"
+            elif hits:
+                found = f"{self._search_pos + 1}/{len(hits)}"
+            else:
+                found = "無結果"
+            status += f" | 搜尋「{self._search_term}」{found} F3 上一筆 F4 下一筆"
+        return status
+
+    @staticmethod
+    def _percent(t: FileTransfer) -> str:
+        return f"{100 * t.done // t.size}%" if t.size else "0%"
+
+    def _set_search(self, term: str) -> None:
+        # 磁碟上的歷史可能很長：在背景執行緒搜尋，結果回到 UI 迴圈再跳轉
+        self._search_term = term
+        self._search_gen += 1
+        self._search_pos = -1
+        self._searching = bool(term)
+        if term:
+            threading.Thread(target=self._run_search, args=(term, self._search_gen), name="search", daemon=True).start()
+        else:
+            self.history.search("")
+            self.history.jump_to(None)
+        self._invalidate()
+
+    def _run_search(self, term: str, gen: int) -> None:
+        hits = self.history.search(term)
+        self._call_in_loop(lambda: self._show_search(gen, hits))
+
+    def _show_search(self, gen: int, hits: List[int]) -> None:
+        if gen != self._search_gen:
+            return
+        self._searching = False
+        # 從最新的命中開始，F3 往舊、F4 往新
+        self._search_pos = len(hits) - 1
+        if hits:
+            self.history.jump_to(hits[self._search_pos])
+        else:
+            self.history.jump_to(None)
+            self._invalidate()
+
+    def _step_search(self, direction: int) -> None:
+        hits = self.history.search_hits
+        if self._searching or not hits:
+            return
+        self._search_pos = max(0, min(len(hits) - 1, self._search_pos + direction))
+        self.history.jump_to(hits[self._search_pos])
 
 
     def _append_system(self, text: str):
@@ -871,18 +2077,366 @@ class ChatClientTUI:
             return "Online: (none)"
         return "Online: " + ", ".join(formatted)
 
-    def _send_json(self, obj: dict):
+    def _send_file(self, path: str) -> None:
         try:
-            data = (json.dumps(obj) + "\n").encode(ENC)
-            self.sock.sendall(data)
-        except Exception:
+            size = os.path.getsize(path)
+            f = open(path, "rb")
+        except OSError as err:
+            self._append_system(f"無法讀取 {path}: {err}")
+            return
+        self._next_xfer += 1
+        name = os.path.basename(path)
+        self._uploads[self._next_xfer] = FileTransfer(name=name, path=path, size=size, f=f)
+        self._send_json({"type": "file_offer", "xfer": self._next_xfer, "name": name, "size": size})
+        self._append_system(f"準備傳送 {name}（{format_size(size)}）")
+
+    def _next_chunk(self, xfer: int) -> bytes:
+        """讀出上傳的下一個分塊；讀完時附上 file_end，由伺服器比對大小與 SHA-256。"""
+        t = self._uploads.get(xfer)
+        if t is None:
+            return b""
+        try:
+            data = t.f.read(min(FILE_CHUNK, t.size - t.done))
+        except (OSError, ValueError):
+            data = b""      # 已被拒絕而關閉，或讀取失敗；送出 file_end 讓伺服器判定不符
+        out = b""
+        if data:
+            t.sha.update(data)
+            t.done += len(data)
+            out = self._encode({
+                "type": "file_chunk",
+                "xfer": xfer,
+                "seq": t.seq,
+                "data": base64.b64encode(data).decode("ascii"),
+            })
+            t.seq += 1
+            if t.done < t.size:
+                return out
+        with self._outbox_cond:
+            if xfer in self._sending:
+                self._sending.remove(xfer)
+            self._uploads.pop(xfer, None)
+        self._close_quietly(t.f)
+        return out + self._encode({"type": "file_end", "xfer": xfer, "sha256": t.sha.hexdigest()})
+
+    def _on_download(self, mtype: str, msg: dict, ts: str) -> None:
+        file_id = str(msg.get("id", ""))
+        if mtype == "file_start":
+            name = os.path.basename(str(msg.get("name") or "").replace("\\", "/")) or file_id
+            path = self._download_path(name)
+            try:
+                f = open(path + ".part", "wb")
+            except OSError as err:
+                self._append_system_with_ts(f"無法建立下載檔 {path}: {err}", ts)
+                return
+            size = msg.get("size") if isinstance(msg.get("size"), int) else 0
+            self._downloads[file_id] = FileTransfer(name=name, path=path, size=size, f=f)
+            self._append_system_with_ts(f"開始下載 {name}（{format_size(size)}）→ {path}", ts)
+            return
+        t = self._downloads.get(file_id)
+        if t is None:
+            return
+        if mtype == "file_data":
+            try:
+                if msg.get("seq") != t.seq:
+                    raise ValueError("分塊順序不符")
+                data = base64.b64decode(str(msg.get("data", "")), validate=True)
+                t.f.write(data)
+            except (ValueError, OSError) as err:
+                self._abort_download(file_id, f"{err}", ts)
+                return
+            t.sha.update(data)
+            t.done += len(data)
+            t.seq += 1
+            self._invalidate()
+        elif mtype == "file_done":
+            if t.done != msg.get("size") or t.sha.hexdigest() != msg.get("sha256"):
+                self._abort_download(file_id, "大小或 SHA-256 不符", ts)
+                return
+            del self._downloads[file_id]
+            try:
+                t.f.close()
+                os.replace(t.path + ".part", t.path)
+            except OSError as err:
+                self._append_system_with_ts(f"儲存 {t.name} 失敗: {err}", ts)
+                return
+            self._append_system_with_ts(f"已下載 {t.name}（{format_size(t.done)}）→ {t.path}", ts)
+        else:
+            self._abort_download(file_id, str(msg.get("reason", "")), ts)
+
+    def _download_path(self, name: str) -> str:
+        """下載目錄中不與既有檔案或進行中下載衝突的路徑：name、name (1)、name (2)…"""
+        os.makedirs(self.download_dir, exist_ok=True)
+        stem, ext = os.path.splitext(name)
+        taken = {t.path for t in self._downloads.values()}
+        path = os.path.join(self.download_dir, name)
+        n = 1
+        while path in taken or os.path.exists(path) or os.path.exists(path + ".part"):
+            path = os.path.join(self.download_dir, f"{stem} ({n}){ext}")
+            n += 1
+        return path
+
+    def _abort_download(self, file_id: str, reason: Optional[str] = None, ts: Optional[str] = None) -> None:
+        t = self._downloads.pop(file_id, None)
+        if t is None:
+            return
+        self._close_quietly(t.f)
+        try:
+            os.unlink(t.path + ".part")
+        except OSError:
             pass
+        if reason is not None:
+            self._append_system_with_ts(f"下載 {t.name} 失敗: {reason}", ts or datetime.datetime.now().strftime("%m.%d %H:%M"))
+
+    def _abort_transfers(self, reason: str) -> None:
+        with self._outbox_cond:
+            uploads = list(self._uploads.values())
+            self._uploads.clear()
+            self._sending.clear()
+        for t in uploads:
+            self._close_quietly(t.f)
+            self._append_system(f"檔案 {t.name} 傳送中斷: {reason}")
+        for file_id in list(self._downloads):
+            self._abort_download(file_id, reason)
+
+    @staticmethod
+    def _close_quietly(f: Optional[BinaryIO]) -> None:
+        if f is not None:
+            try:
+                f.close()
+            except OSError:
+                pass
+
+    def _send_chat(self, text: str) -> None:
+        self._send_json({"type": "chat", "text": text}, track_ack=True)
+
+    def _send_dm(self, to: str, text: str) -> None:
+        self._send_json({"type": "dm", "to": to, "text": text}, track_ack=True)
+        # 伺服器只把私訊送給對方，自己這邊直接顯示
+        ts = datetime.datetime.now().strftime("%m.%d %H:%M")
+        self._append_entry(ChatEntry(user=f"{self.name} → {to}", text=text, ts=ts))
+
+    # 送出後等待伺服器 ack 的上限（秒）；逾時的訊息不再計入「未確認」
+    _ACK_TIMEOUT = 30.0
+
+    def _expire_unacked_locked(self, cutoff: float) -> None:
+        # id 與送出時間同樣遞增，逾時的一定在最前面
+        while self._unacked:
+            msg_id, sent = next(iter(self._unacked.items()))
+            if sent >= cutoff:
+                break
+            del self._unacked[msg_id]
+            self._ack_expired += 1
+
+    @staticmethod
+    def _encode(obj: dict) -> bytes:
+        return (json.dumps(obj) + "\n").encode(ENC)
+
+    def _send_json(self, obj: dict, track_ack: bool = False) -> bool:
+        """排入送出佇列；track_ack 時附上訊息 id 並等候 ack。連線已失敗時不排入，回傳 False。"""
+        if self.headless:
+            return False
+        with self._outbox_cond:
+            if self._send_failed:
+                return False
+            if track_ack:
+                self._next_msg_id += 1
+                obj["id"] = self._next_msg_id
+                self._unacked[self._next_msg_id] = time.monotonic()
+            self._outbox.append(self._encode(obj))
+            self._outbox_cond.notify()
+        if self._wakeup is not None:
+            self._call_in_loop(self._wakeup.set)
+        self._invalidate()
+        return True
+
+    def _take_batch_locked(self) -> Tuple[List[bytes], Optional[int]]:
+        """取出期間累積的訊息，並輪到下一個上傳送一個分塊；呼叫端須持有 _outbox_cond。"""
+        batch, self._outbox = self._outbox, []
+        self._written_id = self._next_msg_id    # id 在同一把鎖下配發，佇列中的訊息都在這一批
+        xfer = None
+        if self._sending:
+            xfer = self._sending[0]
+            self._sending.rotate(-1)
+        self._inflight = len(batch) + (xfer is not None)
+        return batch, xfer
+
+    def _send_loop(self) -> None:
+        while True:
+            with self._outbox_cond:
+                while self.running and (self._paused or (not self._outbox and not self._sending)):
+                    self._outbox_cond.wait()
+                if not self.running and not self._outbox:
+                    return
+                # 期間累積的訊息合併成一次 TLS 寫入
+                batch, xfer = self._take_batch_locked()
+            if xfer is not None:
+                batch.append(self._next_chunk(xfer))
+            try:
+                self.sock.sendall(b"".join(batch))
+            except Exception as err:
+                with self._outbox_cond:
+                    self._inflight = 0
+                    self._send_failed = True
+                    self._outbox.clear()
+                    self._sending.clear()
+                    self._unacked.clear()   # 連線已斷，不會再有 ack
+                    self._outbox_cond.notify_all()
+                if self.running:
+                    self._append_system(f"送出失敗: {err}")
+                return
+            with self._outbox_cond:
+                self._inflight = 0
+                self._outbox_cond.notify_all()
+            self._invalidate()
+
+    async def _send_loop_async(self) -> None:
+        import asyncio
+        while True:
+            with self._outbox_cond:
+                idle = self._paused or (not self._outbox and not self._sending)
+            if idle and self.running:
+                await self._wakeup.wait()
+                self._wakeup.clear()
+            with self._outbox_cond:
+                if not self.running and not self._outbox:
+                    return
+                if self._paused or (not self._outbox and not self._sending):
+                    continue
+                batch, xfer = self._take_batch_locked()
+            if xfer is not None:
+                batch.append(self._next_chunk(xfer))
+            writer = self._writer
+            try:
+                writer.write(b"".join(batch))
+                await writer.drain()
+                if xfer is not None:
+                    await asyncio.sleep(0)  # 傳檔期間 drain 可能不讓出，讓輸入與重繪有機會執行
+            except Exception as err:
+                with self._outbox_cond:
+                    self._inflight = 0
+                    self._send_failed = True
+                    self._outbox.clear()
+                    self._sending.clear()
+                    self._unacked.clear()   # 連線已斷，不會再有 ack
+                if self.running:
+                    self._append_system(f"送出失敗: {err}")
+                return
+            with self._outbox_cond:
+                self._inflight = 0
+            self._invalidate()
+
+    def _flush_outbox(self, timeout: float) -> None:
+        deadline = time.monotonic() + timeout
+        with self._outbox_cond:
+            while (self._outbox or self._inflight) and not self._send_failed:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._outbox_cond.wait(remaining)
+
+def _replay_pass(path: str, speed: float, width: int, height: int, trace_memory: bool) -> dict:
+    import tracemalloc
+    from chat_client_ui import ChatHistoryControl
+
+    client = ChatClientTUI("replay", 0, "replay", headless=True)
+    control = ChatHistoryControl(client.history)
+    appends = 0
+
+    def on_change() -> None:
+        nonlocal appends
+        appends += 1
+
+    client.history.set_on_change(on_change)
+    frame_interval = 1 / 60     # 依錄製時間把訊息分成 60fps 的畫格，每格重繪一次
+    frame_times: List[float] = []
+    messages = 0
+
+    def draw() -> None:
+        t0 = time.perf_counter()
+        content = control.create_content(width, height)
+        for i in range(content.line_count):
+            content.get_line(i)
+        frame_times.append(time.perf_counter() - t0)
+
+    if trace_memory:
+        tracemalloc.start()
+    started = time.perf_counter()
+    next_frame = frame_interval
+    dirty = False
+    try:
+        with open(path, "rb") as f:
+            for raw in f:
+                stamp, sep, line = raw.partition(b"\t")
+                if not sep:
+                    continue
+                at = float(stamp)
+                while at >= next_frame:
+                    if dirty:
+                        draw()
+                        dirty = False
+                    next_frame += frame_interval
+                if speed > 0:
+                    delay = at / speed - (time.perf_counter() - started)
+                    if delay > 0:
+                        time.sleep(delay)
+                try:
+                    msg = json.loads(line)
+                except (json.JSONDecodeError, UnicodeDecodeError):
+                    continue
+                client._handle_msg(msg)
+                messages += 1
+                dirty = True
+        if dirty:
+            draw()
+        elapsed = time.perf_counter() - started
+        peak = tracemalloc.get_traced_memory()[1] if trace_memory else 0
+    finally:
+        if trace_memory:
+            tracemalloc.stop()
+        client._close_local_files()
+    return {
+        "messages": messages,
+        "appends": appends,
+        "elapsed": elapsed,
+        "frame_times": frame_times,
+        "peak_bytes": peak,
+    }
+
+
+def run_replay(path: str, speed: float, width: int, height: int) -> dict:
+    """無終端重播錄製檔：_handle_msg -> ChatHistory -> create_content，回傳效能統計。"""
+    timing = _replay_pass(path, speed, width, height, trace_memory=False)
+    # tracemalloc 會拖慢執行，記憶體峰值另跑一次全速重播量測
+    memory = _replay_pass(path, 0, width, height, trace_memory=True)
+    frames = sorted(timing["frame_times"])
+
+    def pct(p: float) -> float:
+        if not frames:
+            return 0.0
+        return frames[min(len(frames) - 1, int(p * len(frames)))] * 1000
+
+    elapsed = timing["elapsed"]
+    return {
+        "messages": timing["messages"],
+        "appends": timing["appends"],
+        "elapsed_s": elapsed,
+        "appends_per_s": timing["appends"] / elapsed if elapsed > 0 else 0.0,
+        "frames": len(frames),
+        "frame_p50_ms": pct(0.50),
+        "frame_p95_ms": pct(0.95),
+        "frame_p99_ms": pct(0.99),
+        "frame_max_ms": frames[-1] * 1000 if frames else 0.0,
+        "peak_mem_mib": memory["peak_bytes"] / (1024 * 1024),
+    }
+
 
 def main():
+    entered = time.perf_counter()
     ap = argparse.ArgumentParser()
-    ap.add_argument("--host", required=True, help="server host/IP")
+    ap.add_argument("--host", help="server host/IP")
     ap.add_argument("--port", type=int, default=5050, help="server port (default: 5050)")
-    ap.add_argument("--name", required=True, help="your user name")
+    ap.add_argument("--name", help="your user name")
     ap.add_argument(
         "--flash-debug",
         action="store_true",
@@ -901,20 +2455,126 @@ def main():
         action="store_true",
         help="disable TLS certificate verification",
     )
+    ap.add_argument(
+        "--scrollback-file",
+        help="keep history evicted from memory in this new or empty file (default: anonymous temp file)",
+    )
+    ap.add_argument(
+        "--asyncio",
+        action="store_true",
+        help="run the connection on prompt_toolkit's asyncio loop instead of helper threads",
+    )
+    ap.add_argument(
+        "--record",
+        help="record the raw inbound NDJSON stream with arrival times to this file",
+    )
+    ap.add_argument(
+        "--replay",
+        help="replay a --record file headlessly and print render statistics",
+    )
+    ap.add_argument(
+        "--replay-speed",
+        type=float,
+        default=0.0,
+        help="replay speed multiplier; 0 replays as fast as possible (default: 0)",
+    )
+    ap.add_argument(
+        "--replay-size",
+        default="120x40",
+        help="virtual terminal size COLSxROWS for --replay (default: 120x40)",
+    )
+    ap.add_argument(
+        "--replay-max-p95-ms",
+        type=float,
+        help="exit with status 1 if the replay p95 frame time exceeds this",
+    )
+    ap.add_argument(
+        "--busy-retries",
+        type=int,
+        default=3,
+        help="how many times to retry when the server replies busy (default: 3)",
+    )
+    ap.add_argument(
+        "--ping-interval",
+        type=float,
+        default=20.0,
+        help="ping the server after N idle seconds, 0 = disable heartbeats (default: 20)",
+    )
+    ap.add_argument(
+        "--ping-timeout",
+        type=float,
+        default=60.0,
+        help="treat the connection as dead after N silent seconds, 0 = never (default: 60)",
+    )
+    ap.add_argument(
+        "--diag-dir",
+        default=".",
+        help="directory for /profile and /memsnap reports (default: .)",
+    )
+    ap.add_argument(
+        "--download-dir",
+        default=".",
+        help="directory where /get saves files (default: .)",
+    )
+    ap.add_argument(
+        "--startup-profile",
+        action="store_true",
+        help="print a timeline of startup phases (imports, connect, join, first render) on exit",
+    )
     args = ap.parse_args()
+    startup = StartupProfile(args.startup_profile)
+    startup.mark("imports", entered)
+    startup.mark("args parsed")
+    if args.replay:
+        try:
+            cols, rows = (int(v) for v in args.replay_size.lower().split("x"))
+        except ValueError:
+            ap.error("--replay-size 格式應為 COLSxROWS，例如 120x40")
+        report = run_replay(args.replay, args.replay_speed, cols, rows)
+        print(f"[REPLAY] {args.replay}")
+        print(f"  messages={report['messages']} appends={report['appends']} elapsed={report['elapsed_s']:.3f}s")
+        print(f"  appends/s={report['appends_per_s']:.0f}")
+        print(
+            f"  frames={report['frames']} p50={report['frame_p50_ms']:.3f}ms "
+            f"p95={report['frame_p95_ms']:.3f}ms p99={report['frame_p99_ms']:.3f}ms "
+            f"max={report['frame_max_ms']:.3f}ms"
+        )
+        print(f"  peak_mem={report['peak_mem_mib']:.2f}MiB (tracemalloc)")
+        if args.replay_max_p95_ms is not None and report["frame_p95_ms"] > args.replay_max_p95_ms:
+            print(f"[REPLAY] p95 {report['frame_p95_ms']:.3f}ms 超過門檻 {args.replay_max_p95_ms}ms")
+            raise SystemExit(1)
+        return
+
+    if not args.host or not args.name:
+        ap.error("連線時必須指定 --host 與 --name")
     if args.ca and args.insecure:
         ap.error("--ca 與 --insecure 不可同時使用")
 
     ca_path = os.path.expanduser(args.ca) if args.ca else None
-    ChatClientTUI(
-        args.host,
-        args.port,
-        args.name,
-        flash_debug=args.flash_debug,
-        ca_path=ca_path,
-        server_name=args.server_name,
-        insecure=args.insecure,
-    ).start()
+    try:
+        client = ChatClientTUI(
+            args.host,
+            args.port,
+            args.name,
+            flash_debug=args.flash_debug,
+            ca_path=ca_path,
+            server_name=args.server_name,
+            insecure=args.insecure,
+            scrollback_path=os.path.expanduser(args.scrollback_file) if args.scrollback_file else None,
+            use_asyncio=args.asyncio,
+            record_path=args.record,
+            busy_retries=args.busy_retries,
+            ping_interval=args.ping_interval,
+            ping_timeout=args.ping_timeout,
+            diag_dir=args.diag_dir,
+            download_dir=os.path.expanduser(args.download_dir),
+            startup=startup,
+        )
+    except FileExistsError as err:
+        ap.error(str(err))
+    client.start()
+    if args.startup_profile:
+        print(startup.report())
 
 if __name__ == "__main__":
     main()
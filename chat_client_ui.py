@@ -0,0 +1,49 @@
+# chat_client_ui.py
+# chat_client_tui 的 prompt_toolkit 元件；匯入 prompt_toolkit 是客戶端啟動最大的成本，
+# 因此這個模組只在建構 UI（與連線並行）或重播時才載入
+from typing import TYPE_CHECKING, Optional
+
+from prompt_toolkit.layout.controls import UIControl, UIContent
+from prompt_toolkit.mouse_events import MouseEventType
+
+if TYPE_CHECKING:
+    from chat_client_tui import ChatHistory
+
+
+class ChatHistoryControl(UIControl):
+    def __init__(self, history: "ChatHistory"):
+        self.history = history
+        self._last_height = 1
+
+    def is_focusable(self) -> bool:
+        return False
+
+    def create_content(self, width: int, height: Optional[int]) -> UIContent:
+        real_height = height if height and height > 0 else self._last_height
+        real_height = max(1, real_height)
+        self._last_height = real_height
+        lines = self.history.render(width, real_height)
+        highlight_row = self.history.snapshot().get("highlight_row")
+
+        if not lines:
+            lines = [""]
+
+        def get_line(i: int):
+            if i == highlight_row:
+                return [("class:search-match", lines[i])]
+            return [("", lines[i])]
+
+        return UIContent(
+            get_line=get_line,
+            line_count=len(lines),
+            show_cursor=False,
+        )
+
+    def mouse_handler(self, mouse_event) -> object:
+        if mouse_event.event_type == MouseEventType.SCROLL_UP:
+            self.history.scroll_up(3)
+            return None
+        if mouse_event.event_type == MouseEventType.SCROLL_DOWN:
+            self.history.scroll_down(3)
+            return None
+        return NotImplemented
@@ -0,0 +1,158 @@
+# chat_diag.py
+# 線上診斷：不重啟程序即可開關 CPU 取樣與擷取 tracemalloc 快照（伺服器與客戶端共用）
+import os
+import signal
+import sys
+import threading
+import time
+import datetime
+from collections import Counter
+from typing import TYPE_CHECKING, Callable, Optional
+
+if TYPE_CHECKING:
+    import tracemalloc
+
+
+class Diagnostics:
+    """取樣式 CPU profiler（涵蓋所有執行緒）與 tracemalloc 快照，結果寫入帶時間戳的檔案。"""
+
+    SAMPLE_INTERVAL = 0.005
+    TRACE_FRAMES = 10
+
+    def __init__(self, prefix: str, out_dir: str = ".", top_n: int = 25,
+                 log: Optional[Callable[[str], None]] = None) -> None:
+        self.prefix = prefix
+        self.out_dir = out_dir
+        self.top_n = top_n
+        self.log = log or print
+        self._lock = threading.Lock()
+        self._sampler: Optional[threading.Thread] = None
+        self._sampling = False
+        self._started_at = 0.0
+        self._samples = 0
+        self._self_counts: Counter = Counter()
+        self._cum_counts: Counter = Counter()
+        self._thread_counts: Counter = Counter()
+        self._mem_lock = threading.Lock()   # 訊號與 admin 指令可能同時觸發快照
+        self._last_snapshot: Optional["tracemalloc.Snapshot"] = None     # 非 None 表示正在量測
+        self._owns_tracing = False      # tracemalloc 是本物件啟動的，量測結束時要關掉
+
+    def install_signal_handlers(self) -> bool:
+        """SIGUSR1 切換 CPU 取樣、SIGUSR2 擷取記憶體快照；平台不支援（Windows）時回傳 False。"""
+        if not hasattr(signal, "SIGUSR1") or threading.current_thread() is not threading.main_thread():
+            return False
+        # 訊號處理器只負責轉交，實際工作在背景執行緒做，避免在處理器內寫檔
+        signal.signal(signal.SIGUSR1, lambda *_: self._in_background(self.toggle_profile))
+        signal.signal(signal.SIGUSR2, lambda *_: self._in_background(self.snapshot_memory))
+        return True
+
+    def toggle_profile(self) -> str:
+        with self._lock:
+            if not self._sampling:
+                self._self_counts.clear()
+                self._cum_counts.clear()
+                self._thread_counts.clear()
+                self._samples = 0
+                self._sampling = True
+                self._started_at = time.monotonic()
+                self._sampler = threading.Thread(target=self._sample_loop, name="diag-sampler", daemon=True)
+                self._sampler.start()
+                return self._report("CPU 取樣已開始，再次觸發即停止並輸出報告")
+            self._sampling = False
+            sampler = self._sampler
+        if sampler is not None:
+            sampler.join()
+        return self._report(f"CPU 取樣報告: {self._write_profile()}")
+
+    def snapshot_memory(self) -> str:
+        """第一次觸發啟動 tracemalloc 並記下基準；第二次擷取快照、與基準比較後停止追蹤。
+
+        追蹤會拖慢每一次配置，不讓它在一次診斷之後一直開著；原本就在追蹤（例如浸泡測試）時不關。
+        """
+        import tracemalloc
+        with self._mem_lock:
+            if self._last_snapshot is None or not tracemalloc.is_tracing():
+                self._owns_tracing = not tracemalloc.is_tracing()
+                if self._owns_tracing:
+                    tracemalloc.start(self.TRACE_FRAMES)
+                self._last_snapshot = tracemalloc.take_snapshot()
+                return self._report("tracemalloc 已啟動，再次觸發即擷取快照（與此刻比較）並停止追蹤")
+            snapshot = tracemalloc.take_snapshot().filter_traces((
+                tracemalloc.Filter(False, tracemalloc.__file__),
+                tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+            ))
+            current, peak = tracemalloc.get_traced_memory()
+            baseline, self._last_snapshot = self._last_snapshot, None
+            stopped = self._owns_tracing
+            if stopped:
+                tracemalloc.stop()
+                self._owns_tracing = False
+            path = self._path("tracemalloc")
+            with open(path, "w", encoding="utf-8") as f:
+                f.write(f"# {self.prefix} tracemalloc {datetime.datetime.now().isoformat(timespec='seconds')}\n")
+                f.write(f"# current={current / 1024:.1f} KiB peak={peak / 1024:.1f} KiB\n\n")
+                f.write(f"## top {self.top_n} allocation sites\n")
+                for stat in snapshot.statistics("lineno")[:self.top_n]:
+                    f.write(f"{stat.size / 1024:10.1f} KiB {stat.count:8d} blocks  {stat.traceback}\n")
+                f.write(f"\n## top {self.top_n} growth since tracing started\n")
+                for stat in snapshot.compare_to(baseline, "lineno")[:self.top_n]:
+                    f.write(f"{stat.size_diff / 1024:+10.1f} KiB {stat.count_diff:+8d} blocks  {stat.traceback}\n")
+        return self._report(f"記憶體快照: {path}" + ("，tracemalloc 已停止" if stopped else ""))
+
+    def _sample_loop(self) -> None:
+        me = threading.get_ident()
+        while self._sampling:
+            names = {t.ident: t.name for t in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                self._thread_counts[names.get(ident, str(ident))] += 1
+                leaf = True
+                seen = set()
+                while frame is not None:
+                    code = frame.f_code
+                    key = f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+                    if leaf:
+                        self._self_counts[key] += 1
+                        leaf = False
+                    if key not in seen:
+                        seen.add(key)
+                        self._cum_counts[key] += 1
+                    frame = frame.f_back
+            self._samples += 1
+            time.sleep(self.SAMPLE_INTERVAL)
+
+    def _write_profile(self) -> str:
+        path = self._path("profile")
+        elapsed = time.monotonic() - self._started_at
+        total = sum(self._self_counts.values()) or 1
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(f"# {self.prefix} CPU samples {datetime.datetime.now().isoformat(timespec='seconds')}\n")
+            f.write(f"# duration={elapsed:.1f}s sweeps={self._samples} interval={self.SAMPLE_INTERVAL * 1000:.0f}ms\n")
+            f.write("# 取樣涵蓋所有執行緒；阻塞在 I/O 的執行緒同樣會被計入\n\n")
+            f.write(f"## top {self.top_n} by self samples\n")
+            for key, n in self._self_counts.most_common(self.top_n):
+                f.write(f"{n:8d} {100 * n / total:6.2f}%  {key}\n")
+            f.write(f"\n## top {self.top_n} by cumulative samples\n")
+            for key, n in self._cum_counts.most_common(self.top_n):
+                f.write(f"{n:8d} {100 * n / total:6.2f}%  {key}\n")
+            f.write("\n## samples per thread\n")
+            for name, n in self._thread_counts.most_common():
+                f.write(f"{n:8d}  {name}\n")
+        return path
+
+    def _path(self, kind: str) -> str:
+        os.makedirs(self.out_dir, exist_ok=True)
+        stamp = datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
+        return os.path.join(self.out_dir, f"{self.prefix}-{kind}-{stamp}-{os.getpid()}.txt")
+
+    def _report(self, msg: str) -> str:
+        try:
+            self.log(msg)
+        except Exception:
+            pass
+        return msg
+
+    @staticmethod
+    def _in_background(fn: Callable[[], object]) -> None:
+        threading.Thread(target=fn, daemon=True).start()
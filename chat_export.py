@@ -0,0 +1,156 @@
+# chat_export.py
+# 以觀察者身分連上 chat_server，把廣播串流（每行帶 seq）附加寫入 NDJSON 檔；
+# 斷線後以最後寫入的 seq 重連接續，不出現在線上名單
+import argparse
+import json
+import os
+import socket
+import ssl
+import sys
+import time
+from typing import Optional, Tuple
+
+ENC = "utf-8"
+BUFSZ = 256 * 1024
+
+
+def log(msg: str) -> None:
+    sys.stderr.write(f"[EXPORT] {msg}\n")
+    sys.stderr.flush()
+
+
+def load_state(path: Optional[str]) -> Tuple[Optional[int], Optional[int]]:
+    """讀取上次的 (epoch, 下一則 seq)；沒有狀態檔時回傳 (None, None)。"""
+    if not path:
+        return None, None
+    try:
+        with open(path, encoding="utf-8") as f:
+            state = json.load(f)
+        return state["epoch"], state["next_seq"]
+    except (OSError, ValueError, KeyError):
+        return None, None
+
+
+def save_state(path: Optional[str], epoch: int, next_seq: int) -> None:
+    if not path:
+        return
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump({"epoch": epoch, "next_seq": next_seq}, f)
+    os.replace(tmp, path)   # 寫到一半當機也不會留下損毀的狀態檔
+
+
+class Exporter:
+    def __init__(self, args) -> None:
+        self.args = args
+        self.ctx = None
+        if not args.unix and not args.plain:
+            self.ctx = ssl.create_default_context(ssl.Purpose.SERVER_AUTH, cafile=args.ca)
+            if not args.ca:
+                self.ctx.check_hostname = False
+                self.ctx.verify_mode = ssl.CERT_NONE
+        self.epoch, self.next_seq = load_state(args.state)
+        if args.from_seq is not None:
+            self.next_seq = args.from_seq
+        self.out = open(args.out, "ab") if args.out else sys.stdout.buffer
+        self.written = 0
+
+    def connect(self) -> socket.socket:
+        args = self.args
+        if args.unix:
+            conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            conn.connect(args.unix)
+        else:
+            conn = socket.create_connection((args.host, args.port), timeout=10)
+            if self.ctx is not None:
+                conn = self.ctx.wrap_socket(conn, server_hostname=args.server_name or args.host)
+        hello = {"type": "observe", "token": args.token}
+        if self.next_seq is not None:
+            hello["from_seq"] = self.next_seq
+            if self.epoch is not None:
+                hello["epoch"] = self.epoch
+        conn.sendall((json.dumps(hello) + "\n").encode(ENC))
+        conn.settimeout(None)
+        return conn
+
+    def run_once(self) -> None:
+        conn = self.connect()
+        buf = b""
+        try:
+            while True:
+                chunk = conn.recv(BUFSZ)
+                if not chunk:
+                    raise ConnectionError("server closed the stream")
+                lines = (buf + chunk).split(b"\n")
+                buf = lines.pop()
+                self.handle(lines)
+        finally:
+            conn.close()
+
+    def handle(self, lines) -> None:
+        out = []
+        for line in lines:
+            if line.startswith(b'{"seq": '):
+                # 伺服器保證此前綴，不必逐行解析 JSON
+                self.next_seq = int(line[8:line.index(b",")]) + 1
+                out.append(line + b"\n")
+                continue
+            msg = json.loads(line)
+            mtype = msg.get("type")
+            if mtype == "observe_ok":
+                self.epoch = msg["epoch"]
+                self.next_seq = msg["next_seq"]
+                log(f"streaming from seq {msg['next_seq']} (server keeps {msg['oldest_seq']}..{msg['latest_seq']})")
+            elif mtype == "gap":
+                log(f"gap: wanted seq {msg['from_seq']}, server resumes at {msg['next_seq']}")
+                self.next_seq = msg["next_seq"]
+                if self.args.gap_marker:
+                    out.append(line + b"\n")
+            elif mtype == "reconnect":
+                raise ConnectionError("server asked to reconnect")
+        if out:
+            self.out.write(b"".join(out))
+            self.out.flush()
+            self.written += len(out)
+        if self.epoch is not None and self.next_seq is not None:
+            save_state(self.args.state, self.epoch, self.next_seq)
+
+    def run(self) -> int:
+        backoff = 0.5
+        while True:
+            try:
+                self.run_once()
+            except KeyboardInterrupt:
+                log(f"stopped after {self.written} messages, next seq {self.next_seq}")
+                return 0
+            except (OSError, ValueError, ConnectionError) as err:
+                log(f"disconnected: {err}")
+            if self.args.once:
+                return 1
+            try:
+                time.sleep(backoff)
+            except KeyboardInterrupt:
+                return 0
+            backoff = min(30.0, backoff * 2)
+
+
+def main():
+    ap = argparse.ArgumentParser(description="export the chat_server broadcast stream as NDJSON via an observer connection")
+    ap.add_argument("--host", default="127.0.0.1", help="server host (default: 127.0.0.1)")
+    ap.add_argument("--port", type=int, default=5050, help="server port (default: 5050)")
+    ap.add_argument("--token", required=True, help="the server's --observer-token")
+    ap.add_argument("--ca", help="CA certificate to verify the server (default: no verification)")
+    ap.add_argument("--server-name", help="host name expected in the server certificate (default: --host)")
+    ap.add_argument("--plain", action="store_true", help="connect to a plaintext listener (--plain-port) instead of TLS")
+    ap.add_argument("--unix", metavar="PATH", help="connect to the server's plaintext Unix socket")
+    ap.add_argument("--out", help="append messages to this file (default: stdout)")
+    ap.add_argument("--state", help="remember epoch and next seq here and resume from it on restart")
+    ap.add_argument("--from-seq", type=int, help="start from this seq instead of the live stream or --state")
+    ap.add_argument("--gap-marker", action="store_true", help="also write gap notices to the output")
+    ap.add_argument("--once", action="store_true", help="exit instead of reconnecting when the connection drops")
+    args = ap.parse_args()
+    sys.exit(Exporter(args).run())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,32 @@
+# chat_net.py
+# 伺服器與客戶端共用的 socket 設定
+import socket
+
+
+def tune_keepalive(sock: socket.socket, idle: int, interval: int, count: int) -> None:
+    """開啟 TCP keepalive 並縮短偵測時間；各平台支援的選項不同，不支援者略過。"""
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    except OSError:
+        return
+    opts = []
+    if hasattr(socket, "TCP_KEEPIDLE"):
+        opts.append((socket.TCP_KEEPIDLE, idle))
+    elif hasattr(socket, "TCP_KEEPALIVE"):          # macOS
+        opts.append((socket.TCP_KEEPALIVE, idle))
+    if hasattr(socket, "TCP_KEEPINTVL"):
+        opts.append((socket.TCP_KEEPINTVL, interval))
+    if hasattr(socket, "TCP_KEEPCNT"):
+        opts.append((socket.TCP_KEEPCNT, count))
+    if hasattr(socket, "TCP_USER_TIMEOUT"):          # Linux：未確認的送出資料也有上限
+        opts.append((socket.TCP_USER_TIMEOUT, (idle + interval * count) * 1000))
+    for opt, value in opts:
+        try:
+            sock.setsockopt(socket.IPPROTO_TCP, opt, value)
+        except OSError:
+            pass
+    if not hasattr(socket, "TCP_KEEPIDLE") and hasattr(socket, "SIO_KEEPALIVE_VALS"):
+        try:
+            sock.ioctl(socket.SIO_KEEPALIVE_VALS, (1, idle * 1000, interval * 1000))
+        except (OSError, AttributeError):
+            pass
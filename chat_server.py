@@ -5,129 +5,2269 @@ import threading
 import json
 import datetime
 import argparse
+import time
+import hmac
+import os
+import stat
+import sys
+import base64
+import hashlib
+import secrets
+import shutil
+import tempfile
+import select
+from collections import Counter, deque
+from itertools import islice
+from typing import Iterator, List, Optional, Set, Tuple
+
+from chat_diag import Diagnostics
+from chat_net import tune_keepalive
 
 ENC = "utf-8"
 BUFSZ = 4096
+MAX_LINE = 1 << 20      # 單行上限；超過視為協定錯誤並斷線
+FILE_CHUNK = 16 * 1024  # /get 串流的分塊大小；base64 後約 22 KiB 一行，與聊天訊息輪流取得鎖
+FILE_GET_QUEUE = 4      # 每條連線排隊中的 /get 上限；同時只串流一個檔案
+PROXY_V2_SIG = b"\r\n\r\n\x00\r\nQUIT\n"
+PROXY_V1_MAX = 107      # 規格上限，含結尾 \r\n
+
+# 寫出優先序：數字小者先送。未列在 LANE_OF_TYPE 的訊息，單送走 control、廣播走 presence
+LANE_CONTROL, LANE_PRESENCE, LANE_CHAT = 0, 1, 2
+LANE_NAMES = ("control", "presence", "chat")
+LANE_OF_TYPE = {t: LANE_CHAT for t in ("chat", "dm", "file_start", "file_data", "file_done", "file_error")}
+LANE_BATCH = 64 * 1024      # 寫出執行緒每次從同一優先序取出的上限，控制訊息最多等這麼一批
+LANE_SHARE = 2 * LANE_BATCH     # 節流判斷時每條連線最多計入的待送量，不讀的連線推不高平均
+LANE_LAT_SAMPLES = 10000    # 每個優先序保留最近幾筆排隊延遲，用來算百分位數
+OBSERVER_BATCH = 256 * 1024     # 觀察者每次寫出的上限
+OBSERVER_LINGER = 0.05          # 已追上即時串流時，每次寫出前等這麼久讓訊息累積成一批
+RELAY_QUEUE_BYTES = 8 << 20     # 新程序送回舊程序的待送上限；超過或卡住 RELAY_STALL_S 秒即放棄轉送
+RELAY_STALL_S = 5.0
+FED_WINDOW = 1024               # 每個來源記住最近幾個 seq 是否收過；更舊的一律視為重複
+FED_WINDOW_FULL = (1 << FED_WINDOW) - 1
+FED_ROSTER_GRACE = 3.0          # 名單的連結全斷後，等其他連結回覆名單的秒數，逾時才從 /list 移除
+
+
+def current_rss() -> Optional[int]:
+    """目前程序的常駐記憶體（bytes）；優先讀 /proc，其次 psutil，皆不可用時回傳 None。"""
+    try:
+        with open("/proc/self/status", encoding="ascii") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    try:
+        import psutil
+    except ImportError:
+        return None
+    return psutil.Process().memory_info().rss
+
+
+def _recv_some(conn: socket.socket) -> bytes:
+    chunk = conn.recv(BUFSZ)
+    if not chunk:
+        raise ValueError("connection closed inside PROXY header")
+    return chunk
+
+
+def _parse_proxy_v1(line: bytes) -> Optional[Tuple[str, int]]:
+    parts = line.decode("ascii", "replace").split(" ")
+    if len(parts) >= 2 and parts[1] == "UNKNOWN":
+        return None
+    if len(parts) != 6 or parts[1] not in ("TCP4", "TCP6"):
+        raise ValueError(f"bad PROXY v1 header {line[:PROXY_V1_MAX]!r}")
+    family = socket.AF_INET if parts[1] == "TCP4" else socket.AF_INET6
+    try:
+        socket.inet_pton(family, parts[2])
+        port = int(parts[4])
+    except (OSError, ValueError):
+        raise ValueError(f"bad PROXY v1 address {line[:PROXY_V1_MAX]!r}") from None
+    if not 0 <= port <= 65535:
+        raise ValueError(f"bad PROXY v1 port {port}")
+    return parts[2], port
+
+
+def _parse_proxy_v2(header: bytes) -> Optional[Tuple[str, int]]:
+    version, command = header[12] >> 4, header[12] & 0x0F
+    if version != 2 or command not in (0, 1):
+        raise ValueError(f"bad PROXY v2 version/command {header[12]:#x}")
+    body = header[16:]
+    family = header[13] >> 4
+    if command == 0 or family not in (1, 2):     # LOCAL（健康檢查）、UNSPEC、UNIX
+        return None
+    if family == 1 and len(body) >= 12:
+        return socket.inet_ntop(socket.AF_INET, body[0:4]), int.from_bytes(body[8:10], "big")
+    if family == 2 and len(body) >= 36:
+        return socket.inet_ntop(socket.AF_INET6, body[0:16]), int.from_bytes(body[32:34], "big")
+    raise ValueError("truncated PROXY v2 address block")
+
+
+def read_proxy_header(conn: socket.socket) -> Tuple[Optional[Tuple[str, int]], bytes]:
+    """讀取 PROXY protocol v1 或 v2 標頭，回傳 (真實來源位址, 標頭之後已讀到的資料)。
+
+    LOCAL／UNKNOWN（例如終結器的健康檢查）回傳 None，由呼叫端沿用 socket 位址；
+    沒有標頭或格式錯誤時丟出 ValueError。
+    """
+    buf = b""
+    while True:
+        if len(buf) >= 16 and buf.startswith(PROXY_V2_SIG):
+            end = 16 + int.from_bytes(buf[14:16], "big")
+            while len(buf) < end:
+                buf += _recv_some(conn)
+            return _parse_proxy_v2(buf[:end]), buf[end:]
+        if buf.startswith(b"PROXY ") and b"\r\n" in buf:
+            line, _, rest = buf.partition(b"\r\n")
+            if len(line) + 2 > PROXY_V1_MAX:
+                raise ValueError("PROXY v1 header too long")
+            return _parse_proxy_v1(line), rest
+        is_v2 = PROXY_V2_SIG.startswith(buf[:12])
+        is_v1 = b"PROXY ".startswith(buf[:6])
+        if not (is_v1 or is_v2) or (is_v1 and len(buf) > PROXY_V1_MAX):
+            raise ValueError("missing PROXY protocol header")
+        buf += _recv_some(conn)
+
+
+class Session:
+    """一條連線的全部狀態。
+
+    取代原本的 socket + 文字模式 makefile + {"name", "addr"} dict：__slots__ 省去每個物件的
+    __dict__，讀取改用自管的 bytearray 緩衝，閒置時緩衝釋放為空。
+    """
+
+    __slots__ = ("conn", "addr", "name", "joined_at", "last_seen", "last_ping",
+                 "rbuf", "bytes_in", "bytes_out", "msgs_in", "msgs_out", "uploads", "downloads", "pending",
+                 "lanes", "lane_bytes", "scheduled", "urgent", "writing")
+
+    def __init__(self, conn: socket.socket, addr) -> None:
+        now = time.monotonic()
+        self.conn = conn
+        self.addr = addr
+        self.name: Optional[str] = None
+        self.joined_at = now
+        self.last_seen = now
+        self.last_ping = now
+        self.rbuf = bytearray()
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.msgs_in = 0
+        self.msgs_out = 0
+        self.uploads: Optional[dict] = None     # xfer -> Upload，第一次上傳時才建立
+        self.downloads: Optional[deque] = None  # 排隊中的 /get 檔案代號；非 None 表示下載執行緒在跑
+        self.pending: Optional[bytearray] = None    # 合併寫出模式下尚未送出的廣播
+        self.lanes: Optional[tuple] = None  # 優先序寫出模式：每個優先序一個 (排入時間, 資料) 佇列
+        self.lane_bytes = 0
+        self.scheduled = False      # 在寫出執行緒的待服務清單中
+        self.urgent = False         # 有控制訊息，另在優先清單中
+        self.writing = 0.0          # 寫出執行緒開始對它 sendall 的時間，0 表示沒有在寫
+
+    def read_lines(self) -> Iterator[bytes]:
+        """逐行產生收到的資料（不含換行），對端關閉時結束。"""
+        while True:
+            nl = self.rbuf.find(b"\n")
+            if nl >= 0:
+                line = bytes(self.rbuf[:nl])
+                del self.rbuf[:nl + 1]
+                if not self.rbuf:
+                    self.rbuf = bytearray()     # 不保留擴張過的容量
+                self.msgs_in += 1
+                yield line
+                continue
+            if len(self.rbuf) > MAX_LINE:
+                raise ValueError(f"line exceeds {MAX_LINE} bytes")
+            chunk = self.conn.recv(BUFSZ)
+            if not chunk:
+                return
+            self.bytes_in += len(chunk)
+            self.last_seen = time.monotonic()
+            self.rbuf += chunk
+
+    def send(self, data: bytes) -> None:
+        if self.pending is not None:
+            # 還有排隊中的廣播：接在後面一起送，維持順序
+            self.queue(data)
+            self.flush()
+            return
+        self.conn.sendall(data)
+        self.bytes_out += len(data)
+        self.msgs_out += 1
+
+    def queue(self, data: bytes) -> int:
+        """排入待送緩衝，回傳目前緩衝大小。"""
+        if self.pending is None:
+            self.pending = bytearray(data)
+        else:
+            self.pending += data
+        self.msgs_out += 1
+        return len(self.pending)
+
+    def flush(self) -> int:
+        """一次寫出待送緩衝，回傳寫出的位元組數。"""
+        data = self.pending
+        if data is None:
+            return 0
+        self.pending = None
+        self.conn.sendall(data)
+        self.bytes_out += len(data)
+        return len(data)
+
+    def enqueue(self, lane: int, data: bytes, now: float) -> int:
+        """排入指定優先序的佇列，回傳此連線的待送總量。"""
+        if self.lanes is None:
+            self.lanes = (deque(), deque(), deque())
+        self.lanes[lane].append((now, data))
+        self.lane_bytes += len(data)
+        self.msgs_out += 1
+        return self.lane_bytes
+
+    def next_batch(self, now: float, starve_s: float) -> Tuple[int, list, int, bool]:
+        """取出下一批：最高的非空優先序先送，但較低優先序最舊一則已等超過 starve_s 時先輪到它。
+
+        回傳 (優先序, [(排入時間, 資料)...], 位元組數, 是否因等太久而插隊)。
+        """
+        lanes = self.lanes
+        lane = next(i for i, q in enumerate(lanes) if q)
+        starved = False
+        oldest = now - starve_s
+        for low in range(lane + 1, len(lanes)):
+            q = lanes[low]
+            if q and q[0][0] <= oldest:
+                lane, oldest, starved = low, q[0][0], True
+        q = lanes[lane]
+        batch = [q.popleft()]
+        size = len(batch[0][1])
+        while q and size < LANE_BATCH:
+            item = q.popleft()
+            batch.append(item)
+            size += len(item[1])
+        self.lane_bytes -= size
+        if not self.lane_bytes:
+            self.lanes = None       # 閒置連線不保留佇列物件
+        return lane, batch, size, starved
+
+    def discard(self) -> int:
+        """丟棄所有未送出的資料，回傳丟棄的位元組數。"""
+        dropped = self.lane_bytes
+        self.lanes = None
+        self.lane_bytes = 0
+        return dropped
+
+
+class Upload:
+    """上傳中的檔案：分塊直接寫進暫存目錄，記憶體中只有檔案代號與雜湊狀態。"""
+
+    __slots__ = ("file_id", "name", "size", "path", "f", "received", "seq", "sha")
+
+    def __init__(self, file_id: str, name: str, size: int, path: str, f) -> None:
+        self.file_id = file_id
+        self.name = name
+        self.size = size
+        self.path = path
+        self.f = f
+        self.received = 0
+        self.seq = 0
+        self.sha = hashlib.sha256()
+
 
 class ChatServer:
-    def __init__(self, host: str, port: int, certfile: str, keyfile: str):
+    HANDSHAKE_TIMEOUT = 10.0
+    RESUME_GRACE = 120.0    # 交接後，新程序為舊連線保留名稱的秒數
+
+    def __init__(
+        self,
+        host: str,
+        port: int,
+        certfile: Optional[str],
+        keyfile: Optional[str],
+        max_conns: int = 1000,
+        max_conns_per_ip: int = 20,
+        backlog: int = 128,
+        max_handshakes: int = 64,
+        busy_retry_after: int = 5,
+        stats_interval: float = 0.0,
+        ping_interval: float = 20.0,
+        ping_timeout: float = 60.0,
+        admin_token: Optional[str] = None,
+        diag_dir: str = ".",
+        site: Optional[str] = None,
+        peers: Optional[List[Tuple[str, int]]] = None,
+        peer_token: Optional[str] = None,
+        peer_ca: Optional[str] = None,
+        fed_buffer: int = 1000,
+        thread_stack_kb: int = 0,
+        unix_path: Optional[str] = None,
+        plain_port: int = 0,
+        proxy_protocol: bool = False,
+        spool_dir: Optional[str] = None,
+        max_file_mb: int = 100,
+        spool_limit_mb: int = 1024,
+        coalesce_ms: float = 0.0,
+        coalesce_bytes: int = 64 * 1024,
+        handoff_path: Optional[str] = None,
+        takeover_path: Optional[str] = None,
+        drain_spread: float = 5.0,
+        drain_timeout: float = 30.0,
+        writer_threads: int = 0,
+        starve_ms: float = 200.0,
+        lane_queue_kb: int = 4096,
+        write_timeout: float = 10.0,
+        observer_token: Optional[str] = None,
+        stream_buffer: int = 10000,
+    ):
         self.addr = (host, port)
-        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        self.clients = {}       # conn -> {"name": str, "addr": (ip, port)}
+        # 監聽端點：(socket, 是否 TLS, 顯示名稱)。沒有憑證時不開 TLS 埠，只由本機終結器轉入
+        self.listeners = []
+        if certfile:
+            tls_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            tls_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self.listeners.append((tls_sock, True, f"{host}:{port} (TLS)"))
+        # 明文端點只給本機的 TLS 終結器（stunnel、haproxy）使用：Unix socket 或只綁 127.0.0.1
+        self.unix_path = unix_path
+        if unix_path:
+            usock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.listeners.append((usock, False, f"unix:{unix_path} (plaintext)"))
+        self.plain_port = plain_port
+        if plain_port:
+            psock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            psock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self.listeners.append((psock, False, f"127.0.0.1:{plain_port} (plaintext)"))
+        if not self.listeners:
+            raise ValueError("至少需要 TLS 憑證、unix_path 或 plain_port 其中之一")
+        self.proxy_protocol = proxy_protocol    # 明文端點要求 PROXY 標頭，以取得真實來源位址
+        self.clients = {}       # conn -> Session（僅含已 join 者）
+        self.by_name = {}       # name -> conn，與 clients 同步維護（同鎖）
         self.lock = threading.Lock()
         self.running = True
-        self.ssl_ctx = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
-        self.ssl_ctx.load_cert_chain(certfile=certfile, keyfile=keyfile)
+        self.ssl_ctx = None
+        if certfile:
+            self.ssl_ctx = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+            self.ssl_ctx.load_cert_chain(certfile=certfile, keyfile=keyfile)
 
-    def start(self):
-        self.sock.bind(self.addr)
-        self.sock.listen(20)
-        print(f"[SERVER] Listening on {self.addr[0]}:{self.addr[1]}")
+        # 准入控制：0 表示不限制
+        self.max_conns = max_conns
+        self.max_conns_per_ip = max_conns_per_ip
+        self.backlog = backlog
+        self.busy_retry_after = busy_retry_after
+        self._handshake_slots = threading.BoundedSemaphore(max_handshakes) if max_handshakes > 0 else None
+        self.active = 0             # 已通過准入的連線數（含尚未 join 者）
+        self.per_ip = Counter()     # ip -> 已通過准入的連線數
+        self.stats = Counter()      # 累計計數，_stats_line() 輸出
+        self.stats_interval = stats_interval
+
+        # 心跳：閒置 ping_interval 秒送 ping，超過 ping_timeout 秒沒收到任何資料即回收；0 表示停用
+        self.ping_interval = ping_interval
+        self.ping_timeout = ping_timeout
+        self.reaped = 0             # 只由回收執行緒累加，不進 stats（回收不能等 self.lock）
+
+        # 線上診斷：SIGUSR1/SIGUSR2 或帶 admin_token 的 admin 訊息
+        self.admin_token = admin_token
+        self.diag = Diagnostics("chat_server", diag_dir, log=lambda m: print(f"[SERVER] DIAG {m}"))
+
+        # 站點聯邦：每則訊息以 (origin, epoch, seq) 標記，跨連結一次後在本地扇出
+        self.site = site or f"{host}:{port}"
+        self.peers = list(peers or [])
+        self.peer_token = peer_token
+        self.fed_epoch = time.time_ns()          # 重啟後 seq 歸零，以 epoch 區分
+        self.fed_seq = 0
+        self.fed_seen = {}                       # origin -> (epoch, seq) 已收過的最大值
+        self.fed_window = {}                     # origin -> 位元圖，第 k 位表示 seq 最大值 - k 已收過
+        self.fed_parent = {}                     # origin -> 接收該來源訊息的上游連結；其他連結送來的會請對方剪除
+        self.fed_pruned = {}                     # conn -> 對方不想經這條連結收到的來源
+        self.fed_prunes_sent = {}                # conn -> 已請對方剪除的來源，避免重複送 fed_prune
+        self.fed_log = deque(maxlen=fed_buffer)  # (origin, epoch, seq, 原始 fed 行)，連結重連時補送
+        self.links = {}                          # conn -> 對端站點名稱
+        self.remote_rosters = {}                 # site -> [names]
+        self.roster_lines = {}                   # site -> (epoch, seq, 原始 fed 行)，新連結建立時重送
+        self.roster_via = {}                     # site -> {收過該名單的連結 conn}，全部中斷才移除名單
+        self.roster_orphans = {}                 # site -> 移除期限；已向其他連結 graft，等對方回覆名單
+        self.peer_ssl_ctx = ssl.create_default_context(ssl.Purpose.SERVER_AUTH, cafile=peer_ca)
+        if not peer_ca:
+            self.peer_ssl_ctx.check_hostname = False
+            self.peer_ssl_ctx.verify_mode = ssl.CERT_NONE
+
+        # 每連線一條執行緒，堆疊大小直接決定閒置連線的位址空間與部分 RSS；0 表示系統預設
+        self.thread_stack_kb = thread_stack_kb
+        self._rss_at_start: Optional[int] = None
+
+        # 檔案分享：上傳分塊寫入暫存目錄，完成後以 /get <id> 下載；未指定目錄時用暫存資料夾並在結束時刪除
+        self.spool_dir = spool_dir
+        self._spool_is_temp = spool_dir is None
+        self.max_file_bytes = max_file_mb * 1048576
+        self.spool_limit_bytes = spool_limit_mb * 1048576
+        self.spool_bytes = 0        # 已完成與上傳中（預留）的總大小
+        self.files = {}             # file_id -> {"name", "size", "sha256", "from", "path"}，最久沒被下載的在前
+        self._streaming = Counter()     # file_id -> 下載中的數量，這些檔案不會被清出
 
-        accept_th = threading.Thread(target=self._accept_loop, daemon=True)
-        accept_th.start()
+        # 合併寫出：廣播先排進各連線的待送緩衝，窗口結束或緩衝超過 coalesce_bytes 時一次寫出；0 表示停用
+        self.coalesce_s = coalesce_ms / 1000
+        self.coalesce_bytes = coalesce_bytes
+        self._flush_cond = threading.Condition(self.lock)
+        self._dirty = {}            # conn -> Session，待送緩衝非空者
+        self._flush_early = False   # 有連線的緩衝超過 coalesce_bytes：不等窗口到期
+        # 窗口結束時取出的 (sess, 資料, 取出時間)，由寫出執行緒在鎖外送出；卡住時看守執行緒補備用的
+        self._flush_queue: deque = deque()
+        self._flush_ready = threading.Condition(self.lock)
+        self._window_start = 0.0
+        self._window_n = 0          # 本窗口的廣播數，0 表示沒有開啟中的窗口
+        self._window_tsum = 0.0     # 本窗口各廣播排入時間的總和，用來算平均延遲
+        self._delay_sum = 0.0
+        self._delay_max = 0.0
 
+        # 不中斷升級：舊程序在 handoff_path 等候接手者，交出監聽 socket 與狀態後請客戶端分批重連並排空
+        self.handoff_path = handoff_path
+        self.takeover_path = takeover_path
+        self.drain_spread = drain_spread
+        self.drain_timeout = drain_timeout
+        self.accepting = True
+        self.draining = False
+        self._handing_off = False   # 已交出狀態快照：本地發布改交給新程序，避免與它的 seq 重疊
+        self._handoff_sock: Optional[socket.socket] = None
+        # 排空期間兩個程序以 handoff 連線互轉：舊程序把客戶端發布的訊息交給新程序（_relay_backlog 等它就緒
+        # 再送），新程序把每則廣播送回舊程序，還沒重連的客戶端與已重連的看到同一份訊息
+        # 兩個方向都由專屬執行緒在鎖外寫出：對方卡住時只會積在佇列，不會拖住持有全域鎖的廣播
+        self._relay_backlog: List[dict] = []    # 舊程序：{"type": "relay" | "relay_dm", "payload": ...}
+        self._relay_cond = threading.Condition(self.lock)
+        self._successor: Optional[socket.socket] = None     # 舊程序：接手者
+        self._relay_thread: Optional[threading.Thread] = None
+        self._predecessor: Optional[socket.socket] = None   # 新程序：仍在排空的舊程序
+        self._predecessor_out: Optional[List[bytes]] = None     # 新程序：待送回舊程序的廣播
+        self._predecessor_bytes = 0
+        self._predecessor_since = 0.0       # 佇列中最舊一筆的排入時間
+        self._handoff_tokens = {}   # conn -> resume token（舊程序）
+        self._resume_tokens = {}    # token -> (name, 期限)（新程序）
+        self._drain_deadline = 0.0
+        self._adopted_spool: Optional[str] = None   # 接手的舊暫存目錄，結束時一併刪除
+
+        # 優先序寫出：送出改為排進每條連線的 control／presence／chat 佇列，由 writer_threads 條執行緒
+        # 在鎖外寫出，控制訊息不必排在大量聊天之後；0 表示停用，維持在鎖內直接 sendall
+        if writer_threads and coalesce_ms:
+            raise ValueError("writer_threads 與 coalesce_ms 不能同時使用")
+        self.writer_threads = writer_threads
+        self.starve_s = starve_ms / 1000
+        self.lane_queue_bytes = lane_queue_kb * 1024
+        self.write_timeout = write_timeout  # 單次寫出卡住（對端不讀）超過此秒數即斷線，0 表示不斷線
+        self._ready = deque()       # 有待送資料、等待寫出執行緒的 Session
+        self._ready_urgent = deque()    # 其中有控制訊息者，寫出執行緒先服務
+        self._ready_cond = threading.Condition(self.lock)
+        self._writers = 0           # 存活的寫出執行緒，含寫出卡住時補上的備用執行緒
+        self._writing = set()       # 正在 sendall 的 Session，最多與寫出執行緒一樣多
+        self._drained_cond = threading.Condition(self.lock)     # 每寫完一批通知：節流、檔案串流、連線清理
+        self._lane_queued = 0       # 所有連線待送的總位元組數
+        self._lane_counted = 0      # 同上，但每條連線最多計 LANE_SHARE，節流只看這個
+        self._lane_lat = [deque(maxlen=LANE_LAT_SAMPLES) for _ in LANE_NAMES]
+        self._lane_lat_max = [0.0] * len(LANE_NAMES)
+
+        # 觀察者（封存、分析工具）：以 observer_token 驗證，不進名單；每則廣播只編碼一次、加上 seq 存進
+        # stream_log，各觀察者的執行緒從自己的位置批次讀出寫給對端，慢的觀察者只會落後，不會擋住使用者
+        self.observer_token = observer_token
+        self.stream_epoch = time.time_ns()      # seq 只在同一個 epoch 內連續；重啟後改變，交接時沿用
+        self.stream_seq = 0                     # 最後一則廣播的 seq
+        self.stream_log = deque(maxlen=stream_buffer) if observer_token else None
+        self._stream_cond = threading.Condition(self.lock)
+        self.observers = {}                     # conn -> (Session, 下一則要送的 seq)
+
+    def start(self):
+        self.diag.install_signal_handlers()
+        if self.thread_stack_kb:
+            threading.stack_size(self.thread_stack_kb * 1024)
+        self._rss_at_start = current_rss()
+        inherited, ctl = self._take_over() if self.takeover_path else ({}, None)
+        if self.spool_dir is None:
+            self.spool_dir = tempfile.mkdtemp(prefix="chat_spool-")
+        else:
+            os.makedirs(self.spool_dir, exist_ok=True)
+        for i, (lsock, tls, label) in enumerate(self.listeners):
+            taken = inherited.pop(self._listener_key(lsock.family, tls), None)
+            if taken is not None:
+                lsock.close()
+                lsock = taken
+                self.listeners[i] = (lsock, tls, label)
+                print(f"[SERVER] Took over {label}")
+            else:
+                if lsock.family == socket.AF_UNIX:
+                    self._bind_unix(lsock)
+                elif tls:
+                    lsock.bind(self.addr)
+                else:
+                    lsock.bind(("127.0.0.1", self.plain_port))
+                lsock.listen(self.backlog)
+                print(f"[SERVER] Listening on {label}")
+            if self.handoff_path or taken is not None:
+                # 交出後 accept 迴圈需要醒來結束；同一個監聽 socket 不能 shutdown。接手的 socket 與舊程序
+                # 共用 O_NONBLOCK 旗標（舊程序設了逾時），也得用逾時模式，否則 accept 立即 EAGAIN
+                lsock.settimeout(0.5)
+            threading.Thread(target=self._accept_loop, args=(lsock, tls), daemon=True).start()
+        for lsock in inherited.values():
+            lsock.close()           # 舊程序有、本程序沒設定的端點
+        if ctl is not None:
+            with self.lock:
+                self._predecessor = ctl
+            # ready 由寫出執行緒先送，接著是啟動期間累積的廣播
+            threading.Thread(target=self._predecessor_out_loop, args=(ctl,), daemon=True).start()
+            threading.Thread(target=self._predecessor_loop, args=(ctl,), daemon=True).start()
+        if self.handoff_path:
+            threading.Thread(target=self._handoff_loop, daemon=True).start()
+        if self.ping_interval > 0:
+            threading.Thread(target=self._heartbeat_loop, daemon=True).start()
+            if self.ping_timeout:
+                threading.Thread(target=self._reap_loop, daemon=True).start()
+        if self.coalesce_s > 0:
+            threading.Thread(target=self._coalesce_loop, daemon=True).start()
+            threading.Thread(target=self._flusher_loop, args=(False,), daemon=True).start()
+        for i in range(self.writer_threads):
+            self._start_writer()
+        if self.writer_threads or self.coalesce_s > 0 or self.write_timeout > 0:
+            # 沒有寫出池時也要看守：下載分塊與合併寫出同樣在鎖外 sendall
+            threading.Thread(target=self._write_watchdog_loop, daemon=True).start()
+        for peer in self.peers:
+            threading.Thread(target=self._dial_peer_loop, args=(peer,), daemon=True).start()
+
+        next_stats = time.monotonic() + self.stats_interval
         try:
             while self.running:
-                accept_th.join(0.2)
+                time.sleep(0.2)
+                if self.draining and (not self.clients or time.monotonic() >= self._drain_deadline):
+                    print(f"[SERVER] HANDOFF drained, {len(self.clients)} clients left")
+                    break
+                if self.roster_orphans:
+                    with self.lock:
+                        self._expire_rosters_locked(time.monotonic())
+                if self.stats_interval > 0 and time.monotonic() >= next_stats:
+                    print(f"[SERVER] STATS {self._stats_line()}")
+                    next_stats = time.monotonic() + self.stats_interval
         except KeyboardInterrupt:
             print("\n[SERVER] Shutting down...")
         finally:
+            print(f"[SERVER] STATS {self._stats_line()}")
             self.running = False
+            self._finish_relay()
             with self.lock:
-                for c in list(self.clients.keys()):
+                for c in list(self.clients) + list(self.links) + list(self.observers):
                     try:
                         c.shutdown(socket.SHUT_RDWR)
                     except Exception:
                         pass
                     c.close()
-            self.sock.close()
+            for lsock, _, _ in self.listeners:
+                lsock.close()
+            if self._handoff_sock is not None:
+                self._handoff_sock.close()
+            if self._predecessor is not None:
+                self._predecessor.close()
+            # 已交接時這些路徑與暫存檔都屬於新程序
+            if not self.draining:
+                for path in (self.unix_path, self.handoff_path):
+                    if path:
+                        try:
+                            os.unlink(path)
+                        except OSError:
+                            pass
+                if self._spool_is_temp and self.spool_dir:
+                    shutil.rmtree(self.spool_dir, ignore_errors=True)
+                if self._adopted_spool:
+                    shutil.rmtree(self._adopted_spool, ignore_errors=True)
 
-    def _accept_loop(self):
-        while self.running:
+    def _bind_unix(self, lsock: socket.socket, path: Optional[str] = None, mode: int = 0o660) -> None:
+        path = path or self.unix_path
+        # 上次異常結束留下的 socket 檔會讓 bind 失敗；只刪 socket，不碰同名的一般檔案
+        try:
+            if stat.S_ISSOCK(os.stat(path).st_mode):
+                os.unlink(path)
+        except FileNotFoundError:
+            pass
+        lsock.bind(path)
+        # 這個端點不經 TLS 也不驗證身分，只開放給擁有者與同群組（終結器的執行帳號）
+        os.chmod(path, mode)
+
+    def _listener_key(self, family, tls: bool) -> str:
+        """交接時比對端點：種類加上埠號或路徑，設定不同的端點不會被接手。"""
+        if family == socket.AF_UNIX:
+            return f"unix:{os.path.abspath(self.unix_path)}"
+        if tls:
+            return f"tls:{self.addr[1]}"
+        return f"plain:{self.plain_port}"
+
+    def _handoff_loop(self):
+        ctl = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._bind_unix(ctl, self.handoff_path, 0o600)     # 拿到它就拿到監聽 socket，只給擁有者
+        ctl.listen(1)
+        self._handoff_sock = ctl
+        print(f"[SERVER] Waiting for a successor on {self.handoff_path}")
+        while self.running and not self.draining:
             try:
-                conn, caddr = self.sock.accept()
+                conn, _ = ctl.accept()
             except OSError:
                 break
             try:
-                tls_conn = self.ssl_ctx.wrap_socket(conn, server_side=True)
-            except ssl.SSLError as err:
-                print(f"[SERVER] TLS handshake failed for {caddr}: {err}")
+                self._hand_off(conn)
+            except Exception as err:
                 conn.close()
-                continue
-            threading.Thread(target=self._handle_client, args=(tls_conn, caddr), daemon=True).start()
+                print(f"[SERVER] HANDOFF failed, keep serving: {err}")
+                with self.lock:
+                    self._handing_off = False
+                    self._handoff_tokens.clear()
+                    backlog, self._relay_backlog = self._relay_backlog, []
+                    links = list(self.links)
+                for msg in backlog:
+                    if msg["type"] == "relay":
+                        self._publish(msg["payload"])
+                    else:
+                        self._deliver_dm(msg["payload"])
+                # 交接期間收到的聯邦訊息沒有處理（_on_fed），重連讓對端補送
+                for link in links:
+                    try:
+                        link.shutdown(socket.SHUT_RDWR)
+                    except OSError:
+                        pass
 
-    def _broadcast(self, payload: dict, exclude_conn=None):
-        data = (json.dumps(payload) + "\n").encode(ENC)
+    def _hand_off(self, conn: socket.socket):
+        """把監聽 socket（SCM_RIGHTS）與狀態交給接手的程序，等它開始 accept 後進入排空。
+
+        成功後 conn 留作兩程序間的轉送通道，由 _begin_drain 接手；失敗時丟出例外。
+        """
+        conn.settimeout(self.HANDSHAKE_TIMEOUT)
+        lines = Session(conn, "handoff").read_lines()
+        request = json.loads(next(lines, b"null"))
+        if not isinstance(request, dict) or request.get("type") != "takeover":
+            raise ValueError(f"unexpected request {request!r}")
+        body = json.dumps(self._handoff_state()).encode(ENC)
+        keys = [self._listener_key(lsock.family, tls) for lsock, tls, _ in self.listeners]
+        header = json.dumps({"type": "handoff", "listeners": keys, "length": len(body)}) + "\n"
+        socket.send_fds(conn, [header.encode(ENC)], [lsock.fileno() for lsock, _, _ in self.listeners])
+        conn.sendall(body)
+        conn.settimeout(60.0)       # 接手者要載入憑證、綁定其餘端點
+        reply = json.loads(next(lines, b"null"))
+        if not isinstance(reply, dict) or reply.get("type") != "ready":
+            raise ValueError(f"successor not ready: {reply!r}")
+        self._begin_drain(conn, lines)
+
+    def _handoff_state(self) -> dict:
+        with self.lock:
+            self._handing_off = True
+            self._relay_backlog = []
+            tokens = {}
+            for c, sess in self.clients.items():
+                token = secrets.token_hex(8)
+                self._handoff_tokens[c] = token
+                tokens[token] = sess.name
+            files = {fid: dict(info, path=os.path.abspath(info["path"])) for fid, info in self.files.items()}
+            return {
+                "site": self.site,
+                "fed_epoch": self.fed_epoch,
+                "fed_seq": self.fed_seq,
+                "fed_seen": {o: [e, s] for o, (e, s) in self.fed_seen.items()},
+                "fed_log": [[o, e, s, line.decode(ENC)] for o, e, s, line in self.fed_log],
+                "files": files,
+                "spool_dir": os.path.abspath(self.spool_dir),
+                "spool_is_temp": self._spool_is_temp,
+                "resume": tokens,
+                "stream_epoch": self.stream_epoch,
+                "stream_seq": self.stream_seq,
+                "stream_log": [line.decode(ENC) for line in self.stream_log or ()],
+            }
+
+    def _take_over(self):
+        """連到舊程序的 handoff socket，取得監聽 socket 與狀態；回傳 ({端點: socket}, 控制連線)。"""
+        ctl = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        ctl.settimeout(self.HANDSHAKE_TIMEOUT)
+        ctl.connect(self.takeover_path)
+        ctl.sendall(b'{"type": "takeover"}\n')
+        data, fds, _, _ = socket.recv_fds(ctl, 65536, 16)
+        reader = Session(ctl, "handoff")
+        reader.rbuf += data
+        header = json.loads(next(reader.read_lines(), b"null"))
+        if not isinstance(header, dict) or header.get("type") != "handoff":
+            raise ValueError(f"unexpected handoff header {header!r}")
+        body = bytearray(reader.rbuf)
+        while len(body) < header["length"]:
+            chunk = ctl.recv(65536)
+            if not chunk:
+                raise ConnectionError("handoff state truncated")
+            body += chunk
+        inherited = {key: socket.socket(fileno=fd) for key, fd in zip(header["listeners"], fds)}
+        print(f"[SERVER] HANDOFF received {len(inherited)} listeners from {self.takeover_path}")
+        self._adopt_state(json.loads(body))
+        self._predecessor_out = []
+        ctl.settimeout(None)
+        return inherited, ctl
+
+    def _adopt_state(self, state: dict):
+        # 站點名稱相同才沿用 epoch/seq，其他站點據此判斷重複，不會把新程序的訊息當成舊的
+        if state.get("site") == self.site:
+            self.fed_epoch = state["fed_epoch"]
+            self.fed_seq = state["fed_seq"]
+        self.fed_seen = {o: (e, s) for o, (e, s) in state["fed_seen"].items()}
+        # 沒有交接位元圖：最大值以下都當作收過，與對端的 catch-up 一致
+        self.fed_window = {o: FED_WINDOW_FULL for o in self.fed_seen}
+        self.fed_log.extend((o, e, s, line.encode(ENC)) for o, e, s, line in state["fed_log"])
+        self.files.update(state["files"])
+        self.spool_bytes += sum(info["size"] for info in state["files"].values())
+        if self.spool_dir is None:
+            self.spool_dir = state["spool_dir"]
+            self._spool_is_temp = state["spool_is_temp"]
+        elif state["spool_is_temp"] and os.path.abspath(self.spool_dir) != state["spool_dir"]:
+            self._adopted_spool = state["spool_dir"]
+        # 觀察者帶著最後的 seq 重連到新程序即可接續
+        self.stream_epoch = state.get("stream_epoch", self.stream_epoch)
+        self.stream_seq = state.get("stream_seq", 0)
+        if self.stream_log is not None:
+            self.stream_log.extend(line.encode(ENC) for line in state.get("stream_log", ()))
+        deadline = time.monotonic() + self.RESUME_GRACE
+        self._resume_tokens = {token: (name, deadline) for token, name in state["resume"].items()}
+        print(f"[SERVER] HANDOFF adopted {len(self.fed_log)} fed messages, {len(self.files)} files,"
+              f" {len(self._resume_tokens)} sessions to resume")
+
+    def _begin_drain(self, successor: socket.socket, lines: Iterator[bytes]):
+        successor.settimeout(None)
         with self.lock:
-            for c in list(self.clients.keys()):
-                if c is exclude_conn:
+            self.draining = True
+            self.accepting = False
+            self._successor = successor
+            self._relay_cond.notify_all()
+            sessions = sorted(self.clients.items(), key=lambda kv: kv[1].joined_at)
+            links = list(self.links)
+        self._relay_thread = threading.Thread(target=self._relay_out_loop, args=(successor,), daemon=True)
+        self._relay_thread.start()
+        threading.Thread(target=self._successor_loop, args=(successor, lines), daemon=True).start()
+        self._drain_deadline = time.monotonic() + self.drain_timeout
+        if self._handoff_sock is not None:
+            self._handoff_sock.close()
+            self._handoff_sock = None
+        # 聯邦連結交給新程序：對端會重連到同一位址
+        for link in links:
+            try:
+                link.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        n = len(sessions)
+        for i, (conn, sess) in enumerate(sessions):
+            self._send_reconnect(conn, self.drain_spread * i / n, self._handoff_tokens.get(conn))
+        print(f"[SERVER] HANDOFF done, draining {n} clients over {self.drain_spread:g}s")
+
+    def _relay_locked(self, payload: dict, mtype: str = "relay") -> None:
+        """交出狀態後，本地發布的訊息交給新程序：由它編 seq、送聯邦、進觀察者串流，再廣播回這裡。
+
+        mtype 為 "relay_dm" 時是收件人已不在這裡的私訊，由新程序轉交。
+        """
+        self._relay_backlog.append({"type": mtype, "payload": payload})
+        self._relay_cond.notify_all()
+
+    def _relay_out_loop(self, successor: socket.socket) -> None:
+        """在鎖外把 _relay_backlog 寫給新程序；新程序送廣播回來時持有它自己的鎖，兩邊不能都在鎖內等對方。"""
+        while True:
+            with self._relay_cond:
+                while self.running and self._successor is successor and not self._relay_backlog:
+                    self._relay_cond.wait(0.5)
+                if self._successor is not successor or not self._relay_backlog:
+                    return
+                batch, self._relay_backlog = self._relay_backlog, []
+            try:
+                successor.sendall(b"".join((json.dumps(m) + "\n").encode(ENC) for m in batch))
+            except OSError as err:
+                print(f"[SERVER] HANDOFF relay to successor failed, {len(batch)} messages lost: {err}")
+                with self.lock:
+                    self.stats["relay_lost"] += len(batch)
+                    self._successor = None
+                return
+            with self.lock:
+                self.stats["relay_out"] += len(batch)
+
+    def _successor_loop(self, successor: socket.socket, lines: Iterator[bytes]) -> None:
+        """排空期間：新程序送來它的每則廣播，轉給還連在這裡的客戶端；relay_dm 只交給收件人。"""
+        try:
+            for line in lines:
+                try:
+                    msg = json.loads(line)
+                    mtype = msg.get("type")
+                except (ValueError, AttributeError):
+                    continue
+                if mtype == "relay_dm":
+                    if isinstance(msg.get("payload"), dict):
+                        self._deliver_dm(msg["payload"])
                     continue
+                with self.lock:
+                    self.stats["relay_in"] += 1
+                    self._broadcast_locked(line + b"\n", mtype)
+        except (OSError, ValueError):
+            pass
+        with self.lock:
+            if self._successor is successor:
+                self._successor = None
+                self._relay_cond.notify_all()
+        print("[SERVER] HANDOFF relay from successor closed")
+
+    def _finish_relay(self) -> None:
+        """結束前送完還沒轉給新程序的訊息，再關閉轉送通道。"""
+        successor, thread = self._successor, self._relay_thread
+        if successor is None:
+            return
+        with self.lock:
+            self._relay_cond.notify_all()
+        if thread is not None:
+            thread.join(5.0)
+        successor.close()
+
+    def _predecessor_loop(self, ctl: socket.socket) -> None:
+        """新程序：舊程序轉來它的客戶端發布的訊息，在這裡正常發布（廣播也會送回舊程序）。"""
+        try:
+            for line in Session(ctl, "handoff").read_lines():
                 try:
-                    c.sendall(data)
-                except Exception:
-                    self._drop_client(c)
+                    msg = json.loads(line)
+                except ValueError:
+                    continue
+                if not isinstance(msg, dict) or not isinstance(msg.get("payload"), dict):
+                    continue
+                if msg.get("type") == "relay":
+                    self._publish(msg["payload"])
+                elif msg.get("type") == "relay_dm":
+                    self._deliver_dm(msg["payload"])
+        except (OSError, ValueError):
+            pass
+        with self.lock:
+            self._predecessor = None
+            self._predecessor_out = None
+            self._relay_cond.notify_all()
+        ctl.close()
+        print("[SERVER] HANDOFF predecessor finished draining")
 
-    def _send_roster(self, conn):
+    def _queue_predecessor_locked(self, data: bytes) -> None:
+        """新程序：排入要送回舊程序的一行；舊程序讀不動時放棄轉送，而不是讓佇列無限成長。"""
+        now = time.monotonic()
+        if not self._predecessor_out:
+            self._predecessor_since = now
+        self._predecessor_out.append(data)
+        self._predecessor_bytes += len(data)
+        ctl = self._predecessor
+        if ctl is None:
+            return          # 尚未送出 ready：start() 很快會接上寫出執行緒
+        if self._predecessor_bytes > RELAY_QUEUE_BYTES or now - self._predecessor_since > RELAY_STALL_S:
+            self.stats["relay_dropped"] += 1
+            print(f"[SERVER] HANDOFF predecessor not reading ({self._predecessor_bytes} bytes queued), stop relaying")
+            self._predecessor_out = None
+            try:
+                ctl.shutdown(socket.SHUT_RDWR)     # 喚醒卡在 sendall 的寫出執行緒；_predecessor_loop 隨即結束
+            except OSError:
+                pass
+            return
+        self._relay_cond.notify_all()
+
+    def _predecessor_out_loop(self, ctl: socket.socket) -> None:
+        """新程序：在鎖外把 _predecessor_out 寫給舊程序，第一批以 ready 開頭。"""
+        head = b'{"type": "ready"}\n'
+        while True:
+            with self._relay_cond:
+                while (self.running and self._predecessor is ctl and self._predecessor_out is not None
+                       and not self._predecessor_out and not head):
+                    self._relay_cond.wait(0.5)
+                if self._predecessor is not ctl or self._predecessor_out is None:
+                    return
+                batch, self._predecessor_out = self._predecessor_out, []
+                self._predecessor_bytes = 0
+            if not batch and not head:
+                return      # 伺服器結束
+            try:
+                ctl.sendall(head + b"".join(batch))
+            except OSError:
+                with self.lock:
+                    self._predecessor_out = None
+                return
+            head = b""
+
+    def _send_reconnect(self, conn, after: float, token: Optional[str]) -> bool:
+        # 分散各客戶端的重連時間，新程序不會同時收到所有握手
+        return self._send_to(conn, {"type": "reconnect", "retry_after": round(after, 2), "token": token,
+                                    "ts": self._ts_now()})
+
+    def _claim_resume(self, token) -> Optional[str]:
+        if not isinstance(token, str) or not self._resume_tokens:
+            return None
         with self.lock:
-            users = sorted(info["name"] for info in self.clients.values())
+            name, deadline = self._resume_tokens.pop(token, (None, 0.0))
+        return name if deadline > time.monotonic() else None
+
+    def _accept_loop(self, lsock: socket.socket, tls: bool):
+        while self.running and self.accepting:
+            try:
+                conn, caddr = lsock.accept()
+            except TimeoutError:
+                continue
+            except OSError:
+                break
+            with self.lock:
+                self.stats["accepted"] += 1
+            if self.ping_interval > 0 and conn.family != socket.AF_UNIX:
+                tune_keepalive(conn, int(self.ping_interval), max(1, int(self.ping_interval) // 2), 3)
+            # 握手名額用完時連 TLS 都不做，直接關閉，避免無上限地開執行緒
+            if self._handshake_slots is not None and not self._handshake_slots.acquire(blocking=False):
+                with self.lock:
+                    self.stats["rejected_handshakes"] += 1
+                conn.close()
+                continue
+            threading.Thread(target=self._admit, args=(conn, caddr, tls), daemon=True).start()
+
+    def _admit(self, conn: socket.socket, caddr, tls: bool):
+        if not isinstance(caddr, tuple):
+            caddr = ("unix", 0)     # AF_UNIX 的對端位址是空字串
+        leftover = b""
+        # 明文端點的對端是本機的 TLS 終結器，沒有 PROXY 標頭時所有使用者共用它的位址，不適用單一 IP 上限
+        per_ip_limit = self.max_conns_per_ip if tls else 0
+        try:
+            conn.settimeout(self.HANDSHAKE_TIMEOUT)
+            if tls:
+                stream = self.ssl_ctx.wrap_socket(conn, server_side=True)
+            else:
+                if self.proxy_protocol:
+                    real, leftover = read_proxy_header(conn)
+                    if real is not None:
+                        caddr = real
+                        per_ip_limit = self.max_conns_per_ip
+                stream = conn
+        except (ssl.SSLError, OSError, ValueError) as err:
+            kind = "handshake_failed" if tls else "proxy_failed"
+            with self.lock:
+                self.stats[kind] += 1
+            print(f"[SERVER] {'TLS handshake' if tls else 'PROXY header'} failed for {caddr}: {err}")
+            conn.close()
+            return
+        finally:
+            if self._handshake_slots is not None:
+                self._handshake_slots.release()
+
+        ip = caddr[0]
+        with self.lock:
+            if self.max_conns and self.active >= self.max_conns:
+                reason = "max_conns"
+            elif per_ip_limit and self.per_ip[ip] >= per_ip_limit:
+                reason = "max_conns_per_ip"
+            else:
+                reason = None
+                self.active += 1
+                self.per_ip[ip] += 1
+            if reason:
+                self.stats[f"rejected_{reason}"] += 1
+        if reason:
+            self._reject_busy(stream, reason)
+            return
+
+        try:
+            # 等待 join 也受 ping_timeout 限制，避免只連線不說話的客戶端佔住名額
+            stream.settimeout(self.ping_timeout or None)
+            sess = Session(stream, caddr)
+            sess.rbuf += leftover
+            self._handle_client(sess)
+        finally:
+            with self.lock:
+                self.active -= 1
+                self.per_ip[ip] -= 1
+                if self.per_ip[ip] <= 0:
+                    del self.per_ip[ip]
+
+    def _reject_busy(self, conn, reason: str) -> None:
         payload = {
-            "type": "roster",
-            "users": users,
+            "type": "busy",
+            "reason": reason,
+            "retry_after": self.busy_retry_after,
             "ts": self._ts_now()
         }
+        try:
+            conn.sendall((json.dumps(payload) + "\n").encode(ENC))
+            conn.shutdown(socket.SHUT_RDWR)
+        except Exception:
+            pass
+        conn.close()
+
+    def _heartbeat_loop(self):
+        """對閒置的連線送 ping；送出要取鎖、可能卡在 sendall，所以與回收分開在兩條執行緒。"""
+        tick = max(0.5, self.ping_interval / 4)
+        while self.running:
+            time.sleep(tick)
+            now = time.monotonic()
+            for conn, sess in list(self.clients.items()):
+                if now - sess.last_seen >= self.ping_interval and now - sess.last_ping >= self.ping_interval:
+                    sess.last_ping = now
+                    with self.lock:
+                        self.stats["pings_sent"] += 1
+                    self._send_to(conn, {"type": "ping", "ts": self._ts_now()})
+
+    def _reap_loop(self):
+        """shutdown 超過 ping_timeout 沒有任何資料的連線，讓讀取執行緒醒來走正常清理。
+
+        全程不取 self.lock：在鎖內直接 sendall 的模式下，寫給死掉對端的廣播正持有鎖卡住，
+        回收要先 shutdown 那條連線，廣播的 sendall 才會失敗返回、放開鎖。
+        """
+        tick = max(0.5, min(self.ping_interval, self.ping_timeout) / 4)
+        reaped = set()      # 已 shutdown、等讀取執行緒移除的連線，不重複計
+        while self.running:
+            time.sleep(tick)
+            now = time.monotonic()
+            sessions = list(self.clients.items())
+            reaped.intersection_update(conn for conn, _ in sessions)
+            for conn, sess in sessions:
+                idle = now - sess.last_seen
+                if idle > self.ping_timeout and conn not in reaped:
+                    try:
+                        conn.shutdown(socket.SHUT_RDWR)
+                    except OSError:
+                        pass
+                    reaped.add(conn)
+                    self.reaped += 1
+                    print(f"[SERVER] REAP {sess.name} idle {idle:.0f}s")
+
+    def _stats_line(self) -> str:
+        with self.lock:
+            snapshot = dict(self.stats)
+            snapshot["active"] = self.active
+            snapshot["joined"] = len(self.clients)
+            if self.reaped:
+                snapshot["reaped"] = self.reaped
+            if self.coalesce_s > 0:
+                snapshot.update(self._coalesce_summary_locked())
+            if self.writer_threads:
+                snapshot["lane_queued"] = self._lane_queued
+            if self.observer_token:
+                snapshot["observers"] = len(self.observers)
+                snapshot["stream_seq"] = self.stream_seq
+        return " ".join(f"{k}={v}" for k, v in sorted(snapshot.items()))
+
+    def _memory_report(self) -> str:
+        """每條已 join 連線的記憶體估算，依元件拆開。
+
+        Python 物件以 sys.getsizeof 計（不含 OpenSSL 內部配置）；核心緩衝區是 SO_RCVBUF/SO_SNDBUF
+        的上限而非實際用量；執行緒堆疊是保留的位址空間，實際 RSS 只算碰過的頁。
+        最後一行以 RSS 增量除以連線數，是唯一包含所有隱性成本的數字。
+        """
+        with self.lock:
+            sessions = list(self.clients.values())
+            index_bytes = sys.getsizeof(self.clients) + sys.getsizeof(self.by_name)
+        n = len(sessions)
+        if not n:
+            return "memory: 沒有已 join 的連線"
+        parts = [
+            ("session", sum(sys.getsizeof(s) for s in sessions)),
+            ("name+addr", sum(sys.getsizeof(s.name) + sys.getsizeof(s.addr) for s in sessions)),
+            ("read buffer", sum(sys.getsizeof(s.rbuf) for s in sessions)),
+            ("socket object", sum(sys.getsizeof(s.conn) for s in sessions)),
+            ("index dicts", index_bytes),
+        ]
+        lines = [f"memory: {n} sessions, bytes per connection"]
+        for label, total in parts:
+            lines.append(f"  {label:<14}{total / n:10.0f}")
+        try:
+            sample = sessions[0].conn
+            rcv = sample.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)
+            snd = sample.getsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF)
+            lines.append(f"  {'kernel bufs':<14}{rcv + snd:10d}  (SO_RCVBUF+SO_SNDBUF 上限)")
+        except OSError:
+            pass
+        stack = threading.stack_size() or 8 << 20
+        lines.append(f"  {'thread stack':<14}{stack:10d}  (保留位址空間{'' if self.thread_stack_kb else '，系統預設'})")
+        rss = current_rss()
+        if rss is not None and self._rss_at_start is not None:
+            delta = (rss - self._rss_at_start) / n
+            native = delta - sum(total for _, total in parts) / n
+            lines.append(f"  {'RSS delta':<14}{delta:10.0f}  (總 RSS {rss / 1048576:.1f} MiB)")
+            lines.append(f"  {'native':<14}{native:10.0f}  (RSS delta 扣掉上列物件：OpenSSL 狀態與緩衝、執行緒)")
+        totals = Counter()
+        for s in sessions:
+            totals["bytes_in"] += s.bytes_in
+            totals["bytes_out"] += s.bytes_out
+            totals["msgs_in"] += s.msgs_in
+            totals["msgs_out"] += s.msgs_out
+        lines.append("  traffic " + " ".join(f"{k}={v}" for k, v in sorted(totals.items())))
+        return "\n".join(lines)
+
+    def _coalesce_summary_locked(self) -> dict:
+        writes = self.stats["coalesce_writes"]
+        broadcasts = self.stats["coalesce_broadcasts"]
+        return {
+            "coalesce_msgs_per_write": f"{self.stats['coalesce_deliveries'] / writes:.1f}" if writes else "0",
+            "coalesce_bytes_per_write": self.stats["coalesce_bytes"] // writes if writes else 0,
+            "coalesce_avg_delay_ms": f"{self._delay_sum * 1000 / broadcasts:.2f}" if broadcasts else "0",
+            "coalesce_max_delay_ms": f"{self._delay_max * 1000:.2f}",
+        }
+
+    def _coalesce_report(self) -> str:
+        with self.lock:
+            summary = self._coalesce_summary_locked()
+            counts = {k: v for k, v in self.stats.items() if k.startswith("coalesce_")}
+        if self.coalesce_s <= 0:
+            return "coalesce: 未啟用（--coalesce-ms 0）"
+        head = f"coalesce: window={self.coalesce_s * 1000:g}ms bytes={self.coalesce_bytes}"
+        return " ".join([head] + [f"{k[len('coalesce_'):]}={v}" for k, v in sorted({**counts, **summary}.items())])
+
+    def _coalesce_loop(self):
+        """窗口到期（或有連線的緩衝超過 coalesce_bytes）時把所有連線的待送緩衝各交給寫出執行緒一次寫出。
+
+        這條執行緒只在鎖內計時與取出緩衝，從不寫 socket：慢的接收者拖不住窗口，也拖不住全域鎖。
+        """
+        with self._flush_cond:
+            while self.running:
+                if not self._window_n:
+                    self._flush_cond.wait(0.5)
+                    continue
+                wait = self._window_start + self.coalesce_s - time.monotonic()
+                if wait > 0 and not self._flush_early:
+                    self._flush_cond.wait(wait)
+                    continue
+                self._flush_window_locked()
+
+    def _flusher_loop(self, spare: bool) -> None:
+        """在鎖外寫出 _flush_queue；備用的（spare）閒置一秒後退場，慢的接收者卡住期間不必每個窗口都補一條。"""
+        while True:
+            with self._flush_ready:
+                idle_until = time.monotonic() + 1.0
+                while self.running and not self._flush_queue:
+                    if spare and time.monotonic() >= idle_until:
+                        return
+                    self._flush_ready.wait(0.5)
+                if not self.running:
+                    return
+                sess, data, _ = self._flush_queue.popleft()
+            self._write_owned(sess, data)
+
+    def _flush_window_locked(self) -> None:
+        """結束目前窗口：取出各連線的緩衝並取得寫出權，排進 _flush_queue 交給寫出執行緒。"""
+        now = time.monotonic()
+        self._flush_early = False
+        # 延遲只計窗口內的排隊時間（不含寫出本身），提前因 coalesce_bytes 送出的部分會被高估
+        self._delay_sum += self._window_n * now - self._window_tsum
+        self._delay_max = max(self._delay_max, now - self._window_start)
+        self.stats["coalesce_windows"] += 1
+        self.stats["coalesce_broadcasts"] += self._window_n
+        self._window_n = 0
+        self._window_tsum = 0.0
+        dirty, self._dirty = self._dirty, {}
+        for c, sess in dirty.items():
+            if sess.writing or not sess.pending or c not in self.clients:
+                continue    # 鎖外正在寫這條連線：它寫完會接著送出緩衝
+            data, sess.pending = bytes(sess.pending), None
+            sess.writing = now
+            self._writing.add(sess)
+            self.stats["coalesce_writes"] += 1
+            self.stats["coalesce_bytes"] += len(data)
+            self._flush_queue.append((sess, data, now))
+        if self._flush_queue:
+            self._flush_ready.notify()
+
+    def _queue_broadcast_locked(self, data: bytes, exclude_conn=None):
+        now = time.monotonic()
+        if not self._window_n:
+            self._window_start = now
+            self._flush_cond.notify()
+        self._window_n += 1
+        self._window_tsum += now
+        for c, sess in list(self.clients.items()):
+            if c is exclude_conn:
+                continue
+            self.stats["coalesce_deliveries"] += 1
+            self._dirty[c] = sess
+            if sess.queue(data) >= self.coalesce_bytes and not self._flush_early:
+                # 提前結束窗口，由合併寫出執行緒在鎖外寫出
+                self.stats["coalesce_early"] += 1
+                self._flush_early = True
+                self._flush_cond.notify()
+
+    def _lanes_report(self) -> str:
+        if not self.writer_threads:
+            return "lanes: 未啟用（--writer-threads 0）"
+        with self.lock:
+            samples = [sorted(lat) for lat in self._lane_lat]
+            lines = [f"lanes: writers={self._writers}/{self.writer_threads} starve={self.starve_s * 1000:g}ms"
+                     f" queued={self._lane_queued} ready={len(self._ready)} urgent={len(self._ready_urgent)}"
+                     f" starved_picks={self.stats['lane_starved']} spares={self.stats['writer_spares']}"
+                     f" dropped_slow={self.stats['dropped_slow']} dropped_stalled={self.stats['dropped_stalled']}"]
+            for i, name in enumerate(LANE_NAMES):
+                msgs = self.stats[f"lane_{name}_msgs"]
+                writes = self.stats[f"lane_{name}_writes"]
+
+                def pct(p: float, lat=samples[i]) -> float:
+                    return lat[min(len(lat) - 1, int(p * len(lat)))] * 1000 if lat else 0.0
+
+                lines.append(f"  {name:<9}msgs={msgs} writes={writes}"
+                             f" msgs/write={msgs / writes if writes else 0:.1f}"
+                             f" p50={pct(0.50):.2f}ms p99={pct(0.99):.2f}ms max={self._lane_lat_max[i] * 1000:.2f}ms")
+        return "\n".join(lines)
+
+    def _observers_report(self) -> str:
+        if self.stream_log is None:
+            return "observers: 未啟用（沒有 --observer-token）"
+        with self.lock:
+            oldest = self.stream_seq - len(self.stream_log) + 1
+            lines = [f"observers: {len(self.observers)} connected, stream seq {oldest}..{self.stream_seq}"
+                     f" ({sum(len(line) for line in self.stream_log) // 1024} KiB kept)"]
+            for sess, seq in self.observers.values():
+                lines.append(f"  {sess.addr[0]}:{sess.addr[1]} next_seq={seq} behind={self.stream_seq - seq + 1}"
+                             f" msgs_out={sess.msgs_out} bytes_out={sess.bytes_out}")
+        return "\n".join(lines)
+
+    def _start_writer(self) -> None:
+        with self.lock:
+            self._writers += 1
+            n = self._writers
+        threading.Thread(target=self._writer_loop, name=f"writer-{n}", daemon=True).start()
+
+    def _stalled_writes_locked(self, now: float) -> int:
+        return sum(1 for s in self._writing if now - s.writing > self.starve_s)
+
+    def _writer_loop(self):
+        """寫出執行緒：輪流服務有待送資料的連線，每次寫一批；同一連線同時只有一個執行緒在寫。"""
+        while self.running:
+            with self._ready_cond:
+                # 卡住的寫出結束後，多出來的執行緒退場，池子回到 writer_threads 條
+                if self._writers - self._stalled_writes_locked(time.monotonic()) > self.writer_threads:
+                    self._writers -= 1
+                    return
+                while self.running and not (self._ready_urgent or self._ready):
+                    self._ready_cond.wait(0.5)
+                if not self.running:
+                    return
+                if self._ready_urgent:
+                    sess = self._ready_urgent.popleft()
+                    sess.urgent = False
+                else:
+                    sess = self._ready.popleft()
+                    sess.scheduled = False
+                if sess.writing or not sess.lane_bytes:
+                    continue    # 另一個執行緒正在寫，寫完會重新排入；或已清空
+                before = sess.lane_bytes
+                lane, batch, size, starved = sess.next_batch(time.monotonic(), self.starve_s)
+                self._lane_queued -= size
+                self._lane_counted -= min(before, LANE_SHARE) - min(sess.lane_bytes, LANE_SHARE)
+                if starved:
+                    self.stats["lane_starved"] += 1
+                sess.writing = time.monotonic()
+                self._writing.add(sess)
+            try:
+                sess.conn.sendall(b"".join(data for _, data in batch))
+                ok = True
+            except Exception:
+                ok = False
+            done = time.monotonic()
+            with self.lock:
+                sess.writing = 0.0
+                self._writing.discard(sess)
+                sess.bytes_out += size
+                name = LANE_NAMES[lane]
+                self.stats[f"lane_{name}_writes"] += 1
+                self.stats[f"lane_{name}_msgs"] += len(batch)
+                lat = self._lane_lat[lane]
+                for queued_at, _ in batch:
+                    lat.append(done - queued_at)
+                self._lane_lat_max[lane] = max(self._lane_lat_max[lane], done - batch[0][0])
+                if not ok:
+                    self._drop_client(sess.conn)
+                else:
+                    self._schedule_locked(sess)
+                self._drained_cond.notify_all()
+
+    def _write_watchdog_loop(self):
+        """看守鎖外的寫出（_writing），否則幾個不讀的客戶端就能佔滿整個寫出池。
+
+        某次 sendall 卡住超過 starve_ms 而還有連線等著寫時，補一條備用寫出執行緒，其他連線不必等它；
+        卡住超過 write_timeout 則 shutdown 該連線，讓 sendall 失敗返回，備用執行緒隨之退場。
+        合併寫出的佇列同樣卡住時補一條備用的 _flusher_loop；沒有寫出池時也看守 _write_owned 的下載分塊。
+        """
+        tick = max(0.05, min(1.0, self.starve_s / 2))
+        while self.running:
+            time.sleep(tick)
+            now = time.monotonic()
+            with self.lock:
+                stalled = self._stalled_writes_locked(now)
+                spare = (self._ready or self._ready_urgent) and self._writers - stalled < self.writer_threads
+                if spare:
+                    self.stats["writer_spares"] += 1
+                # 合併寫出：佇列最前面等超過一個窗口，表示寫出執行緒都卡在慢的接收者上
+                flush_spare = bool(self._flush_queue) and now - self._flush_queue[0][2] > max(0.05, self.coalesce_s)
+                if flush_spare:
+                    self.stats["coalesce_spares"] += 1
+                expired = [s for s in self._writing if self.write_timeout > 0 and now - s.writing > self.write_timeout]
+                for sess in expired:
+                    print(f"[SERVER] STALLED {sess.name} write blocked {now - sess.writing:.0f}s")
+                    self._drop_client(sess.conn, "dropped_stalled")
+            if spare:
+                self._start_writer()
+            if flush_spare:
+                threading.Thread(target=self._flusher_loop, args=(True,), daemon=True).start()
+
+    def _schedule_locked(self, sess: Session) -> None:
+        """有待送資料的連線排到清單尾端輪流服務；有控制訊息的另排進優先清單，不必等其他連線輪完。"""
+        if sess.writing or not sess.lane_bytes:
+            return
+        if not sess.scheduled:
+            sess.scheduled = True
+            self._ready.append(sess)
+            self._ready_cond.notify()
+        if not sess.urgent and sess.lanes[LANE_CONTROL]:
+            sess.urgent = True
+            self._ready_urgent.append(sess)
+            self._ready_cond.notify()
+
+    def _enqueue_locked(self, conn, sess: Session, lane: int, data: bytes) -> bool:
+        before = sess.lane_bytes
+        queued = sess.enqueue(lane, data, time.monotonic())
+        self._lane_queued += len(data)
+        self._lane_counted += min(queued, LANE_SHARE) - min(before, LANE_SHARE)
+        if queued > self.lane_queue_bytes:
+            # 讀得太慢的客戶端：斷線，而不是讓它的佇列無限成長
+            self._drop_client(conn, "dropped_slow")
+            return False
+        self._schedule_locked(sess)
+        return True
+
+    def _lane_backpressure_locked(self, mtype) -> None:
+        """平均每條連線待送超過一批（LANE_BATCH）時，讓送出聊天的執行緒等待。
+
+        在編 seq、轉送之前呼叫（_publish、_broadcast）：等待時鎖已釋放，別人的發布照常進行，
+        串流、舊程序與客戶端看到的順序一致；已編號的訊息進入 fan-out 後不再等待。
+
+        每條連線最多計入 LANE_SHARE（兩批），不讀的客戶端再怎麼積也只算兩批，要超過一半的連線
+        都落後才會觸發；個別的慢速客戶端由 lane_queue_bytes 與寫出逾時處理，不會擋住其他人。
+        所有佇列一起成長代表整體寫不過來，這時把壓力推回傳送端，聊天延遲不會跟著拉長。
+        """
+        if not self.writer_threads or LANE_OF_TYPE.get(mtype) != LANE_CHAT:
+            return
+        while self.running and self._lane_counted > LANE_BATCH * max(2, len(self.clients)):
+            self.stats["lane_throttled"] += 1
+            self._drained_cond.wait(0.5)
+
+    def _wait_lane_room(self, conn) -> bool:
+        """檔案串流用：等該連線的待送量降到上限一半以下再排下一塊，不一次把整個檔案排進佇列。"""
+        with self._drained_cond:
+            while self.running:
+                sess = self.clients.get(conn)
+                if sess is None:
+                    return False
+                if sess.lane_bytes * 2 < self.lane_queue_bytes:
+                    return True
+                self._drained_cond.wait(0.5)
+        return False
+
+    def _broadcast(self, payload: dict, exclude_conn=None):
         data = (json.dumps(payload) + "\n").encode(ENC)
+        with self.lock:
+            self._lane_backpressure_locked(payload.get("type"))
+            self._broadcast_locked(data, payload.get("type"), exclude_conn)
+
+    def _broadcast_locked(self, data: bytes, mtype, exclude_conn=None):
+        if self.stream_log is not None and not self._handing_off:
+            # 已交出狀態後 seq 屬於新程序；排空期間的發布由新程序編入它的串流
+            self.stream_seq += 1
+            self.stream_log.append(b'{"seq": %d, ' % self.stream_seq + data[1:])
+            self._stream_cond.notify_all()
+        if self._predecessor_out is not None:
+            self._queue_predecessor_locked(data)
+        if self.coalesce_s > 0:
+            self._queue_broadcast_locked(data, exclude_conn)
+            return
+        if self.writer_threads:
+            lane = LANE_OF_TYPE.get(mtype, LANE_PRESENCE)
+            for c, sess in list(self.clients.items()):
+                if c is not exclude_conn:
+                    self._enqueue_locked(c, sess, lane, data)
+            return
+        for c, sess in list(self.clients.items()):
+            if c is exclude_conn:
+                continue
+            try:
+                self._send_session_locked(c, sess, data)
+            except Exception:
+                self._drop_client(c)
+
+    def _publish(self, payload: dict):
+        """本地廣播並送往所有聯邦連結；已交出狀態時改由新程序發布。"""
+        data = (json.dumps(payload) + "\n").encode(ENC)
+        with self.lock:
+            self._lane_backpressure_locked(payload.get("type"))
+            if self._handing_off:
+                self._relay_locked(payload)
+                return
+            self._federate_locked(payload)
+            self._broadcast_locked(data, payload.get("type"))
+
+    def _federate(self, payload: dict):
+        with self.lock:
+            if not self._handing_off:
+                self._federate_locked(payload)
+
+    def _federate_locked(self, payload: dict):
+        if not self.peers and not self.links and not self.peer_token:
+            return
+        self.fed_seq += 1
+        seq = self.fed_seq
+        self.fed_seen[self.site] = (self.fed_epoch, seq)
+        line = (json.dumps({
+            "type": "fed",
+            "origin": self.site,
+            "epoch": self.fed_epoch,
+            "seq": seq,
+            "payload": payload
+        }) + "\n").encode(ENC)
+        self.fed_log.append((self.site, self.fed_epoch, seq, line))
+        roster = payload.get("type") == "peer_roster"
+        for link in list(self.links):
+            if roster or self.site not in self.fed_pruned.get(link, ()):
+                self._send_link_locked(link, line)
+
+    def _federate_roster(self):
+        with self.lock:
+            users = sorted(sess.name for sess in self.clients.values())
+        self._federate({"type": "peer_roster", "users": users})
+
+    def _send_link_locked(self, link, data: bytes) -> None:
         try:
-            conn.sendall(data)
+            link.sendall(data)
+            self.stats["fed_sent"] += 1
+        except Exception:
+            # 交給該連結的讀取執行緒做清理
+            try:
+                link.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def _on_fed(self, link, raw: bytes, msg: dict):
+        origin = str(msg.get("origin", ""))
+        epoch = msg.get("epoch")
+        seq = msg.get("seq")
+        payload = msg.get("payload")
+        if not origin or not isinstance(epoch, int) or not isinstance(seq, int) or not isinstance(payload, dict):
+            return
+        data = raw + b"\n"
+        roster = payload.get("type") == "peer_roster"
+        with self.lock:
+            if self._handing_off:
+                # 不記為已見過：新程序連上對端時由 catch-up 取得，再廣播回這裡
+                self.stats["fed_deferred"] += 1
+                return
+            if roster and origin != self.site:
+                # 重複的名單也要記下連結：環狀連接時另一條路徑斷了，名單仍可經這條連結到達
+                self._note_roster_locked(link, origin, epoch, seq, data, payload.get("users"))
+            if origin != self.site:
+                # 上游優先選直連來源的連結，否則沿用第一個送來的連結
+                parent = self.fed_parent.get(origin)
+                if parent not in self.links or self.links.get(link) == origin:
+                    parent = self.fed_parent[origin] = link
+            else:
+                parent = None
+            if link is not parent and not roster:
+                self._prune_locked(link, origin)
+            if origin == self.site or not self._fed_accept_locked(origin, epoch, seq):
+                self.stats["fed_dup"] += 1
+                return
+            self.fed_log.append((origin, epoch, seq, data))
+            self.stats["fed_recv"] += 1
+            # 名單照舊轉給所有連結，各站據此知道經由哪些連結到得了該站點
+            for other in list(self.links):
+                if other is not link and (roster or origin not in self.fed_pruned.get(other, ())):
+                    self._send_link_locked(other, data)
+            if roster:
+                return
+
+        local = dict(payload)
+        if local.get("type") == "chat":
+            local["name"] = f"{local.get('name', '?')}@{origin}"
+        elif local.get("type") == "system":
+            local["text"] = f"[{origin}] {local.get('text', '')}"
+        else:
+            return
+        self._broadcast(local)
+
+    def _fed_accept_locked(self, origin: str, epoch: int, seq: int) -> bool:
+        """記下 (epoch, seq)；已收過、比視窗更舊或屬於舊 epoch 時回傳 False。"""
+        seen_epoch, seen_seq = self.fed_seen.get(origin, (0, 0))
+        if epoch < seen_epoch:
+            return False
+        if epoch > seen_epoch:
+            # 第一次見到這個來源（或對方重啟）：之前的 seq 不再追
+            self.fed_seen[origin] = (epoch, seq)
+            self.fed_window[origin] = FED_WINDOW_FULL
             return True
+        bits = self.fed_window.get(origin, FED_WINDOW_FULL)
+        if seq > seen_seq:
+            self.fed_seen[origin] = (epoch, seq)
+            self.fed_window[origin] = ((bits << (seq - seen_seq)) | 1) & FED_WINDOW_FULL
+            return True
+        k = seen_seq - seq
+        if k >= FED_WINDOW or bits >> k & 1:
+            return False
+        self.fed_window[origin] = bits | 1 << k
+        return True
+
+    def _fed_floor_locked(self, origin: str) -> Tuple[int, int]:
+        """回傳 (epoch, seq)，該 seq 以下都已收過；catch-up 從這之後補送。"""
+        epoch, seq = self.fed_seen[origin]
+        missing = ~self.fed_window.get(origin, FED_WINDOW_FULL) & FED_WINDOW_FULL
+        if missing:
+            seq -= missing.bit_length()
+        return epoch, seq
+
+    def _prune_locked(self, link, origin: str) -> None:
+        sent = self.fed_prunes_sent.setdefault(link, set())
+        if origin not in sent:
+            sent.add(origin)
+            self.stats["fed_prune"] += 1
+            self._send_link_locked(link, (json.dumps({"type": "fed_prune", "origin": origin}) + "\n").encode(ENC))
+
+    def _graft_locked(self, origins, skip=None) -> None:
+        """上游連結斷了：請其他連結恢復轉送這些來源，並從已收過的位置補送。"""
+        origins = [o for o in origins if o in self.fed_seen]
+        if not origins:
+            return
+        line = (json.dumps({
+            "type": "fed_graft",
+            "seen": {o: list(self._fed_floor_locked(o)) for o in origins}
+        }) + "\n").encode(ENC)
+        for link in list(self.links):
+            if link is not skip:
+                self.fed_prunes_sent.get(link, set()).difference_update(origins)
+                self._send_link_locked(link, line)
+
+    def _on_graft(self, link, msg: dict):
+        seen = msg.get("seen")
+        if not isinstance(seen, dict):
+            return
+        with self.lock:
+            if self._handing_off:
+                return
+            pruned = self.fed_pruned.get(link, set())
+            lost = []
+            for origin, pair in seen.items():
+                pruned.discard(origin)
+                if self.fed_parent.get(origin) is link:
+                    # 我們的上游也失去了來源：一起往其他連結找
+                    del self.fed_parent[origin]
+                    lost.append(origin)
+            want = {o: tuple(p) for o, p in seen.items() if isinstance(p, list) and len(p) == 2}
+            backlog = [
+                line for origin, epoch, seq, line in self.fed_log
+                if origin in want and (epoch, seq) > want[origin]
+            ]
+            self.stats["fed_catchup"] += len(backlog)
+            # 名單只回覆經由其他連結收到的，不把對方自己告訴我們的再送回去
+            backlog.extend(
+                self.roster_lines[origin][2] for origin in want
+                if origin in self.roster_lines and self.roster_via.get(origin, set()) - {link}
+            )
+            if backlog:
+                self._send_link_locked(link, b"".join(backlog))
+            self._graft_locked(lost, skip=link)
+
+    def _note_roster_locked(self, link, origin: str, epoch: int, seq: int, data: bytes, users) -> None:
+        current = self.roster_lines.get(origin)
+        if current is not None and (epoch, seq) < current[:2]:
+            return      # 比手上的舊
+        if current is None or (epoch, seq) > current[:2]:
+            self.remote_rosters[origin] = [str(u) for u in users] if isinstance(users, list) else []
+            self.roster_lines[origin] = (epoch, seq, data)
+        self.roster_via.setdefault(origin, set()).add(link)
+        self.roster_orphans.pop(origin, None)
+
+    def _expire_rosters_locked(self, now: float) -> None:
+        for origin, deadline in list(self.roster_orphans.items()):
+            if now >= deadline:
+                del self.roster_orphans[origin]
+                if not self.roster_via.get(origin):
+                    self.remote_rosters.pop(origin, None)
+                    self.roster_lines.pop(origin, None)
+
+    def _peer_hello(self) -> dict:
+        with self.lock:
+            seen = {o: list(self._fed_floor_locked(o)) for o in self.fed_seen}
+        return {"type": "peer_hello", "site": self.site, "token": self.peer_token or "", "seen": seen}
+
+    def _dial_peer_loop(self, peer: Tuple[str, int]):
+        backoff = 1.0
+        while self.running and not self.draining:
+            try:
+                raw = socket.create_connection(peer, timeout=self.HANDSHAKE_TIMEOUT)
+                if self.ping_interval > 0:
+                    tune_keepalive(raw, int(self.ping_interval), max(1, int(self.ping_interval) // 2), 3)
+                conn = self.peer_ssl_ctx.wrap_socket(raw, server_hostname=peer[0])
+                conn.sendall((json.dumps(self._peer_hello()) + "\n").encode(ENC))
+                lines = Session(conn, peer).read_lines()
+                reply = json.loads(next(lines, b"null"))
+                if not isinstance(reply, dict) or reply.get("type") != "peer_hello":
+                    raise ConnectionError(f"unexpected reply {reply!r}")
+                conn.settimeout(None)
+                backoff = 1.0
+                self._run_link(conn, lines, str(reply.get("site", "")), reply.get("seen"))
+            except Exception as err:
+                print(f"[SERVER] PEER {peer[0]}:{peer[1]} unavailable: {err}")
+            if self.running:
+                time.sleep(backoff)
+                backoff = min(30.0, backoff * 2)
+
+    def _accept_peer(self, conn, lines: Iterator[bytes], caddr, msg: dict):
+        token = str(msg.get("token", ""))
+        if not self.peer_token or not hmac.compare_digest(token.encode(ENC), self.peer_token.encode(ENC)):
+            with self.lock:
+                self.stats["peer_denied"] += 1
+            print(f"[SERVER] PEER from {caddr} denied")
+            conn.close()
+            return
+        conn.sendall((json.dumps(self._peer_hello()) + "\n").encode(ENC))
+        conn.settimeout(None)
+        self._run_link(conn, lines, str(msg.get("site", "")), msg.get("seen"))
+
+    def _run_link(self, conn, lines: Iterator[bytes], peer_site: str, peer_seen):
+        """連結建立後雙方流程相同：補送對方沒看過的訊息、交換名單，然後轉發 fed 訊息。"""
+        if not peer_site or peer_site == self.site:
+            conn.close()
+            return
+        seen = {}
+        if isinstance(peer_seen, dict):
+            for origin, pair in peer_seen.items():
+                if isinstance(pair, list) and len(pair) == 2:
+                    seen[origin] = (pair[0], pair[1])
+        with self.lock:
+            if peer_site in self.links.values():
+                conn.close()
+                return
+            self.links[conn] = peer_site
+            backlog = [
+                line for origin, epoch, seq, line in self.fed_log
+                if origin != peer_site and (epoch, seq) > seen.get(origin, (0, 0))
+            ]
+            self.stats["fed_catchup"] += len(backlog)
+            # 其他站點的名單即使對方已見過也重送：對方可能因先前的連結中斷而移除了它
+            backlog.extend(line for origin, (_, _, line) in self.roster_lines.items() if origin != peer_site)
+            try:
+                if backlog:
+                    conn.sendall(b"".join(backlog))
+            except Exception:
+                pass
+        print(f"[SERVER] LINK up {peer_site} (catch-up {len(backlog)})")
+        self._federate_roster()
+        self._broadcast({"type": "system", "text": f"已連上站點 {peer_site}", "ts": self._ts_now()})
+        try:
+            for line in lines:
+                try:
+                    msg = json.loads(line)
+                except ValueError:
+                    continue
+                if not isinstance(msg, dict):
+                    continue
+                mtype = msg.get("type")
+                if mtype == "fed":
+                    self._on_fed(conn, line, msg)
+                elif mtype == "fed_prune":
+                    with self.lock:
+                        self.fed_pruned.setdefault(conn, set()).add(str(msg.get("origin", "")))
+                elif mtype == "fed_graft":
+                    self._on_graft(conn, msg)
         except Exception:
+            pass
+        finally:
             with self.lock:
-                self._drop_client(conn)
+                self.links.pop(conn, None)
+                self.fed_pruned.pop(conn, None)
+                self.fed_prunes_sent.pop(conn, None)
+                lost = [o for o, parent in self.fed_parent.items() if parent is conn]
+                for origin in lost:
+                    del self.fed_parent[origin]
+                regraft = self.running and not self.draining and bool(self.links)
+                for origin, via in list(self.roster_via.items()):
+                    via.discard(conn)
+                    if not via:
+                        del self.roster_via[origin]
+                        if regraft:
+                            # 其他連結可能也到得了該站點，graft 的回覆會帶回名單
+                            self.roster_orphans[origin] = time.monotonic() + FED_ROSTER_GRACE
+                            lost.append(origin)
+                        else:
+                            self.remote_rosters.pop(origin, None)
+                            self.roster_lines.pop(origin, None)
+                if regraft:
+                    self._graft_locked(set(lost))
+            try:
+                conn.close()
+            except Exception:
+                pass
+            print(f"[SERVER] LINK down {peer_site}")
+            if self.running and not self.draining:
+                self._broadcast({"type": "system", "text": f"與站點 {peer_site} 的連線中斷", "ts": self._ts_now()})
+
+    def _observe(self, sess: Session, msg: dict):
+        """觀察者連線：驗證後回覆 observe_ok，之後這條執行緒只負責把串流寫給它。"""
+        conn = sess.conn
+        token = str(msg.get("token", ""))
+        if not self.observer_token or not hmac.compare_digest(token.encode(ENC), self.observer_token.encode(ENC)):
+            with self.lock:
+                self.stats["observer_denied"] += 1
+            print(f"[SERVER] OBSERVER from {sess.addr} denied")
+            return
+        from_seq = msg.get("from_seq")
+        with self.lock:
+            oldest = self.stream_seq - len(self.stream_log) + 1
+            if not isinstance(from_seq, int):
+                start = self.stream_seq + 1     # 沒指定：從下一則即時廣播開始
+            elif msg.get("epoch", self.stream_epoch) != self.stream_epoch or from_seq > self.stream_seq + 1:
+                start = oldest                  # 伺服器重啟過，舊的 seq 沒有意義
+            else:
+                start = max(from_seq, oldest)
+            self.observers[conn] = (sess, start)
+            self.stats["observers_total"] += 1
+            hello = {"type": "observe_ok", "epoch": self.stream_epoch, "next_seq": start,
+                     "oldest_seq": oldest, "latest_seq": self.stream_seq, "ts": self._ts_now()}
+        print(f"[SERVER] OBSERVER {sess.addr[0]}:{sess.addr[1]} from seq {start}")
+        try:
+            conn.sendall((json.dumps(hello) + "\n").encode(ENC))
+            if isinstance(from_seq, int) and start != from_seq:
+                self._observer_gap(conn, from_seq, start)
+            conn.settimeout(None)
+            self._observer_loop(sess, start)
+        finally:
+            with self.lock:
+                _, seq = self.observers.pop(conn, (None, start))
+            print(f"[SERVER] OBSERVER {sess.addr[0]}:{sess.addr[1]} gone before seq {seq}")
+
+    def _observer_gap(self, conn, wanted: int, start: int) -> None:
+        with self.lock:
+            self.stats["observer_gaps"] += 1
+        gap = {"type": "gap", "from_seq": wanted, "next_seq": start, "epoch": self.stream_epoch}
+        conn.sendall((json.dumps(gap) + "\n").encode(ENC))
+
+    def _observer_loop(self, sess: Session, seq: int) -> None:
+        """從 seq 起把 stream_log 批次寫出；落後超過保留量時送 gap 並跳到最舊的一則。
+
+        寫出在鎖外、由這條連線自己的執行緒做，對端讀得慢只會讓它自己落後。
+        """
+        conn = sess.conn
+        caught_up = True
+        while self.running and not self.draining:
+            with self._stream_cond:
+                if self.stream_seq < seq:
+                    self._stream_cond.wait(1.0)
+                behind = self.stream_seq - seq + 1
+                # 落後已多時立刻寫，不再等，否則一陣突發就可能超過保留量
+                linger = caught_up and behind * 4 < self.stream_log.maxlen
+            if behind <= 0:
+                if self._observer_closed(conn):
+                    return
+                continue
+            if linger:
+                time.sleep(OBSERVER_LINGER)
+            with self.lock:
+                oldest = self.stream_seq - len(self.stream_log) + 1
+                skipped = seq if seq < oldest else None
+                seq = max(seq, oldest)
+                parts = []
+                size = 0
+                for line in islice(self.stream_log, seq - oldest, None):
+                    parts.append(line)
+                    size += len(line)
+                    if size >= OBSERVER_BATCH:
+                        break
+                caught_up = size < OBSERVER_BATCH
+            if skipped is not None:
+                self._observer_gap(conn, skipped, seq)
+            conn.sendall(b"".join(parts))
+            seq += len(parts)
+            sess.msgs_out += len(parts)
+            sess.bytes_out += size
+            with self.lock:
+                self.observers[conn] = (sess, seq)
+                self.stats["observer_writes"] += 1
+                self.stats["observer_msgs"] += len(parts)
+                self.stats["observer_bytes"] += size
+
+    @staticmethod
+    def _observer_closed(conn) -> bool:
+        """觀察者不會送資料；閒置時順便檢查對端是否已關閉，避免執行緒等到下一則廣播才發現。"""
+        try:
+            if not select.select([conn], [], [], 0)[0]:
+                return False
+            conn.settimeout(1.0)
+            try:
+                return not conn.recv(BUFSZ)     # 送來的其他資料一律忽略
+            finally:
+                conn.settimeout(None)
+        except (TimeoutError, ssl.SSLWantReadError):
             return False
+        except OSError:
+            return True
+
+    def _send_to(self, conn, payload: dict) -> bool:
+        data = (json.dumps(payload) + "\n").encode(ENC)
+        # 與 _broadcast 共用鎖，避免兩個執行緒同時寫同一條 TLS 連線
+        with self.lock:
+            return self._send_locked(conn, data, LANE_OF_TYPE.get(payload.get("type"), LANE_CONTROL))
 
-    def _drop_client(self, conn):
-        info = self.clients.get(conn)
-        if info:
-            del self.clients[conn]
+    def _send_session_locked(self, conn, sess: Session, data: bytes) -> bool:
+        """沒有寫出池時的送出（持有鎖）：有執行緒正在鎖外寫這條連線時接在待送緩衝，由它寫完後接著送。"""
+        if sess.writing:
+            if sess.queue(data) > self.lane_queue_bytes:
+                self._drop_client(conn, "dropped_slow")
+                return False
+            return True
+        if sess.pending is not None and self.coalesce_s > 0:
+            # 窗口中已有廣播：接在後面維持順序，提前結束窗口，不在鎖內寫出整個緩衝
+            sess.queue(data)
+            if not self._flush_early:
+                self._flush_early = True
+                self._flush_cond.notify()
+            return True
+        sess.send(data)
+        return True
+
+    def _send_owned(self, conn, data: bytes) -> bool:
+        """取得該連線的寫出權後在鎖外 sendall，慢的接收者只卡住呼叫端，不拖住全域鎖與其他連線。
+
+        已在待送緩衝的資料排在 data 之前；寫出期間別人送來的由 _write_owned 接著送出。
+        """
+        with self._drained_cond:
+            while True:
+                sess = self.clients.get(conn)
+                if sess is None:
+                    return False
+                if not sess.writing:
+                    break
+                self._drained_cond.wait(0.5)
+            if sess.pending:
+                data = bytes(sess.pending) + data
+                sess.pending = None
+            sess.writing = time.monotonic()
+            self._writing.add(sess)
+        return self._write_owned(sess, data)
+
+    def _write_owned(self, sess: Session, data: bytes) -> bool:
+        """呼叫端已設好 sess.writing：在鎖外寫出 data 與期間排入的緩衝，完成後交還寫出權。
+
+        卡住超過 write_timeout 時由 _write_watchdog_loop shutdown 連線，sendall 隨即失敗返回。
+        """
+        conn = sess.conn
+        while True:
             try:
-                conn.close()
+                conn.sendall(data)
+                ok = True
             except Exception:
+                ok = False
+            with self.lock:
+                if ok:
+                    sess.bytes_out += len(data)
+                    if sess.pending:
+                        data, sess.pending = bytes(sess.pending), None
+                        sess.writing = time.monotonic()
+                        continue
+                sess.writing = 0.0
+                self._writing.discard(sess)
+                self._drained_cond.notify_all()
+                if not ok:
+                    self._drop_client(conn)
+                return ok
+
+    def _send_locked(self, conn, data: bytes, lane: int = LANE_CONTROL) -> bool:
+        sess = self.clients.get(conn)
+        try:
+            if sess is not None and self.writer_threads:
+                return self._enqueue_locked(conn, sess, lane, data)
+            if sess is not None:
+                return self._send_session_locked(conn, sess, data)
+            else:
+                conn.sendall(data)      # 尚未 join（rename 之前）或已移除
+            return True
+        except Exception:
+            self._drop_client(conn)
+            return False
+
+    def _register(self, sess: Session, name: str) -> str:
+        """登記連線並回傳實際使用的名稱；重名時加上 #2、#3… 以維持 by_name 唯一。"""
+        with self.lock:
+            reserved = ()
+            if self._resume_tokens:
+                # 交接後尚未重連的使用者保留原名稱
+                reserved = self._resuming_names_locked()
+                if not reserved:
+                    self._resume_tokens.clear()
+            unique = name
+            n = 2
+            while unique in self.by_name or unique in reserved:
+                unique = f"{name}#{n}"
+                n += 1
+            sess.name = unique
+            sess.last_ping = sess.last_seen = time.monotonic()
+            self.clients[sess.conn] = sess
+            self.by_name[unique] = sess.conn
+        return unique
+
+    def _unregister(self, conn) -> None:
+        self._dirty.pop(conn, None)
+        sess = self.clients.pop(conn, None)
+        if sess and self.by_name.get(sess.name) is conn:
+            del self.by_name[sess.name]
+        if sess and sess.lane_bytes:
+            self._lane_counted -= min(sess.lane_bytes, LANE_SHARE)
+            self._lane_queued -= sess.discard()
+
+    def _send_dm(self, conn, sender: str, msg: dict) -> bool:
+        target = str(msg.get("to", "")).strip()
+        payload = {
+            "type": "dm",
+            "from": sender,
+            "to": target,
+            "text": msg.get("text", ""),
+            "ts": self._ts_now()
+        }
+        with self.lock:
+            delivered = self._deliver_dm_locked(payload)
+            if not delivered and self._handing_off:
+                # 收件人已重連到新程序
+                self._relay_locked(payload, "relay_dm")
+                delivered = True
+            elif not delivered and self._predecessor_out is not None and target in self._resuming_names_locked():
+                # 收件人還連在排空中的舊程序
+                self._queue_predecessor_locked((json.dumps({"type": "relay_dm", "payload": payload}) + "\n").encode(ENC))
+                delivered = True
+        if not delivered:
+            if not self._send_to(conn, {
+                "type": "system",
+                "text": f"使用者 {target} 不在線上",
+                "ts": self._ts_now()
+            }):
+                return False
+        msg_id = msg.get("id")
+        if isinstance(msg_id, int):
+            return self._send_to(conn, {"type": "ack", "id": msg_id})
+        return True
+
+    def _deliver_dm(self, payload: dict) -> bool:
+        with self.lock:
+            return self._deliver_dm_locked(payload)
+
+    def _deliver_dm_locked(self, payload: dict) -> bool:
+        dest = self.by_name.get(payload.get("to"))
+        if dest is None:
+            return False
+        self._send_locked(dest, (json.dumps(payload) + "\n").encode(ENC), LANE_CHAT)
+        return True
+
+    def _resuming_names_locked(self) -> Set[str]:
+        now = time.monotonic()
+        return {n for n, deadline in self._resume_tokens.values() if deadline > now}
+
+    def _handle_admin(self, conn, name: str, msg: dict) -> bool:
+        token = str(msg.get("token", ""))
+        if not self.admin_token or not hmac.compare_digest(token.encode(ENC), self.admin_token.encode(ENC)):
+            with self.lock:
+                self.stats["admin_denied"] += 1
+            result = "admin 指令未啟用或 token 錯誤"
+        else:
+            cmd = msg.get("cmd")
+            print(f"[SERVER] ADMIN {name} {cmd}")
+            if cmd == "profile":
+                result = self.diag.toggle_profile()
+            elif cmd == "memsnap":
+                result = self.diag.snapshot_memory()
+            elif cmd == "stats":
+                result = self._stats_line()
+            elif cmd == "memory":
+                result = self._memory_report()
+            elif cmd == "coalesce":
+                result = self._coalesce_report()
+            elif cmd == "lanes":
+                result = self._lanes_report()
+            elif cmd == "observers":
+                result = self._observers_report()
+            else:
+                result = f"未知的 admin 指令: {cmd}"
+        return self._send_to(conn, {"type": "system", "text": result, "ts": self._ts_now()})
+
+    def _file_offer(self, sess: Session, msg: dict) -> bool:
+        xfer = msg.get("xfer")
+        name = os.path.basename(str(msg.get("name", "")).replace("\\", "/")).strip()
+        size = msg.get("size")
+        reason = None
+        if not isinstance(xfer, int) or not name or not isinstance(size, int) or size < 0:
+            reason = "檔案資訊不完整"
+        elif size > self.max_file_bytes:
+            reason = f"檔案超過上限 {self.max_file_bytes // 1048576} MiB"
+        elif self._handing_off:
+            reason = "伺服器更新中，請在重新連線後再傳"
+        else:
+            evicted = []
+            with self.lock:
+                need = self.spool_bytes + size - self.spool_limit_bytes
+                if need > 0:
+                    evicted = self._evict_files_locked(need)
+                if need > 0 and not evicted:
+                    reason = "伺服器暫存空間已滿"
+                else:
+                    self.spool_bytes += size    # 先預留，失敗或中斷時退回
+                    file_id = secrets.token_hex(4)
+                    while file_id in self.files:
+                        file_id = secrets.token_hex(4)
+            for fid, info in evicted:
+                print(f"[SERVER] FILE evicted {info['name']} {info['size']}B id={fid}")
+                try:
+                    os.unlink(info["path"])
+                except OSError:
+                    pass
+        if reason is None:
+            path = os.path.join(self.spool_dir, file_id + ".part")
+            try:
+                f = open(path, "wb")
+            except OSError as err:
+                with self.lock:
+                    self.spool_bytes -= size
+                reason = f"無法建立暫存檔: {err}"
+        if reason is not None:
+            return self._send_to(sess.conn, {"type": "file_reject", "xfer": xfer, "reason": reason})
+        if sess.uploads is None:
+            sess.uploads = {}
+        sess.uploads[xfer] = Upload(file_id, name, size, path, f)
+        return self._send_to(sess.conn, {"type": "file_accept", "xfer": xfer, "id": file_id})
+
+    def _evict_files_locked(self, need: int) -> List[Tuple[str, dict]]:
+        """從最久沒被下載的已完成檔案開始移出清單，直到騰出 need bytes；不夠騰出時一個都不移。
+
+        下載中的檔案不動。回傳移出的 (file_id, info)，由呼叫端在鎖外刪檔。
+        """
+        victims = []
+        freed = 0
+        for fid, info in self.files.items():
+            if freed >= need:
+                break
+            if not self._streaming[fid]:
+                victims.append(fid)
+                freed += info["size"]
+        if freed < need:
+            return []
+        self.spool_bytes -= freed
+        self.stats["files_evicted"] += len(victims)
+        return [(fid, self.files.pop(fid)) for fid in victims]
+
+    def _file_chunk(self, sess: Session, msg: dict) -> bool:
+        xfer = msg.get("xfer")
+        up = sess.uploads.get(xfer) if sess.uploads else None
+        if up is None:
+            return True     # 已被拒絕或中止的傳送，剩下的分塊直接丟棄
+        try:
+            data = base64.b64decode(str(msg.get("data", "")), validate=True)
+        except ValueError:
+            return self._abort_upload(sess, xfer, "分塊格式錯誤")
+        if msg.get("seq") != up.seq or up.received + len(data) > up.size:
+            return self._abort_upload(sess, xfer, "分塊順序或大小不符")
+        try:
+            up.f.write(data)
+        except OSError as err:
+            return self._abort_upload(sess, xfer, f"寫入暫存檔失敗: {err}")
+        up.sha.update(data)
+        up.received += len(data)
+        up.seq += 1
+        return True
+
+    def _file_end(self, sess: Session, msg: dict) -> bool:
+        xfer = msg.get("xfer")
+        up = sess.uploads.get(xfer) if sess.uploads else None
+        if up is None:
+            return True
+        sha256 = up.sha.hexdigest()
+        if up.received != up.size or msg.get("sha256") != sha256:
+            return self._abort_upload(sess, xfer, "檔案大小或 SHA-256 不符")
+        if self._handing_off:
+            # 檔案清單已交給新程序，這裡完成的檔案它看不到
+            return self._abort_upload(sess, xfer, "伺服器更新中，請在重新連線後重新傳送")
+        del sess.uploads[xfer]
+        final = up.path[:-len(".part")]
+        try:
+            up.f.close()
+            os.replace(up.path, final)
+        except OSError as err:
+            sess.uploads[xfer] = up
+            return self._abort_upload(sess, xfer, f"儲存檔案失敗: {err}")
+        with self.lock:
+            self.files[up.file_id] = {"name": up.name, "size": up.size, "sha256": sha256,
+                                      "from": sess.name, "path": final}
+            self.stats["files_uploaded"] += 1
+            self.stats["file_bytes_in"] += up.size
+        print(f"[SERVER] FILE {sess.name} {up.name} {up.size}B id={up.file_id}")
+        # 只在本站廣播：檔案存在這台伺服器的暫存目錄，其他站點無法 /get
+        self._broadcast({
+            "type": "file",
+            "id": up.file_id,
+            "from": sess.name,
+            "name": up.name,
+            "size": up.size,
+            "ts": self._ts_now()
+        })
+        return True
+
+    def _abort_upload(self, sess: Session, xfer, reason: Optional[str] = None) -> bool:
+        up = sess.uploads.pop(xfer, None) if sess.uploads else None
+        if up is None:
+            return True
+        try:
+            up.f.close()
+            os.unlink(up.path)
+        except OSError:
+            pass
+        with self.lock:
+            self.spool_bytes -= up.size
+            self.stats["files_aborted"] += 1
+        if reason is None:
+            return True
+        return self._send_to(sess.conn, {"type": "file_reject", "xfer": xfer, "reason": reason})
+
+    def _file_get(self, sess: Session, msg: dict) -> bool:
+        """一條連線同時只串流一個檔案，其餘排進 sess.downloads；執行緒數因此受連線上限約束。"""
+        file_id = str(msg.get("id", ""))
+        start = False
+        with self.lock:
+            if file_id not in self.files:
+                text = f"找不到檔案 {file_id}"
+            elif sess.downloads is None:
+                sess.downloads = deque([file_id])
+                start = True
+            elif len(sess.downloads) >= FILE_GET_QUEUE:
+                self.stats["file_gets_rejected"] += 1
+                text = f"已有 {FILE_GET_QUEUE} 個下載在排隊，請等目前的下載完成"
+            else:
+                sess.downloads.append(file_id)
+                text = f"檔案 {file_id} 已排入下載佇列"
+        if start:
+            threading.Thread(target=self._download_loop, args=(sess,), daemon=True).start()
+            return True
+        return self._send_to(sess.conn, {"type": "system", "text": text, "ts": self._ts_now()})
+
+    def _download_loop(self, sess: Session) -> None:
+        conn = sess.conn
+        while True:
+            with self.lock:
+                if not sess.downloads or conn not in self.clients:
+                    sess.downloads = None
+                    return
+                file_id = sess.downloads.popleft()
+                info = self.files.pop(file_id, None)
+                if info is not None:
+                    self.files[file_id] = info      # 移到最後：最近下載過的最晚被清出
+                    self._streaming[file_id] += 1
+            if info is None:
+                self._send_to(conn, {"type": "system", "text": f"找不到檔案 {file_id}", "ts": self._ts_now()})
+                continue
+            try:
+                self._stream_file(conn, file_id, info)
+            finally:
+                with self.lock:
+                    self._streaming[file_id] -= 1
+                    if self._streaming[file_id] <= 0:
+                        del self._streaming[file_id]
+
+    def _stream_file(self, conn, file_id: str, info: dict) -> None:
+        """逐塊讀檔送出，聊天訊息可以插在分塊之間。
+
+        有寫出池時依該連線的待送量逐塊排入；沒有時每塊以 _send_owned 在鎖外寫出，期間的廣播
+        排在該連線的緩衝、下一塊之前送出，下載者讀得慢不會拖住全域鎖。
+        """
+        start = {"type": "file_start", "id": file_id, "name": info["name"], "size": info["size"], "from": info["from"]}
+        if not self._send_to(conn, start):
+            return
+        seq = 0
+        try:
+            with open(info["path"], "rb") as f:
+                while True:
+                    chunk = f.read(FILE_CHUNK)
+                    if not chunk:
+                        break
+                    payload = {
+                        "type": "file_data",
+                        "id": file_id,
+                        "seq": seq,
+                        "data": base64.b64encode(chunk).decode("ascii")
+                    }
+                    if self.writer_threads:
+                        if not self._wait_lane_room(conn) or not self._send_to(conn, payload):
+                            return
+                    elif not self._send_owned(conn, (json.dumps(payload) + "\n").encode(ENC)):
+                        return
+                    seq += 1
+                    time.sleep(0)   # 讓出 GIL，避免連續搶到鎖
+        except OSError as err:
+            self._send_to(conn, {"type": "file_error", "id": file_id, "reason": str(err)})
+            return
+        with self.lock:
+            self.stats["file_bytes_out"] += info["size"]
+        self._send_to(conn, {"type": "file_done", "id": file_id, "size": info["size"], "sha256": info["sha256"]})
+
+    def _send_roster(self, conn):
+        with self.lock:
+            users = sorted(sess.name for sess in self.clients.values())
+            for site, names in sorted(self.remote_rosters.items()):
+                users.extend(f"{n}@{site}" for n in names)
+        return self._send_to(conn, {
+            "type": "roster",
+            "users": users,
+            "ts": self._ts_now()
+        })
+
+    def _drop_client(self, conn, stat: str = "dropped_on_send"):
+        """寫出失敗或待送超量時呼叫（持有鎖）：立即停止對它送出，關閉交給該連線的讀取執行緒。
+
+        這裡若直接 close，fd 號碼可能馬上被新連線重用，而讀取執行緒還在同一個號碼上 recv；
+        shutdown 只會讓它醒來，由 _handle_client 的 finally 做唯一一次清理。
+        """
+        if conn in self.clients:
+            self._unregister(conn)
+            self.stats[stat] += 1
+            try:
+                conn.shutdown(socket.SHUT_RDWR)
+            except OSError:
                 pass
 
-    def _handle_client(self, conn: socket.socket, caddr):
-        f = conn.makefile("r", encoding=ENC, newline="\n")
+    def _handle_client(self, sess: Session):
+        conn, caddr = sess.conn, sess.addr
+        lines = sess.read_lines()
         name = None
         try:
             # 等待 JOIN
-            line = f.readline()
-            if not line:
+            line = next(lines, None)
+            if line is None:
                 conn.close()
                 return
             msg = json.loads(line)
+            if self.draining and msg.get("type") in ("peer_hello", "observe"):
+                conn.close()        # 交出監聽 socket 前最後 accept 到的：對端會重試，連到新程序
+                return
+            if msg.get("type") == "peer_hello":
+                self._accept_peer(conn, lines, caddr, msg)
+                return
+            if msg.get("type") == "observe":
+                self._observe(sess, msg)
+                return
             if msg.get("type") != "join" or "name" not in msg:
                 conn.close()
                 return
-            name = str(msg["name"]).strip() or f"{caddr[0]}:{caddr[1]}"
-
-            with self.lock:
-                self.clients[conn] = {"name": name, "addr": caddr}
-
-            # 系統訊息：有人加入
-            self._broadcast({
-                "type": "system",
-                "text": f"{name} joined",
+            if self.draining:
+                # 交出監聽 socket 前最後幾個 accept 到的連線：直接請它改連新程序
+                self._send_reconnect(conn, 0, None)
+                return
+            resumed = self._claim_resume(msg.get("resume"))
+            requested = resumed or str(msg["name"]).strip() or f"{caddr[0]}:{caddr[1]}"
+            name = self._register(sess, requested)
+            if name != requested and not self._send_to(conn, {
+                "type": "rename",
+                "name": name,
                 "ts": self._ts_now()
-            })
+            }):
+                return
+
+            # 系統訊息：有人加入（交接後重連的不再廣播）
+            if not resumed:
+                self._publish({
+                    "type": "system",
+                    "text": f"{name} joined",
+                    "ts": self._ts_now()
+                })
+            self._federate_roster()
 
             if not self._send_roster(conn):
                 return
 
-            # 收訊息迴圈
-            for line in f:
+            # join 後改由心跳執行緒判斷存活，讀取不設逾時
+            conn.settimeout(None)
+
+            # 收訊息迴圈（last_seen 由 read_lines 在收到資料時更新）
+            for line in lines:
                 try:
                     msg = json.loads(line)
-                except json.JSONDecodeError:
+                except ValueError:
                     continue
 
                 mtype = msg.get("type")
@@ -139,31 +2279,77 @@ class ChatServer:
                         "text": text,
                         "ts": self._ts_now()
                     }
-                    self._broadcast(payload)
+                    self._publish(payload)
+                    msg_id = msg.get("id")
+                    if isinstance(msg_id, int):
+                        if not self._send_to(conn, {"type": "ack", "id": msg_id}):
+                            break
+                elif mtype == "dm":
+                    if not self._send_dm(conn, name, msg):
+                        break
+                elif mtype == "admin":
+                    if not self._handle_admin(conn, name, msg):
+                        break
+                elif mtype == "ping":
+                    if not self._send_to(conn, {"type": "pong", "ts": self._ts_now()}):
+                        break
                 elif mtype == "leave":
                     break
                 elif mtype == "list":
                     if not self._send_roster(conn):
                         break
+                elif mtype == "file_offer":
+                    if not self._file_offer(sess, msg):
+                        break
+                elif mtype == "file_chunk":
+                    if not self._file_chunk(sess, msg):
+                        break
+                elif mtype == "file_end":
+                    if not self._file_end(sess, msg):
+                        break
+                elif mtype == "file_get":
+                    if not self._file_get(sess, msg):
+                        break
 
+        except TimeoutError:
+            with self.lock:
+                self.stats["join_timeout"] += 1
         except Exception:
             pass
         finally:
             # 離開
+            for xfer in list(sess.uploads or ()):
+                self._abort_upload(sess, xfer)
             with self.lock:
-                if conn in self.clients:
-                    del self.clients[conn]
+                self._unregister(conn)
+                if sess.scheduled:
+                    self._ready.remove(sess)
+                    sess.scheduled = False
+                if sess.urgent:
+                    self._ready_urgent.remove(sess)
+                    sess.urgent = False
+                if sess.writing:
+                    # 寫出執行緒還在這條連線上 sendall：先讓它失敗返回，close 之後 fd 才可能被重用
+                    try:
+                        conn.shutdown(socket.SHUT_RDWR)
+                    except OSError:
+                        pass
+                    while sess.writing:
+                        self._drained_cond.wait()
             try:
                 conn.close()
             except Exception:
                 pass
+            if name and self.draining:
+                name = None     # 改連新程序，不是離開
             if name:
                 print(f"[SERVER] LEAVE {name}")
-                self._broadcast({
+                self._publish({
                     "type": "system",
                     "text": f"{name} left",
                     "ts": self._ts_now()
                 })
+                self._federate_roster()
                 
     @staticmethod
     def _ts_now():
@@ -174,10 +2360,114 @@ def main():
     ap = argparse.ArgumentParser()
     ap.add_argument("--host", default="0.0.0.0", help="bind host (default: 0.0.0.0)")
     ap.add_argument("--port", type=int, default=5050, help="port (default: 5050)")
-    ap.add_argument("--cert", required=True, help="path to TLS certificate (PEM)")
-    ap.add_argument("--key", required=True, help="path to TLS private key (PEM)")
+    ap.add_argument("--cert", help="path to TLS certificate (PEM); omit to serve only plaintext listeners")
+    ap.add_argument("--key", help="path to TLS private key (PEM)")
+    ap.add_argument("--unix", metavar="PATH", help="also listen in plaintext on this Unix socket (for a local TLS terminator)")
+    ap.add_argument("--plain-port", type=int, default=0, help="also listen in plaintext on 127.0.0.1:PORT (for a local TLS terminator)")
+    ap.add_argument("--proxy-protocol", action="store_true", help="require a PROXY protocol v1/v2 header on plaintext listeners")
+    ap.add_argument("--max-conns", type=int, default=1000, help="max concurrent connections, 0 = unlimited (default: 1000)")
+    ap.add_argument("--max-conns-per-ip", type=int, default=20, help="max concurrent connections per source IP (TLS, or plaintext with --proxy-protocol), 0 = unlimited (default: 20)")
+    ap.add_argument("--backlog", type=int, default=128, help="listen() accept backlog (default: 128)")
+    ap.add_argument("--max-handshakes", type=int, default=64, help="max TLS handshakes in progress, 0 = unlimited (default: 64)")
+    ap.add_argument("--busy-retry-after", type=int, default=5, help="seconds clients are told to wait when rejected (default: 5)")
+    ap.add_argument("--stats-interval", type=float, default=0.0, help="print stats every N seconds, 0 = only on shutdown (default: 0)")
+    ap.add_argument("--ping-interval", type=float, default=20.0, help="ping clients idle for N seconds, 0 = disable heartbeats (default: 20)")
+    ap.add_argument("--ping-timeout", type=float, default=60.0, help="drop clients silent for N seconds, 0 = never (default: 60)")
+    ap.add_argument("--admin-token", help="enable admin messages (profile/memsnap/stats) authenticated by this token")
+    ap.add_argument("--diag-dir", default=".", help="directory for profile and tracemalloc reports (default: .)")
+    ap.add_argument("--site", help="name of this site in a federation (default: host:port)")
+    ap.add_argument("--peer", action="append", default=[], metavar="HOST:PORT", help="federate with another server (repeatable)")
+    ap.add_argument("--peer-token", help="shared secret required on federation links")
+    ap.add_argument("--peer-ca", help="CA certificate to verify peer servers (default: no verification)")
+    ap.add_argument("--fed-buffer", type=int, default=1000, help="federated messages kept for link catch-up (default: 1000)")
+    ap.add_argument("--spool-dir", help="keep shared files here (default: a temporary directory removed on exit)")
+    ap.add_argument("--max-file-mb", type=int, default=100, help="largest file accepted by /send in MiB (default: 100)")
+    ap.add_argument("--spool-limit-mb", type=int, default=1024, help="total size of shared files kept in MiB (default: 1024)")
+    ap.add_argument("--coalesce-ms", type=float, default=0.0,
+                    help="batch broadcasts for up to N ms and flush them as one write per client, 0 = off (default: 0)")
+    ap.add_argument("--coalesce-bytes", type=int, default=64 * 1024,
+                    help="flush a client's batch early once it reaches N bytes (default: 65536)")
+    ap.add_argument("--writer-threads", type=int, default=0,
+                    help="write through N writer threads with control/presence/chat priority lanes, 0 = off (default: 0)")
+    ap.add_argument("--starve-ms", type=float, default=200.0,
+                    help="with --writer-threads, let a lower lane go first once its oldest message waited N ms (default: 200)")
+    ap.add_argument("--lane-queue-kb", type=int, default=4096,
+                    help="with --writer-threads, drop a client whose unsent data exceeds N KiB (default: 4096)")
+    ap.add_argument("--write-timeout", type=float, default=10.0,
+                    help="drop a client whose write (writer pool, file download or coalesced flush) has been blocked for N seconds, 0 = never (default: 10)")
+    ap.add_argument("--observer-token", help="accept read-only observer connections (exporters) authenticated by this token")
+    ap.add_argument("--stream-buffer", type=int, default=10000,
+                    help="broadcasts kept for observers resuming from a seq (default: 10000)")
+    ap.add_argument("--handoff", metavar="PATH",
+                    help="wait on this Unix socket for a successor started with --takeover (zero-downtime restart)")
+    ap.add_argument("--takeover", metavar="PATH",
+                    help="start by taking over the listeners and state of the server waiting on PATH")
+    ap.add_argument("--drain-spread", type=float, default=5.0,
+                    help="after a handoff, spread client reconnects over N seconds (default: 5)")
+    ap.add_argument("--drain-timeout", type=float, default=30.0,
+                    help="after a handoff, close remaining clients after N seconds (default: 30)")
+    ap.add_argument("--thread-stack-kb", type=int, default=0, help="stack size of per-connection threads in KiB, 0 = system default (default: 0)")
     args = ap.parse_args()
-    ChatServer(args.host, args.port, args.cert, args.key).start()
+    peers = []
+    for spec in args.peer:
+        host, sep, port = spec.rpartition(":")
+        if not sep or not port.isdigit():
+            ap.error(f"--peer 格式應為 HOST:PORT：{spec}")
+        peers.append((host, int(port)))
+    if peers and not args.peer_token:
+        ap.error("使用 --peer 時必須指定 --peer-token")
+    if bool(args.cert) != bool(args.key):
+        ap.error("--cert 與 --key 必須同時指定")
+    if not args.cert and not args.unix and not args.plain_port:
+        ap.error("需要 --cert/--key，或以 --unix、--plain-port 開啟明文端點")
+    if args.unix and not hasattr(socket, "AF_UNIX"):
+        ap.error("此平台不支援 Unix socket，請改用 --plain-port")
+    if (args.handoff or args.takeover) and not hasattr(socket, "send_fds"):
+        ap.error("此平台無法在程序間傳遞 socket，不支援 --handoff／--takeover")
+    if args.writer_threads and args.coalesce_ms:
+        ap.error("--writer-threads 與 --coalesce-ms 不能同時使用")
+    if args.drain_spread >= args.drain_timeout:
+        ap.error("--drain-spread 必須小於 --drain-timeout")
+    ChatServer(
+        args.host,
+        args.port,
+        args.cert,
+        args.key,
+        max_conns=args.max_conns,
+        max_conns_per_ip=args.max_conns_per_ip,
+        backlog=args.backlog,
+        max_handshakes=args.max_handshakes,
+        busy_retry_after=args.busy_retry_after,
+        stats_interval=args.stats_interval,
+        ping_interval=args.ping_interval,
+        ping_timeout=args.ping_timeout,
+        admin_token=args.admin_token,
+        diag_dir=args.diag_dir,
+        site=args.site,
+        peers=peers,
+        peer_token=args.peer_token,
+        peer_ca=args.peer_ca,
+        fed_buffer=args.fed_buffer,
+        thread_stack_kb=args.thread_stack_kb,
+        unix_path=args.unix,
+        plain_port=args.plain_port,
+        proxy_protocol=args.proxy_protocol,
+        spool_dir=args.spool_dir,
+        max_file_mb=args.max_file_mb,
+        spool_limit_mb=args.spool_limit_mb,
+        coalesce_ms=args.coalesce_ms,
+        coalesce_bytes=args.coalesce_bytes,
+        handoff_path=args.handoff,
+        takeover_path=args.takeover,
+        drain_spread=args.drain_spread,
+        drain_timeout=args.drain_timeout,
+        writer_threads=args.writer_threads,
+        starve_ms=args.starve_ms,
+        lane_queue_kb=args.lane_queue_kb,
+        write_timeout=args.write_timeout,
+        observer_token=args.observer_token,
+        stream_buffer=args.stream_buffer,
+    ).start()
 
 if __name__ == "__main__":
     main()
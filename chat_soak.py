@@ -0,0 +1,421 @@
+# chat_soak.py
+# 長時間浸泡測試：在本程序內啟動 ChatServer，反覆連線／join／聊天／異常斷線，
+# 定期在流量靜止時取樣 RSS、執行緒、fd 與 tracemalloc，成長超過門檻即以結束碼 1 失敗
+import argparse
+import json
+import os
+import random
+import selectors
+import socket
+import ssl
+import struct
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from typing import Dict, List, Optional
+
+from chat_server import LANE_SHARE, ChatServer, current_rss
+
+ENC = "utf-8"
+_out = sys.stdout   # 伺服器的 print 預設導向 /dev/null，報告一律寫到這裡
+
+
+def log(msg: str) -> None:
+    _out.write(f"[SOAK] {msg}\n")
+    _out.flush()
+
+
+def open_fds() -> Optional[int]:
+    try:
+        return len(os.listdir("/proc/self/fd"))
+    except OSError:
+        return None     # 非 Linux
+
+
+class Churn:
+    """多個工作執行緒輪流執行各種連線情境；pause() 等所有情境做完、伺服器回收完畢後才回傳。"""
+
+    SCENARIOS = {
+        "graceful": 4,      # join、聊天、leave、讀到伺服器關閉
+        "abrupt": 3,        # join、聊天後 RST（不讀完收到的廣播，伺服器寫出時會失敗）
+        "vanish": 2,        # join 後直接關閉，不送 leave
+        "prejoin": 1,       # 完成 TLS 但不 join
+        "no_tls": 1,        # 只建 TCP，不握手就關閉
+        "garbage": 1,       # join 後送非 JSON 與缺欄位的訊息
+    }
+
+    def __init__(self, port: int, workers: int, seed: int) -> None:
+        self.port = port
+        self.ctx = ssl.create_default_context()
+        self.ctx.check_hostname = False
+        self.ctx.verify_mode = ssl.CERT_NONE
+        self.counts: Counter = Counter()
+        self.errors: Counter = Counter()
+        self._workers = workers
+        self._seed = seed
+        self._cond = threading.Condition()
+        self._paused = False
+        self._busy = 0
+        self._stop = False
+        self._threads: List[threading.Thread] = []
+        names, weights = zip(*self.SCENARIOS.items())
+        self._names = list(names)
+        self._weights = list(weights)
+
+    def start(self) -> None:
+        for i in range(self._workers):
+            t = threading.Thread(target=self._worker, args=(random.Random(self._seed + i), i),
+                                 name=f"churn-{i}", daemon=True)
+            t.start()
+            self._threads.append(t)
+
+    def pause(self) -> None:
+        with self._cond:
+            self._paused = True
+            while self._busy:
+                self._cond.wait()
+
+    def resume(self) -> None:
+        with self._cond:
+            self._paused = False
+            self._cond.notify_all()
+
+    def stop(self) -> None:
+        with self._cond:
+            self._stop = True
+            self._paused = False
+            self._cond.notify_all()
+        for t in self._threads:
+            t.join(10)
+
+    def _worker(self, rng: random.Random, wid: int) -> None:
+        n = 0
+        while True:
+            with self._cond:
+                while self._paused and not self._stop:
+                    self._cond.wait()
+                if self._stop:
+                    return
+                self._busy += 1
+            kind = rng.choices(self._names, self._weights)[0]
+            try:
+                getattr(self, f"_{kind}")(f"soak{wid}-{n}", rng)
+                self.counts[kind] += 1
+            except (OSError, ValueError) as err:
+                self.errors[f"{kind}:{type(err).__name__}"] += 1
+            finally:
+                n += 1
+                with self._cond:
+                    self._busy -= 1
+                    self._cond.notify_all()
+
+    # --- 情境 ---
+
+    def _connect(self, tls: bool = True) -> socket.socket:
+        raw = socket.create_connection(("127.0.0.1", self.port), timeout=10)
+        return self.ctx.wrap_socket(raw) if tls else raw
+
+    def _join(self, name: str) -> socket.socket:
+        conn = self._connect()
+        conn.sendall(self._line({"type": "join", "name": name}))
+        if not conn.recv(65536):
+            raise ConnectionError("closed before join reply")
+        return conn
+
+    @staticmethod
+    def _line(obj: dict) -> bytes:
+        return (json.dumps(obj) + "\n").encode(ENC)
+
+    def _chat(self, conn: socket.socket, rng: random.Random) -> None:
+        for i in range(rng.randint(1, 3)):
+            conn.sendall(self._line({"type": "chat", "text": "x" * rng.randint(1, 400), "id": i}))
+
+    @staticmethod
+    def _reset(conn: socket.socket) -> None:
+        # SO_LINGER 0：close 時送 RST 而不是 FIN，模擬斷網或程序被殺
+        raw = conn.detach() if isinstance(conn, ssl.SSLSocket) else conn
+        sock = raw if isinstance(raw, socket.socket) else socket.socket(fileno=raw)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack("ii", 1, 0))
+        sock.close()
+
+    def _graceful(self, name: str, rng: random.Random) -> None:
+        conn = self._join(name)
+        self._chat(conn, rng)
+        conn.sendall(self._line({"type": "leave"}))
+        try:
+            while conn.recv(65536):
+                pass
+        except OSError:
+            pass
+        conn.close()
+
+    def _abrupt(self, name: str, rng: random.Random) -> None:
+        conn = self._join(name)
+        self._chat(conn, rng)
+        time.sleep(rng.uniform(0, 0.05))
+        self._reset(conn)
+
+    def _vanish(self, name: str, rng: random.Random) -> None:
+        conn = self._join(name)
+        if rng.random() < 0.5:
+            self._chat(conn, rng)
+        conn.close()
+
+    def _prejoin(self, name: str, rng: random.Random) -> None:
+        conn = self._connect()
+        time.sleep(rng.uniform(0, 0.05))
+        conn.close()
+
+    def _no_tls(self, name: str, rng: random.Random) -> None:
+        conn = self._connect(tls=False)
+        if rng.random() < 0.5:
+            conn.sendall(b"GET / HTTP/1.0\r\n\r\n")
+        self._reset(conn)
+
+    def _garbage(self, name: str, rng: random.Random) -> None:
+        conn = self._join(name)
+        conn.sendall(b"not json\n{\"type\": \"dm\"}\n{\"type\": \"file_chunk\", \"xfer\": 9}\n[1, 2]\n")
+        conn.sendall(self._line({"type": "leave"}))
+        conn.close()
+
+
+class Residents:
+    """常駐連線：整段測試期間保持在線並讀掉所有廣播，讓扇出路徑一直有對象。"""
+
+    def __init__(self, port: int, n: int) -> None:
+        ctx = ssl.create_default_context()
+        ctx.check_hostname = False
+        ctx.verify_mode = ssl.CERT_NONE
+        self.sel = selectors.DefaultSelector()
+        self.conns = []
+        for i in range(n):
+            conn = ctx.wrap_socket(socket.create_connection(("127.0.0.1", port)))
+            conn.sendall((json.dumps({"type": "join", "name": f"resident{i}"}) + "\n").encode(ENC))
+            conn.setblocking(False)
+            self.sel.register(conn, selectors.EVENT_READ)
+            self.conns.append(conn)
+        self.bytes_in = 0
+        self._running = True
+        self._thread = threading.Thread(target=self._loop, name="residents", daemon=True)
+        self._thread.start()
+
+    def _loop(self) -> None:
+        while self._running:
+            for key, _ in self.sel.select(timeout=0.2):
+                while True:
+                    try:
+                        chunk = key.fileobj.recv(65536)
+                    except (ssl.SSLWantReadError, BlockingIOError):
+                        break
+                    except OSError:
+                        chunk = b""
+                    if not chunk:
+                        self.sel.unregister(key.fileobj)
+                        break
+                    self.bytes_in += len(chunk)
+
+    def close(self) -> None:
+        self._running = False
+        self._thread.join(2)
+        for conn in self.conns:
+            conn.close()
+
+
+def server_invariants(server: ChatServer, residents: int) -> List[str]:
+    """流量靜止後伺服器內部應有的狀態；任何不符都代表清理不完整。"""
+    problems = []
+    with server.lock:
+        if server.active != residents:
+            problems.append(f"active={server.active}（預期 {residents}）")
+        if len(server.clients) != residents or len(server.by_name) != residents:
+            problems.append(f"clients={len(server.clients)} by_name={len(server.by_name)}（預期 {residents}）")
+        if sum(server.per_ip.values()) != server.active:
+            problems.append(f"per_ip 合計 {sum(server.per_ip.values())} != active {server.active}")
+        if set(server._dirty) - set(server.clients):
+            problems.append(f"{len(set(server._dirty) - set(server.clients))} 個已移除的連線仍在待送清單")
+        queued = sum(s.lane_bytes for s in server.clients.values())
+        if server._lane_queued != queued:
+            problems.append(f"_lane_queued={server._lane_queued} 與各連線待送合計 {queued} 不符")
+        counted = sum(min(s.lane_bytes, LANE_SHARE) for s in server.clients.values())
+        if server._lane_counted != counted:
+            problems.append(f"_lane_counted={server._lane_counted} 與各連線計入量合計 {counted} 不符")
+        if server._writing:
+            problems.append(f"流量靜止後仍有 {len(server._writing)} 個寫出進行中")
+        stale = [s for s in list(server._ready) + list(server._ready_urgent) if s.conn not in server.clients]
+        if stale:
+            problems.append(f"{len(stale)} 個已移除的連線仍在寫出清單")
+        uploads = sum(len(s.uploads or ()) for s in server.clients.values())
+        if uploads:
+            problems.append(f"{uploads} 個未完成的上傳")
+    slots = server._handshake_slots
+    if slots is not None and slots._value != slots._initial_value:
+        problems.append(f"握手名額 {slots._value}/{slots._initial_value} 未歸還")
+    return problems
+
+
+def settle(server: ChatServer, residents: int, timeout: float) -> bool:
+    """等伺服器把斷線的連線都回收（active 回到常駐數、執行緒數穩定）。"""
+    deadline = time.monotonic() + timeout
+    last = -1
+    stable = 0
+    while time.monotonic() < deadline:
+        n = threading.active_count()
+        if server.active == residents and len(server.clients) == residents and n == last:
+            stable += 1
+            if stable >= 3:
+                return True
+        else:
+            stable = 0
+        last = n
+        time.sleep(0.1)
+    return False
+
+
+def sample() -> Dict[str, Optional[int]]:
+    return {
+        "rss": current_rss(),
+        "threads": threading.active_count(),
+        "fds": open_fds(),
+        "traced": tracemalloc.get_traced_memory()[0] if tracemalloc.is_tracing() else None,
+    }
+
+
+def growth_failures(base: dict, now: dict, args) -> List[str]:
+    limits = {
+        "rss": args.max_rss_growth_mb * 1048576,
+        "threads": args.max_thread_growth,
+        "fds": args.max_fd_growth,
+        "traced": args.max_traced_growth_mb * 1048576,
+    }
+    failures = []
+    for key, limit in limits.items():
+        if base[key] is None or now[key] is None:
+            continue
+        grown = now[key] - base[key]
+        if grown > limit:
+            unit = 1048576 if key in ("rss", "traced") else 1
+            failures.append(f"{key} 成長 {grown / unit:.1f} > {limit / unit:.1f}")
+    return failures
+
+
+def fmt(s: dict) -> str:
+    def mib(v):
+        return "?" if v is None else f"{v / 1048576:.1f}"
+    return f"rss={mib(s['rss'])}MiB threads={s['threads']} fds={s['fds'] if s['fds'] is not None else '?'} traced={mib(s['traced'])}MiB"
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description="soak chat_server with connection churn and fail on resource growth")
+    ap.add_argument("--cert", required=True, help="server TLS certificate (PEM)")
+    ap.add_argument("--key", required=True, help="server TLS private key (PEM)")
+    ap.add_argument("--port", type=int, default=5099, help="port for the in-process server (default: 5099)")
+    ap.add_argument("--duration", type=float, default=300.0, help="seconds of churn, e.g. 14400 for four hours (default: 300)")
+    ap.add_argument("--warmup", type=float, default=20.0, help="seconds of churn before the baseline sample (default: 20)")
+    ap.add_argument("--sample-interval", type=float, default=30.0, help="seconds between quiescent samples (default: 30)")
+    ap.add_argument("--workers", type=int, default=8, help="concurrent churn threads (default: 8)")
+    ap.add_argument("--residents", type=int, default=5, help="connections kept joined for the whole run (default: 5)")
+    ap.add_argument("--seed", type=int, default=1, help="random seed for scenario choice (default: 1)")
+    ap.add_argument("--coalesce-ms", type=float, default=0.0, help="run the server with write coalescing (default: 0)")
+    ap.add_argument("--writer-threads", type=int, default=0, help="run the server with priority-lane writer threads (default: 0)")
+    ap.add_argument("--max-rss-growth-mb", type=float, default=32.0, help="fail if RSS grows more than this (default: 32)")
+    ap.add_argument("--max-thread-growth", type=int, default=2, help="fail if the thread count grows more than this (default: 2)")
+    ap.add_argument("--max-fd-growth", type=int, default=4, help="fail if open fds grow more than this (default: 4)")
+    ap.add_argument("--max-traced-growth-mb", type=float, default=8.0,
+                    help="fail if tracemalloc-traced memory grows more than this (default: 8)")
+    ap.add_argument("--no-tracemalloc", action="store_true", help="skip tracemalloc (faster churn, no allocation report)")
+    ap.add_argument("--trace-frames", type=int, default=8, help="frames kept per tracemalloc allocation (default: 8)")
+    ap.add_argument("--verbose", action="store_true", help="keep the server's own log lines")
+    args = ap.parse_args()
+
+    if not args.no_tracemalloc:
+        tracemalloc.start(args.trace_frames)
+    if not args.verbose:
+        sys.stdout = open(os.devnull, "w", encoding="utf-8")
+    server = ChatServer("127.0.0.1", args.port, args.cert, args.key,
+                        max_conns=0, max_conns_per_ip=0, ping_interval=0, ping_timeout=0,
+                        coalesce_ms=args.coalesce_ms, writer_threads=args.writer_threads)
+    threading.Thread(target=server.start, name="server", daemon=True).start()
+    deadline = time.monotonic() + 10
+    while True:
+        try:
+            socket.create_connection(("127.0.0.1", args.port), timeout=1).close()
+            break
+        except OSError:
+            if time.monotonic() > deadline:
+                sys.exit("伺服器未能啟動")
+            time.sleep(0.1)
+
+    residents = Residents(args.port, args.residents)
+    churn = Churn(args.port, args.workers, args.seed)
+    started = time.monotonic()
+    churn.start()
+    log(f"churn {args.workers} workers, {args.residents} residents, duration {args.duration:.0f}s, warmup {args.warmup:.0f}s")
+
+    failures: List[str] = []
+    base = None
+    base_snapshot = None
+    next_sample = started + args.warmup
+    end = started + args.warmup + args.duration
+    try:
+        while True:
+            time.sleep(max(0.0, min(next_sample, end) - time.monotonic()))
+            finished = time.monotonic() >= end
+            churn.pause()
+            t_pause = time.monotonic()
+            if not settle(server, args.residents, timeout=30):
+                failures.append(f"30 秒內未回收完畢：active={server.active} clients={len(server.clients)}")
+            problems = server_invariants(server, args.residents)
+            now = sample()
+            cycles = sum(churn.counts.values())
+            elapsed = time.monotonic() - started
+            if base is None:
+                base = now
+                base_snapshot = tracemalloc.take_snapshot() if tracemalloc.is_tracing() else None
+                log(f"baseline after {cycles} cycles: {fmt(now)}")
+            else:
+                grown = growth_failures(base, now, args)
+                log(f"t={elapsed:7.0f}s cycles={cycles} ({cycles / elapsed:.0f}/s) {fmt(now)}"
+                    f"{'  ' + '; '.join(grown) if grown else ''}")
+                if finished:
+                    failures.extend(grown)
+            if problems:
+                failures.extend(problems)
+                log("狀態不一致: " + "; ".join(problems))
+            if finished or failures:
+                break
+            next_sample = time.monotonic() + args.sample_interval
+            started += time.monotonic() - t_pause     # 暫停時間不算進速率
+            end += time.monotonic() - t_pause
+            churn.resume()
+    except KeyboardInterrupt:
+        log("中斷")
+    finally:
+        churn.stop()
+
+    log("scenarios " + " ".join(f"{k}={v}" for k, v in sorted(churn.counts.items())))
+    if churn.errors:
+        log("client errors " + " ".join(f"{k}={v}" for k, v in sorted(churn.errors.items())))
+    log(f"server {server._stats_line()}")
+    if failures and base_snapshot is not None:
+        snapshot = tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+            tracemalloc.Filter(False, __file__, all_frames=True),     # 測試端自己的連線
+        ))
+        log("top allocation growth since baseline (server side):")
+        for stat in snapshot.compare_to(base_snapshot, "traceback")[:10]:
+            _out.write(f"  {stat.size_diff / 1024:+10.1f} KiB {stat.count_diff:+8d} blocks\n")
+            for line in stat.traceback.format()[-6:]:
+                _out.write(f"      {line}\n")
+    residents.close()
+    server.running = False
+    if failures:
+        log("FAIL: " + "; ".join(failures))
+        sys.exit(1)
+    log("PASS")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,164 @@
+import pytest
+
+from chat_client_tui import (
+    ChatEntry, ChatHistory, HistoryIndex, PostingFile, ScrollbackFile, _matches, _query_tokens, _tokenize,
+)
+
+
+def test_tokenize_splits_cjk_and_latin_runs():
+    assert _tokenize("Hello世界abc") == {"hello", "世", "界", "世界", "abc"}
+
+
+def test_tokenize_cjk_unigrams_and_bigrams():
+    assert _tokenize("測試資料") == {"測", "試", "資", "料", "測試", "試資", "資料"}
+
+
+def test_tokenize_kana_and_hangul_are_cjk():
+    assert _tokenize("カナ") == {"カ", "ナ", "カナ"}
+    assert _tokenize("한글 ok") == {"한", "글", "한글", "ok"}
+
+
+def test_tokenize_punctuation_and_digits():
+    assert _tokenize("v2.0, ok!") == {"v2", "0", "ok"}
+
+
+def test_query_tokens_use_bigrams_for_cjk():
+    # 單字查詢保留單字；兩字以上只用 bigram，避免單字 posting 過長
+    assert _query_tokens("中") == {"中"}
+    assert _query_tokens("測試資") == {"測試", "試資"}
+    assert _query_tokens("Conn 測試") == {"conn", "測試"}
+
+
+def test_query_tokens_empty():
+    assert _query_tokens("  ,. ") == set()
+
+
+def test_prefix_matching_for_latin():
+    idx = HistoryIndex()
+    idx.add(0, "connection reset")
+    idx.add(1, "connect")
+    idx.add(2, "cone")
+    assert idx.candidates("conn") == [0, 1]
+    assert idx.candidates("con") == [0, 1, 2]
+    assert idx.candidates("nection") == []
+
+
+def test_cjk_is_not_prefix_matched():
+    idx = HistoryIndex()
+    idx.add(0, "測試")
+    idx.add(1, "測")
+    assert idx.candidates("測") == [0, 1]
+    assert idx.candidates("測試") == [0]
+
+
+def test_candidates_intersect_all_tokens():
+    idx = HistoryIndex()
+    idx.add(0, "alpha beta")
+    idx.add(1, "alpha")
+    idx.add(2, "beta gamma")
+    assert idx.candidates("alpha beta") == [0]
+    assert idx.candidates("alpha zzz") == []
+    assert idx.candidates("beta", below=2) == [0]
+
+
+def test_remove_drops_vocabulary():
+    idx = HistoryIndex()
+    idx.add(0, "alpha")
+    idx.remove(0, "alpha")
+    assert idx.candidates("al") == []
+    assert idx._latin == []
+
+
+def test_freeze_spills_segments(tmp_path):
+    spill = PostingFile(str(tmp_path / "h.idx"))
+    idx = HistoryIndex(spill)
+    idx._SEGMENT_DOCS = 3
+    texts = ["alpha one", "beta 測試", "alpha two", "gamma", "alpha 測試", "beta"]
+    for i, text in enumerate(texts):
+        idx.add(i, text)
+    for i, text in enumerate(texts[:4]):
+        idx.freeze(i, text)
+    # 前三筆寫成一段，第四筆仍在記憶體
+    assert len(spill._segments) == 1
+    assert set(idx._pending) == {"gamma"}
+    assert "one" not in idx._latin and "alpha" in idx._latin
+    assert idx.candidates("alpha") == [0, 2, 4]
+    assert idx.candidates("o") == [0]
+    assert idx.candidates("測試") == [1, 4]
+    assert idx.candidates("beta 測試") == [1]
+    assert idx.candidates("gam") == [3]
+    idx.clear()
+    assert idx.candidates("alpha") == []
+    assert spill._segments == []
+    spill.close()
+
+
+def test_posting_file_refuses_existing_file(tmp_path):
+    path = tmp_path / "h.idx"
+    path.write_bytes(b"keep")
+    with pytest.raises(FileExistsError):
+        PostingFile(str(path))
+    assert path.read_bytes() == b"keep"
+
+
+def test_posting_file_prefix_lookup():
+    spill = PostingFile()
+    spill.write_segment({"apple": _ids(1, 5), "apply": _ids(2), "banana": _ids(3)})
+    spill.write_segment({"apple": _ids(9)})
+    found = spill.find("appl", prefix=True)
+    assert sorted(list(spill.read(off, n)) for _, _, off, n in found) == [[1, 5], [2], [9]]
+    assert [list(spill.read(off, n)) for _, _, off, n in spill.find("apple")] == [[1, 5], [9]]
+    assert spill.find("appl") == []
+    assert spill.find("zzz", prefix=True) == []
+    spill.close()
+
+
+def _ids(*values):
+    from array import array
+    return array("I", values)
+
+
+def _history(scrollback):
+    h = ChatHistory(max_entries=8, scrollback=scrollback)
+    h.index._SEGMENT_DOCS = 5
+    return h
+
+
+@pytest.mark.parametrize("spill", [True, False])
+def test_history_search_matches_brute_force(spill):
+    h = _history(ScrollbackFile() if spill else None)
+    texts = []
+    for i in range(60):
+        text = ["hello world", "help 測試資料", "測試 料資", "nothing", "hello 資料"][i % 5]
+        h.append(ChatEntry(user="u", text=text, ts=""))
+        texts.append(f"u {text}")
+    first = h._dropped
+    for term in ["hel", "測試資料", "資料 hello", "料資", "zzz"]:
+        expect = [i for i in range(first, len(texts)) if _matches(term, texts[i])]
+        assert h.search(term) == expect
+    if spill:
+        assert h.index.spill._segments
+        h.index.spill.close()
+        h.scrollback.close()
+
+
+def test_search_hits_follow_new_entries():
+    h = _history(ScrollbackFile())
+    for _ in range(20):
+        h.append(ChatEntry(user="u", text="alpha", ts=""))
+    assert len(h.search("alp")) == 20
+    h.append(ChatEntry(user="u", text="beta", ts=""))
+    h.append(ChatEntry(user="u", text="alphabet", ts=""))
+    assert h.search_hits[-1] == 21 and len(h.search_hits) == 21
+    h.search("")
+    h.append(ChatEntry(user="u", text="alpha", ts=""))
+    assert h.search_hits == []
+
+
+def test_search_hits_drop_evicted_entries():
+    h = _history(None)
+    for _ in range(8):
+        h.append(ChatEntry(user="u", text="alpha", ts=""))
+    assert h.search("alpha") == list(range(8))
+    h.append(ChatEntry(user="u", text="alpha", ts=""))
+    assert h.search_hits == list(range(1, 9))
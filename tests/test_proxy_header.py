@@ -0,0 +1,144 @@
+import socket
+import struct
+
+import pytest
+
+from chat_server import PROXY_V1_MAX, PROXY_V2_SIG, read_proxy_header
+
+
+class Chunks:
+    """依序回傳預先切好的資料，模擬標頭分成多次到達；用完後回傳 b"" 表示對端關閉。"""
+
+    def __init__(self, *chunks: bytes) -> None:
+        self.chunks = list(chunks)
+
+    def recv(self, n: int) -> bytes:
+        if not self.chunks:
+            return b""
+        chunk = self.chunks.pop(0)
+        if len(chunk) > n:
+            self.chunks.insert(0, chunk[n:])
+            chunk = chunk[:n]
+        return chunk
+
+
+def v2(command: int, family: int, body: bytes) -> bytes:
+    return PROXY_V2_SIG + bytes([0x20 | command, family << 4 | 1]) + struct.pack("!H", len(body)) + body
+
+
+def v2_tcp4(src: str, port: int, extra: bytes = b"") -> bytes:
+    body = socket.inet_aton(src) + socket.inet_aton("10.0.0.1") + struct.pack("!HH", port, 443) + extra
+    return v2(1, 1, body)
+
+
+def test_v1_tcp4_keeps_leftover():
+    conn = Chunks(b"PROXY TCP4 203.0.113.7 10.0.0.1 51234 443\r\n{\"type\":", b"\"join\"}\n")
+    assert read_proxy_header(conn) == (("203.0.113.7", 51234), b"{\"type\":")
+
+
+def test_v1_tcp6():
+    conn = Chunks(b"PROXY TCP6 2001:db8::1 2001:db8::2 4000 443\r\n")
+    assert read_proxy_header(conn) == (("2001:db8::1", 4000), b"")
+
+
+def test_v1_split_across_reads():
+    line = b"PROXY TCP4 198.51.100.2 10.0.0.1 1000 443\r\nrest"
+    conn = Chunks(*[line[i:i + 1] for i in range(len(line))])
+    real, rest = read_proxy_header(conn)
+    assert real == ("198.51.100.2", 1000)
+    assert rest == b""      # 讀到 \r\n 就停，之後的資料留在 socket 裡
+    assert b"".join(conn.chunks) == b"rest"
+
+
+def test_v1_unknown_returns_none():
+    assert read_proxy_header(Chunks(b"PROXY UNKNOWN\r\nhi")) == (None, b"hi")
+    assert read_proxy_header(Chunks(b"PROXY UNKNOWN ffff::1 ffff::2 1 2\r\n")) == (None, b"")
+
+
+def test_v1_oversized_without_crlf():
+    conn = Chunks(b"PROXY TCP4 " + b"1" * PROXY_V1_MAX)
+    with pytest.raises(ValueError):
+        read_proxy_header(conn)
+
+
+def test_v1_oversized_line():
+    line = b"PROXY TCP4 1.2.3.4 5.6.7.8 1 " + b"2" * PROXY_V1_MAX + b"\r\n"
+    with pytest.raises(ValueError, match="too long"):
+        read_proxy_header(Chunks(line))
+
+
+def test_v1_truncated():
+    with pytest.raises(ValueError, match="closed"):
+        read_proxy_header(Chunks(b"PROXY TCP4 1.2.3.4 5.6"))
+
+
+@pytest.mark.parametrize("line", [
+    b"PROXY TCP4 1.2.3.4 5.6.7.8 1\r\n",
+    b"PROXY TCP4 1.2.3.999 5.6.7.8 1 2\r\n",
+    b"PROXY TCP4 1.2.3.4 5.6.7.8 70000 2\r\n",
+    b"PROXY UDP4 1.2.3.4 5.6.7.8 1 2\r\n",
+])
+def test_v1_malformed(line):
+    with pytest.raises(ValueError):
+        read_proxy_header(Chunks(line))
+
+
+def test_missing_header():
+    with pytest.raises(ValueError, match="missing"):
+        read_proxy_header(Chunks(b"{\"type\": \"join\"}\n"))
+
+
+def test_v2_tcp4_keeps_leftover():
+    header = v2_tcp4("192.0.2.9", 40000)
+    conn = Chunks(header[:5], header[5:20], header[20:] + b"data")
+    assert read_proxy_header(conn) == (("192.0.2.9", 40000), b"data")
+
+
+def test_v2_tcp6():
+    body = socket.inet_pton(socket.AF_INET6, "2001:db8::5") + bytes(16) + struct.pack("!HH", 5555, 443)
+    assert read_proxy_header(Chunks(v2(1, 2, body))) == (("2001:db8::5", 5555), b"")
+
+
+def test_v2_with_tlvs():
+    # 位址區塊之後的 TLV 一併讀掉，不會留在後續資料裡
+    tlv = b"\x04" + struct.pack("!H", 300) + b"x" * 300
+    assert read_proxy_header(Chunks(v2_tcp4("192.0.2.1", 1, tlv) + b"after")) == (("192.0.2.1", 1), b"after")
+
+
+def test_v2_local_returns_none():
+    assert read_proxy_header(Chunks(v2(0, 1, bytes(12)) + b"x")) == (None, b"x")
+
+
+def test_v2_unspec_and_unix_return_none():
+    assert read_proxy_header(Chunks(v2(1, 0, b""))) == (None, b"")
+    assert read_proxy_header(Chunks(v2(1, 3, bytes(216)))) == (None, b"")
+
+
+def test_v2_truncated_body():
+    header = v2_tcp4("192.0.2.9", 40000)
+    with pytest.raises(ValueError, match="closed"):
+        read_proxy_header(Chunks(header[:-3]))
+
+
+def test_v2_oversized_length_truncated():
+    header = PROXY_V2_SIG + b"\x21\x11" + struct.pack("!H", 0xFFFF) + bytes(12)
+    with pytest.raises(ValueError, match="closed"):
+        read_proxy_header(Chunks(header))
+
+
+def test_v2_short_address_block():
+    with pytest.raises(ValueError, match="truncated"):
+        read_proxy_header(Chunks(v2(1, 1, bytes(8))))
+
+
+def test_v2_bad_version_or_command():
+    header = v2_tcp4("192.0.2.9", 1)
+    with pytest.raises(ValueError):
+        read_proxy_header(Chunks(header[:12] + b"\x11" + header[13:]))
+    with pytest.raises(ValueError):
+        read_proxy_header(Chunks(header[:12] + b"\x22" + header[13:]))
+
+
+def test_v2_truncated_signature():
+    with pytest.raises(ValueError, match="closed"):
+        read_proxy_header(Chunks(PROXY_V2_SIG[:7]))